@@ -0,0 +1,99 @@
+import threading
+import time
+from typing import Dict, Optional, Union
+from sqlalchemy import exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+
+class CheckoutStats:
+    """
+    Статистика получения соединений из пула: количество, суммарное и максимальное время ожидания, таймауты
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.checkouts = 0
+        self.timeouts = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def record(self, wait: float, timed_out: bool = False) -> None:
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+            else:
+                self.checkouts += 1
+                self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'checkouts': self.checkouts,
+                'timeouts': self.timeouts,
+                'total_wait_seconds': self.total_wait,
+                'avg_wait_seconds': self.total_wait / self.checkouts if self.checkouts else 0.0,
+                'max_wait_seconds': self.max_wait,
+            }
+
+
+class InstrumentedPoolMixin:
+    """
+    Замер времени ожидания свободного соединения пула (включая открытие нового)
+    """
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.checkout_stats = CheckoutStats()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except exc.TimeoutError:
+            self.checkout_stats.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.checkout_stats.record(time.perf_counter() - start)
+        return conn
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    """
+    QueuePool со статистикой ожидания соединений
+    """
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    """
+    Пул асинхронного движка (create_async_engine) со статистикой ожидания: ожидание соединения
+    в цикле событий замеряется так же, как в потоке
+    """
+
+
+def pool_status(engine: Union[Engine, AsyncEngine]) -> Dict:
+    """
+    Текущее состояние пула соединений движка: размер, выданные соединения, переполнение и статистика ожидания
+    У асинхронного движка пул принадлежит его синхронному движку (sync_engine)
+    """
+    pool = getattr(engine, 'sync_engine', engine).pool
+    status = {'pool_class': type(pool).__name__}
+    if isinstance(pool, QueuePool):
+        status.update(
+            size=pool.size(),
+            checked_in=pool.checkedin(),
+            checked_out=pool.checkedout(),
+            overflow=pool.overflow(),
+        )
+    if isinstance(pool, InstrumentedPoolMixin):
+        status.update(pool.checkout_stats.as_dict())
+    return status
+
+
+def pools_status(**engines: Optional[Union[Engine, AsyncEngine]]) -> Dict:
+    """
+    Состояние пулов нескольких движков по именам; None - движок еще не создан (им не пользовались),
+    и ради отчета он не создается
+    """
+    return {name: pool_status(engine) if engine is not None else None for name, engine in engines.items()}
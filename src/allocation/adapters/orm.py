@@ -1,5 +1,10 @@
+import sys
+from collections import deque
+from sqlalchemy import event
 from sqlalchemy.orm import registry, relationship
-from sqlalchemy import MetaData, Table, Column, Integer, String, Date, ForeignKey
+from sqlalchemy import (
+    MetaData, Table, Column, Integer, String, Text, Date, DateTime, ForeignKey, Index, PrimaryKeyConstraint, func
+)
 from src.allocation.domain import models
 
 metadata = MetaData()
@@ -11,6 +16,7 @@ order_lines = Table(
     Column('sku', String(255)),
     Column('qty', Integer, nullable=False),
     Column('orderid', String(255)),
+    Index('ix_order_lines_orderid_sku', 'orderid', 'sku'),
 )
 
 products = Table(
@@ -26,6 +32,8 @@ batches = Table(
     Column('sku', ForeignKey('products.sku')),
     Column('_purchased_quantity', Integer, nullable=False),
     Column("eta", Date, nullable=True),
+    Index('ix_batches_reference', 'reference', unique=True),    # поиск продукта по ссылке партии
+    Index('ix_batches_sku', 'sku'),     # загрузка партий продукта: внешние ключи Postgres не индексирует сам
 )
 
 allocations = Table(
@@ -33,15 +41,87 @@ allocations = Table(
     Column("id", Integer, primary_key=True, autoincrement=True),
     Column("orderline_id", ForeignKey("order_lines.id")),
     Column("batch_id", ForeignKey("batches.id")),
+    Index('ix_allocations_batch_id', 'batch_id'),       # загрузка позиций партии
+    Index('ix_allocations_orderline_id', 'orderline_id'),
 )
 
+# Модель чтения: одна строка на товарную позицию заказа; ключ - позиция целиком (orderid, sku, qty), как и равенство
+# OrderLine в предметной области: позиции одного заказа и артикула с разным количеством размещаются отдельно
+# и могут попасть в разные партии; первичный ключ обслуживает и выборку по orderid (префикс ключа),
+# и удаление позиции по (orderid, sku, qty)
+# Индекс по sku - для дельты перестроения (adapters/projection_rebuild.py), копируемой под блокировкой
 allocations_view = Table(
     'allocations_view', metadata,
-    Column('orderid', String(255)),
-    Column('sku', String(255)),
-    Column('batchref', String(255))
+    Column('orderid', String(255), nullable=False),
+    Column('sku', String(255), nullable=False),
+    Column('qty', Integer, nullable=False),
+    Column('batchref', String(255)),
+    PrimaryKeyConstraint('orderid', 'sku', 'qty', name='pk_allocations_view'),
+    Index('ix_allocations_view_sku', 'sku'),
+)
+
+# Транзакционный outbox: события для внешних систем записываются в одной транзакции с изменением агрегата,
+# в Redis их публикует отдельный процесс (entrypoints/outbox_relay.py)
+outbox = Table(
+    'outbox', metadata,
+    Column('id', Integer, primary_key=True, autoincrement=True),
+    Column('channel', String(255), nullable=False),
+    Column('payload', Text, nullable=False),
+    Column('created_at', DateTime, nullable=False, server_default=func.now()),
+    Column('sent_at', DateTime, nullable=True),     # NULL - событие еще не опубликовано
+    Index('ix_outbox_unsent', 'sent_at', 'id'),
+)
+
+
+# Контрольные точки перестроения проекций (entrypoints/rebuild_read_model.py): одна строка на часть
+# диапазона allocations.id, которую копирует отдельный поток; last_key - последний скопированный id
+projection_checkpoints = Table(
+    'projection_checkpoints', metadata,
+    Column('projection', String(255), primary_key=True),
+    Column('part', Integer, primary_key=True),
+    Column('start_key', Integer, nullable=False),
+    Column('end_key', Integer, nullable=False),
+    Column('last_key', Integer, nullable=False),
+    Column('rows', Integer, nullable=False, server_default='0'),
+    Column('updated_at', DateTime, nullable=False, server_default=func.now()),
 )
 
+
+def _reset_allocated_quantity(batch, *args):
+    """
+    Сброс накопленной суммы размещенных позиций партии, если ORM загружает или обновляет ее состояние из БД
+    """
+    if batch is not None:   # объект мог быть уже удален сборщиком мусора
+        batch.reset_allocated_quantity()
+
+
+def _reset_product_indexes(product, *args):
+    """
+    Сброс индексов агрегата, построенных по партиям, если ORM загружает или обновляет его состояние из БД
+    """
+    if product is not None:
+        product.reset_indexes()
+
+
+def _intern_line_sku(line, *args):
+    """
+    Одна строка артикула на все загруженные позиции вместо копии в каждой строке результата запроса
+    Значение заменяется в __dict__ в обход инструментирования: оно равно загруженному, изменением это не считается
+    """
+    sku = line.__dict__.get('sku') if line is not None else None
+    if sku is not None:
+        line.__dict__['sku'] = sys.intern(sku)
+
+
+def _init_product_events(product, *args):
+    """
+    Собственный список событий для продукта, загруженного ORM без вызова __init__,
+    иначе все такие продукты (в т.ч. из разных потоков) делили бы общий атрибут класса Product.events
+    """
+    if product is not None:
+        product.events = deque()
+
+
 def start_mappers():
     lines_mapper = mapper_reg.map_imperatively(models.OrderLine, order_lines)   # Привязка класса модели к таблице
     batches_mapper = mapper_reg.map_imperatively(
@@ -53,4 +133,17 @@ def start_mappers():
             )
         }
     )
-    mapper_reg.map_imperatively(models.Product, products, properties={"batches": relationship(batches_mapper)})
\ No newline at end of file
+    mapper_reg.map_imperatively(
+        models.Product,
+        products,
+        properties={"batches": relationship(batches_mapper)},
+        # оптимистическая блокировка: UPDATE products ... WHERE version_number = <загруженная версия>,
+        # новую версию назначает сам агрегат, если строка не обновилась - StaleDataError
+        version_id_col=products.c.version_number,
+        version_id_generator=False,
+    )
+    for identifier in ('load', 'refresh', 'expire'):
+        event.listen(models.Batch, identifier, _reset_allocated_quantity)
+        event.listen(models.Product, identifier, _reset_product_indexes)
+    event.listen(models.Product, 'load', _init_product_events)
+    event.listen(models.OrderLine, 'load', _intern_line_sku)
@@ -0,0 +1,61 @@
+import logging
+from typing import Dict, Iterable, List
+from sqlalchemy import func, select, update
+
+from src.allocation.adapters import orm
+from src.allocation.adapters.redis_eventpublisher import CHANNEL_MAPPING, serialize
+from src.allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+
+def outbox_rows(new_events: Iterable[events.Event]) -> List[Dict]:
+    """
+    Строки outbox для событий, которые публикуются во внешние каналы (см. redis_eventpublisher.CHANNEL_MAPPING)
+    """
+    return [
+        {'channel': CHANNEL_MAPPING[type(event)], 'payload': serialize(event)}
+        for event in new_events if type(event) in CHANNEL_MAPPING
+    ]
+
+
+class OutboxRelay:
+    """
+    Публикация событий из outbox в Redis:
+    пачка неопубликованных строк читается с блокировкой (FOR UPDATE SKIP LOCKED - несколько ретрансляторов
+    не делят одни и те же строки), публикуется одним конвейером Redis и помечается отправленной в той же транзакции
+    Доставка "хотя бы один раз": при сбое между публикацией и фиксацией пачка будет опубликована повторно
+    """
+
+    def __init__(self, session_factory, redis_client, batch_size: int = 100) -> None:
+        self.session_factory = session_factory
+        self.redis = redis_client
+        self.batch_size = batch_size
+
+    def relay_once(self) -> int:
+        """
+        Публикация одной пачки, возвращает число опубликованных событий
+        """
+        session = self.session_factory()
+        try:
+            rows = session.execute(
+                select(orm.outbox.c.id, orm.outbox.c.channel, orm.outbox.c.payload)
+                .where(orm.outbox.c.sent_at.is_(None))
+                .order_by(orm.outbox.c.id)
+                .limit(self.batch_size)
+                .with_for_update(skip_locked=True)
+            ).all()
+            if not rows:
+                return 0
+            pipe = self.redis.pipeline(transaction=False)
+            for row in rows:
+                pipe.publish(row.channel, row.payload)
+            pipe.execute()
+            session.execute(
+                update(orm.outbox).where(orm.outbox.c.id.in_([row.id for row in rows])).values(sent_at=func.now())
+            )
+            session.commit()
+            logger.debug('relayed %s outbox events', len(rows))
+            return len(rows)
+        finally:
+            session.close()     # без фиксации откатывает транзакцию и снимает блокировки строк
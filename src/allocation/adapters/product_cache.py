@@ -0,0 +1,161 @@
+import time
+import threading
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+from src.allocation.domain import models
+from src.allocation.adapters.repository import AbstractProductRepositoriy, SqlAlchemyRepository
+
+
+class ProductCacheStats:
+    """
+    Счетчики кеша агрегатов: попадания, промахи (в т.ч. из-за устаревшей версии), вытеснения, инвалидации
+    и время получения агрегата - при попадании (проверка версии) и при загрузке из БД
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.stale = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.hit_seconds = 0.0
+        self.load_seconds = 0.0
+
+    def increment(self, name: str, value=1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            load_time = self.load_seconds / self.misses if self.misses else 0.0
+            hit_time = self.hit_seconds / self.hits if self.hits else 0.0
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale': self.stale,
+                'hit_ratio': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'avg_hit_ms': hit_time * 1000,
+                'avg_load_ms': load_time * 1000,
+                # оценка: каждое попадание сэкономило среднюю загрузку агрегата за вычетом проверки версии
+                'saved_seconds': max(self.hits * load_time - self.hit_seconds, 0.0),
+            }
+
+
+class ProductCache:
+    """
+    Кеш агрегатов Product процесса по артикулу (LRU, не больше max_size продуктов)
+    Продукт из кеша выдается одному UoW (checkout) и возвращается им после успешной фиксации (checkin),
+    поэтому один объект никогда не изменяют параллельно два потока
+    """
+
+    def __init__(self, max_size: int = 1000, stats: Optional[ProductCacheStats] = None) -> None:
+        self.max_size = max_size
+        self.stats = stats or ProductCacheStats()
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()    # артикул -> продукт, отсоединенный от сеанса
+
+    def checkout(self, sku: str) -> Optional[models.Product]:
+        with self._lock:
+            return self._items.pop(sku, None)
+
+    def checkin(self, product: models.Product) -> None:
+        """
+        Возврат продукта в кеш; более новая версия, возвращенная другим UoW, не заменяется
+        """
+        with self._lock:
+            current = self._items.get(product.sku)
+            if current is not None and current.version_number > product.version_number:
+                return
+            self._items[product.sku] = product
+            self._items.move_to_end(product.sku)
+            evicted = 0
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.increment('evictions', evicted)
+
+    def invalidate(self, sku: str) -> None:
+        self.stats.increment('invalidations')
+        with self._lock:
+            self._items.pop(sku, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class ReleasedProduct:
+    """
+    Место продукта, возвращенного в кеш, в repository.seen: необработанные события агрегата остаются
+    у UoW, который их породил, - шина соберет их после выхода из блока with
+    """
+
+    def __init__(self, product: models.Product) -> None:
+        self.sku = product.sku
+        self.events = product.events
+        product.events = deque()
+
+
+class CachingProductRepository(AbstractProductRepositoriy):
+    """
+    Репозиторий с кешем агрегатов поверх SqlAlchemyRepository:
+    продукт из кеша используется, только если его version_number совпадает с версией строки products
+    (один запрос по первичному ключу вместо загрузки партий и позиций), иначе агрегат загружается заново
+    Поиск по ссылке партии кеш не использует
+    """
+
+    def __init__(self, repository: SqlAlchemyRepository, cache: ProductCache) -> None:
+        super().__init__()
+        self.repository = repository
+        self.cache = cache
+        self.skus = set()   # артикулы агрегатов транзакции: после сбоя фиксации атрибуты продуктов уже не прочитать
+
+    def _add(self, product):
+        self.skus.add(product.sku)
+        self.repository._add(product)
+
+    def _get(self, sku):
+        self.skus.add(sku)
+        start = time.perf_counter()
+        cached = self.cache.checkout(sku)
+        if cached is not None:
+            if self.repository.version(sku) == cached.version_number:
+                self.repository.attach(cached)
+                self.cache.stats.increment('hits')
+                self.cache.stats.increment('hit_seconds', time.perf_counter() - start)
+                return cached
+            self.cache.stats.increment('stale')
+        product = self.repository._get(sku)
+        self.cache.stats.increment('misses')
+        self.cache.stats.increment('load_seconds', time.perf_counter() - start)
+        return product
+
+    def _get_by_batchref(self, batchref):
+        return self.repository._get_by_batchref(batchref)
+
+    def release(self) -> None:
+        """
+        Возврат в кеш продуктов зафиксированной транзакции, вызывается UoW после закрытия сеанса
+        Продукты отмененной транзакции в кеш не возвращаются: откат сеанса сбросил их состояние
+        """
+        for product in list(self.seen):
+            if not isinstance(product, ReleasedProduct):
+                self.seen.discard(product)
+                self.seen.add(ReleasedProduct(product))
+                self.cache.checkin(product)
+
+    def invalidate(self) -> None:
+        """
+        Сбой фиксации: записи кеша для артикулов транзакции удаляются
+        """
+        for sku in self.skus:
+            self.cache.invalidate(sku)
@@ -0,0 +1,252 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional
+from sqlalchemy import Column, Integer, MetaData, String, Table, bindparam, delete, func, insert, select, update
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.sql import text
+
+from src.allocation.adapters import orm
+
+logger = logging.getLogger(__name__)
+
+PROJECTION = 'allocations_view'
+SHADOW = 'allocations_view_rebuild'
+RETIRED = 'allocations_view_retired'
+VERSIONS = 'allocations_view_rebuild_versions'
+
+# Строки модели чтения из таблиц записи; :lo < allocations.id <= :hi - очередная порция (keyset по первичному ключу)
+_SOURCE = (
+    'SELECT ol.orderid, ol.sku, ol.qty, b.reference FROM allocations a'
+    ' JOIN order_lines ol ON ol.id = a.orderline_id'
+    ' JOIN batches b ON b.id = a.batch_id'
+)
+COPY_CHUNK = text(
+    f'INSERT INTO {SHADOW} (orderid, sku, qty, batchref) {_SOURCE} WHERE a.id > :lo AND a.id <= :hi'
+    ' ON CONFLICT (orderid, sku, qty) DO NOTHING'
+)
+# Досчет по отсутствию строки, а не по id: последовательность выдает id при вставке, а не при фиксации,
+# и размещение с id ниже скопированного диапазона может зафиксироваться уже после его копирования
+CATCH_UP = text(
+    f'INSERT INTO {SHADOW} (orderid, sku, qty, batchref) {_SOURCE}'
+    f' WHERE NOT EXISTS (SELECT 1 FROM {SHADOW} s WHERE s.orderid = ol.orderid AND s.sku = ol.sku AND s.qty = ol.qty)'
+    ' ON CONFLICT (orderid, sku, qty) DO NOTHING'
+)
+DELETE_STALE = text(
+    f'DELETE FROM {SHADOW} WHERE NOT EXISTS ({_SOURCE}'
+    f' WHERE ol.orderid = {SHADOW}.orderid AND ol.sku = {SHADOW}.sku AND ol.qty = {SHADOW}.qty'
+    f' AND b.reference = {SHADOW}.batchref)'
+)
+# Заказы, строки которых в текущей и новой таблицах различаются: их записи кеша модели чтения устарели
+CHANGED_ORDERS = [
+    text(f'SELECT DISTINCT orderid FROM (SELECT orderid, sku, qty, batchref FROM {left}'
+         f' EXCEPT SELECT orderid, sku, qty, batchref FROM {right}) AS changed')
+    for left, right in ((PROJECTION, SHADOW), (SHADOW, PROJECTION))
+]
+
+# Дельта под блокировкой: артикулы, версия продукта которых изменилась после снимка версий
+# (версия растет в той же транзакции, что и размещение, поэтому снимок упорядочен по фиксации, а не по id)
+CHANGED_SKUS = text(
+    f'SELECT p.sku FROM products p LEFT JOIN {VERSIONS} v ON v.sku = p.sku'
+    ' WHERE v.sku IS NULL OR v.version_number <> p.version_number'
+)
+ORDERS_OF_SKUS = [
+    text(f'SELECT DISTINCT orderid FROM {table} WHERE sku IN :skus').bindparams(bindparam('skus', expanding=True))
+    for table in (PROJECTION, SHADOW)
+]
+DELETE_SKUS = text(f'DELETE FROM {SHADOW} WHERE sku IN :skus').bindparams(bindparam('skus', expanding=True))
+COPY_SKUS = text(
+    f'INSERT INTO {SHADOW} (orderid, sku, qty, batchref) {_SOURCE} WHERE b.sku IN :skus'
+    ' ON CONFLICT (orderid, sku, qty) DO NOTHING'
+).bindparams(bindparam('skus', expanding=True))
+
+
+def shadow_table():
+    """
+    Теневая таблица со схемой allocations_view; первичный ключ и индексы названы по-своему - имена
+    ограничений и индексов уникальны в схеме (в SQLite - в базе)
+    """
+    table = orm.allocations_view.to_metadata(MetaData(), name=SHADOW)
+    table.primary_key.name = f'pk_{SHADOW}'
+    for index in table.indexes:
+        index.name = index.name.replace(PROJECTION, SHADOW)
+    return table
+
+
+def versions_table():
+    """
+    Снимок версий продуктов, сделанный перед досчетом теневой таблицы
+    """
+    return Table(
+        VERSIONS, MetaData(),
+        Column('sku', String(255), primary_key=True),
+        Column('version_number', Integer, nullable=False),
+    )
+
+
+class AllocationsViewRebuild:
+    """
+    Перестроение allocations_view из batches/allocations/order_lines:
+    1. диапазон allocations.id делится на workers частей, каждая копируется своим потоком в теневую таблицу
+       порциями по chunk_size id: INSERT ... SELECT выполняется на сервере, строки не проходят через Python,
+       поэтому память не зависит от объема данных
+    2. после каждой порции в той же транзакции сохраняется контрольная точка части - прерванный запуск
+       продолжается с последней скопированной порции
+    3. подготовка без блокировки (prepare): снимок версий продуктов, затем из теневой таблицы удаляются строки
+       отмененных за время копирования размещений и в нее досчитываются все размещения, которых в ней нет
+       (в т.ч. зафиксированные после копирования своей порции); заказы, строки которых отличаются
+       от allocations_view, запоминаются для инвалидации кеша
+    4. замена одной транзакцией (swap): allocations_view блокируется от записи, строки артикулов, версия которых
+       изменилась после снимка, копируются заново (дельта по индексу sku, а не полный проход), затем таблицы
+       меняются местами - запись в модель чтения ждет только дельту и переименование
+    5. после замены для заказов, строки которых изменились, вызывается invalidate (инвалидация кеша модели чтения,
+       например ViewCache.invalidate или RedisCache.delete)
+    """
+
+    def __init__(
+        self, engine: Engine, chunk_size: int = 50_000, workers: int = 4,
+        invalidate: Optional[Callable[[str], None]] = None
+    ) -> None:
+        self.engine = engine
+        self.invalidate = invalidate
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.checkpoints = orm.projection_checkpoints
+        self.shadow = shadow_table()
+        self.versions = versions_table()
+        self.changed = set()    # заказы, найденные prepare: их строки в новой таблице отличаются
+
+    def run(self) -> int:
+        """
+        Перестроение целиком, возвращает число строк новой allocations_view
+        """
+        start = time.perf_counter()
+        parts = self.plan()
+        with ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='rebuild') as executor:
+            list(executor.map(self.copy_part, [part['part'] for part in parts if part['last_key'] < part['end_key']]))
+        self.prepare()
+        rows = self.swap()
+        logger.info('allocations_view перестроена: %s строк за %.1f с', rows, time.perf_counter() - start)
+        return rows
+
+    def plan(self) -> List[Dict]:
+        """
+        Части диапазона allocations.id: сохраненные прерванным запуском либо новые
+        """
+        with self.engine.begin() as connection:
+            parts = self._load_parts(connection)
+            if parts:
+                logger.info('Продолжение перестроения с контрольных точек: %s', parts)
+                return parts
+            self.shadow.drop(connection, checkfirst=True)     # остаток запуска, прерванного до контрольных точек
+            self.shadow.create(connection)
+            low, high = connection.execute(select(func.min(orm.allocations.c.id), func.max(orm.allocations.c.id))).one()
+            low, high = (low or 1) - 1, high or 0
+            step = -(-(high - low) // self.workers) or 1
+            rows = [
+                {'projection': PROJECTION, 'part': i, 'start_key': lo, 'end_key': min(lo + step, high), 'last_key': lo}
+                for i, lo in enumerate(range(low, max(high, low + 1), step))
+            ]
+            connection.execute(insert(self.checkpoints), rows)
+            return self._load_parts(connection)
+
+    def _load_parts(self, connection: Connection) -> List[Dict]:
+        return [dict(row._mapping) for row in connection.execute(
+            select(self.checkpoints).where(self.checkpoints.c.projection == PROJECTION).order_by(self.checkpoints.c.part)
+        )]
+
+    def copy_part(self, part: int) -> None:
+        while self.copy_chunk(part):
+            pass
+
+    def copy_chunk(self, part: int) -> bool:
+        """
+        Копирование следующей порции части вместе с продвижением контрольной точки;
+        False - часть скопирована полностью
+        """
+        checkpoint = self.checkpoints.c
+        with self.engine.begin() as connection:
+            last_key, end_key = connection.execute(
+                select(checkpoint.last_key, checkpoint.end_key)
+                .where(checkpoint.projection == PROJECTION, checkpoint.part == part)
+            ).one()
+            if last_key >= end_key:
+                return False
+            upper = min(last_key + self.chunk_size, end_key)
+            copied = connection.execute(COPY_CHUNK, {'lo': last_key, 'hi': upper}).rowcount
+            connection.execute(
+                update(self.checkpoints)
+                .where(checkpoint.projection == PROJECTION, checkpoint.part == part)
+                .values(last_key=upper, rows=checkpoint.rows + copied, updated_at=func.now())
+            )
+        return upper < end_key
+
+    def prepare(self) -> None:
+        """
+        Полный досчет и сравнение с allocations_view без блокировки модели чтения: запись в нее не ждет
+        Снимок версий делается до досчета, поэтому все, что зафиксировано после снимка, swap скопирует заново
+        """
+        with self.engine.begin() as connection:
+            self.versions.drop(connection, checkfirst=True)
+            self.versions.create(connection)
+            connection.execute(
+                insert(self.versions).from_select(['sku', 'version_number'], select(orm.products.c.sku, orm.products.c.version_number))
+            )
+        with self.engine.begin() as connection:
+            connection.execute(DELETE_STALE)
+            connection.execute(CATCH_UP)
+        with self.engine.connect() as connection:
+            self.changed = {orderid for query in CHANGED_ORDERS for orderid in connection.execute(query).scalars()}
+
+    def swap(self) -> int:
+        with self.engine.begin() as connection:
+            postgres = connection.dialect.name == 'postgresql'
+            if postgres:    # проекция текущих запросов ждет замены и выполняется уже по новой таблице
+                connection.execute(text(f'LOCK TABLE {PROJECTION} IN EXCLUSIVE MODE'))
+            skus = list(connection.execute(CHANGED_SKUS).scalars())
+            changed = set(self.changed)
+            if skus:
+                changed.update(orderid for query in ORDERS_OF_SKUS for orderid in connection.execute(query, {'skus': skus}).scalars())
+                connection.execute(DELETE_SKUS, {'skus': skus})
+                connection.execute(COPY_SKUS, {'skus': skus})
+                changed.update(connection.execute(ORDERS_OF_SKUS[1], {'skus': skus}).scalars())
+            connection.execute(text(f'ALTER TABLE {PROJECTION} RENAME TO {RETIRED}'))
+            connection.execute(text(f'DROP TABLE {RETIRED}'))
+            connection.execute(text(f'ALTER TABLE {SHADOW} RENAME TO {PROJECTION}'))
+            self._rename_schema_objects(connection)
+            self.versions.drop(connection)
+            connection.execute(delete(self.checkpoints).where(self.checkpoints.c.projection == PROJECTION))
+            rows = connection.execute(text(f'SELECT count(*) FROM {PROJECTION}')).scalar()
+        if self.invalidate is not None:     # после фиксации: иначе читатель успел бы закешировать старые строки
+            for orderid in changed:
+                self.invalidate(orderid)
+        self.changed = set()
+        logger.info('Под блокировкой скопировано заново %s артикулов, изменились размещения %s заказов', len(skus), len(changed))
+        return rows
+
+    def _rename_schema_objects(self, connection: Connection) -> None:
+        """
+        Первичный ключ и индексы новой allocations_view получают имена из orm.allocations_view,
+        чтобы следующее перестроение могло создать теневую таблицу с прежними именами
+        SQLite не умеет переименовывать индексы: индекс создается заново (в SQLite запись и так последовательна)
+        """
+        if connection.dialect.name == 'postgresql':
+            connection.execute(text(f'ALTER TABLE {PROJECTION} RENAME CONSTRAINT pk_{SHADOW} TO pk_{PROJECTION}'))
+            for index in orm.allocations_view.indexes:
+                connection.execute(text(f'ALTER INDEX {index.name.replace(PROJECTION, SHADOW)} RENAME TO {index.name}'))
+            return
+        for index in orm.allocations_view.indexes:
+            connection.execute(text(f'DROP INDEX {index.name.replace(PROJECTION, SHADOW)}'))
+            index.create(connection)
+
+    def progress(self) -> Optional[Dict]:
+        """
+        Состояние прерванного или идущего перестроения: скопировано строк и доля пройденного диапазона id
+        """
+        with self.engine.connect() as connection:
+            parts = self._load_parts(connection)
+        if not parts:
+            return None
+        total = sum(p['end_key'] - p['start_key'] for p in parts) or 1
+        done = sum(p['last_key'] - p['start_key'] for p in parts)
+        return {'rows': sum(p['rows'] for p in parts), 'done': done / total, 'parts': len(parts)}
@@ -0,0 +1,103 @@
+import threading
+from typing import Any, Dict, List, Optional
+from sqlalchemy import create_engine
+from sqlalchemy.engine import Engine, Row
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.sql.elements import TextClause
+
+from src.allocation import config
+from src.allocation.adapters import db_pool
+
+_read_engine = None     # движки модели чтения создаются при первом запросе, а не при импорте
+_async_read_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_read_engine() -> Engine:
+    """
+    Движок только для чтения: сервер db_read_host (реплика) или основной, режим AUTOCOMMIT -
+    запрос выполняется без BEGIN/ROLLBACK вокруг него
+    """
+    global _read_engine
+    with _engine_lock:
+        if _read_engine is None:
+            _read_engine = create_engine(
+                config.get_postgres_uri(read_only=True),
+                isolation_level='AUTOCOMMIT',
+                poolclass=db_pool.InstrumentedQueuePool,
+                **config.get_postgres_pool_options()
+            )
+        return _read_engine
+
+
+def get_async_read_engine() -> AsyncEngine:
+    global _async_read_engine
+    with _engine_lock:
+        if _async_read_engine is None:
+            _async_read_engine = create_async_engine(
+                config.get_postgres_uri(driver='asyncpg', read_only=True),
+                isolation_level='AUTOCOMMIT',
+                poolclass=db_pool.InstrumentedAsyncAdaptedQueuePool,
+                **config.get_postgres_pool_options()
+            )
+        return _async_read_engine
+
+
+def pool_status() -> Dict:
+    """
+    Пулы движков модели чтения: асинхронный обслуживает GET /allocate/{orderid}, синхронный - синхронные представления
+    """
+    return db_pool.pools_status(**{'async': _async_read_engine, 'sync': _read_engine})
+
+
+class ReadOnlyDatabase:
+    """
+    Путь чтения для представлений: соединение из пула движка без сеанса ORM, репозитория и UoW
+    Запросы - заранее созданные text() модуля views: SQLAlchemy компилирует их один раз (кеш компиляции),
+    asyncpg дополнительно подготавливает их на сервере и переиспользует подготовленные операторы соединения
+    engine - движок в режиме AUTOCOMMIT (get_read_engine); None - движок по умолчанию, создается при первом запросе
+    """
+
+    def __init__(self, engine: Optional[Engine] = None) -> None:
+        self._engine = engine
+
+    @property
+    def engine(self) -> Engine:
+        if self._engine is None:
+            self._engine = get_read_engine()
+        return self._engine
+
+    def fetch_all(self, statement: TextClause, **params: Any) -> List[Row]:
+        with self.engine.connect() as connection:
+            return connection.execute(statement, params).all()
+
+
+class AsyncReadOnlyDatabase:
+    """
+    Асинхронная версия ReadOnlyDatabase для конечных точек FastAPI
+    """
+
+    def __init__(self, engine: Optional[AsyncEngine] = None) -> None:
+        self._engine = engine
+
+    @property
+    def engine(self) -> AsyncEngine:
+        if self._engine is None:
+            self._engine = get_async_read_engine()
+        return self._engine
+
+    async def fetch_all(self, statement: TextClause, **params: Any) -> List[Row]:
+        async with self.engine.connect() as connection:
+            return (await connection.execute(statement, params)).all()
+
+
+_reader = ReadOnlyDatabase()
+_async_reader = AsyncReadOnlyDatabase()
+
+
+def default_reader() -> ReadOnlyDatabase:
+    return _reader
+
+
+def default_async_reader() -> AsyncReadOnlyDatabase:
+    return _async_reader
@@ -1,21 +1,68 @@
 import redis
 import logging
 import json
-from dataclasses import asdict
+import threading
+from dataclasses import fields
+from functools import lru_cache
+from typing import Optional, Tuple
 from src.allocation import config
 from src.allocation.domain import events
 
-r = redis.Redis(**config.get_redis_host_and_port())
+logger = logging.getLogger(__name__)
 
 CHANNEL_MAPPING = {
     events.Allocated: "line_allocated"
 }
 
-# публикация событий в канал
-def publish(event: events.Event):
-    channel = CHANNEL_MAPPING.get(type(event))
-    if channel:
-        logging.debug('publishing: channel=%s, event=%s', channel, event)
-        r.publish(channel, json.dumps(asdict(event)))
-    else:
-        logging.warning('No channel defined for event %s', type(event))
\ No newline at end of file
+_pool: Optional[redis.ConnectionPool] = None   # пул соединений создается при первом использовании, а не при импорте
+_pool_lock = threading.Lock()
+
+
+def get_connection_pool() -> redis.ConnectionPool:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = redis.ConnectionPool(**config.get_redis_host_and_port(), **config.get_redis_pool_options())
+        return _pool
+
+
+def get_redis_client() -> redis.Redis:
+    return redis.Redis(connection_pool=get_connection_pool())
+
+
+@lru_cache(maxsize=None)
+def _field_names(event_type: type) -> Tuple[str, ...]:
+    return tuple(f.name for f in fields(event_type))
+
+
+def serialize(event: events.Event) -> str:
+    """
+    JSON события: события - плоские dataclass, поэтому вместо рекурсивного asdict (копирует каждое значение)
+    берутся атрибуты по закешированному для типа списку полей
+    """
+    return json.dumps({name: getattr(event, name) for name in _field_names(type(event))})
+
+
+class RedisEventPublisher:
+    """
+    Публикация событий в каналы Redis через пул соединений прямо в обработке запроса (bootstrap(publish=...))
+    В работе события публикует ретранслятор outbox_relay: он читает их из outbox пачками
+    и отправляет пачку одним конвейером (см. adapters.outbox)
+    """
+
+    def __init__(self, client: Optional[redis.Redis] = None) -> None:
+        self._client = client
+
+    @property
+    def client(self) -> redis.Redis:
+        if self._client is None:
+            self._client = get_redis_client()
+        return self._client
+
+    def __call__(self, event: events.Event) -> None:
+        channel = CHANNEL_MAPPING.get(type(event))
+        if not channel:
+            logger.warning('No channel defined for event %s', type(event))
+            return
+        logger.debug('publishing: channel=%s, event=%s', channel, event)
+        self.client.publish(channel, serialize(event))
@@ -1,5 +1,7 @@
 from abc import ABC, abstractmethod
+from typing import Iterable, Optional
 from sqlalchemy import select
+from sqlalchemy.orm import selectinload, joinedload
 from src.allocation.domain import models
 from src.allocation.adapters import orm
 
@@ -43,21 +45,204 @@ class AbstractProductRepositoriy(ABC):
         raise NotImplementedError
     
 
+LOADING_STRATEGIES = ('lazy', 'selectin', 'joined')   # стратегии загрузки партий и размещенных позиций агрегата
+
+
+def product_loader_options(loading_strategy: str) -> list:
+    """
+    Опции запроса для загрузки агрегата Product вместе с партиями и их позициями:
+    lazy - партии и позиции подгружаются при обращении (1 + 1 + число партий запросов)
+    selectin - отдельный запрос SELECT ... WHERE IN на каждый уровень (всего 3 запроса)
+    joined - один запрос с LEFT OUTER JOIN всех уровней
+    """
+    if loading_strategy == 'lazy':
+        return []
+    if loading_strategy == 'selectin':
+        return [selectinload(models.Product.batches).selectinload(models.Batch._allocations)]
+    if loading_strategy == 'joined':
+        return [joinedload(models.Product.batches).joinedload(models.Batch._allocations)]
+    raise ValueError(f'Неизвестная стратегия загрузки {loading_strategy}, допустимые: {LOADING_STRATEGIES}')
+
+
+LOCK_MODES = ('optimistic', 'pessimistic')     # режимы блокировки строки продукта при загрузке агрегата
+
+
+class ProductLockPolicy:
+    """
+    Выбор блокировки строки products при загрузке агрегата:
+    optimistic - без блокировки, параллельное изменение обнаруживает проверка версии при фиксации
+    pessimistic - SELECT ... FOR UPDATE OF products для всех артикулов
+    pessimistic_skus - горячие артикулы, которые блокируются и в режиме optimistic
+    isolation_level - уровень изоляции транзакции с блокировкой: в REPEATABLE READ дождавшаяся блокировки транзакция
+    все равно завершится ошибкой сериализации, если строку изменили после начала транзакции; None - не менять
+    """
+
+    def __init__(
+            self,
+            mode: str = 'optimistic',
+            pessimistic_skus: Iterable[str] = (),
+            isolation_level: Optional[str] = 'READ COMMITTED'
+    ) -> None:
+        if mode not in LOCK_MODES:
+            raise ValueError(f'Неизвестный режим блокировки {mode}, допустимые: {LOCK_MODES}')
+        self.mode = mode
+        self.pessimistic_skus = frozenset(pessimistic_skus)
+        self.isolation_level = isolation_level
+
+    @property
+    def may_lock(self) -> bool:
+        return self.mode == 'pessimistic' or bool(self.pessimistic_skus)
+
+    def locks(self, sku: str) -> bool:
+        return self.mode == 'pessimistic' or sku in self.pessimistic_skus
+
+    @property
+    def execution_options(self) -> dict:
+        return {'isolation_level': self.isolation_level} if self.isolation_level else {}
+
+
 class SqlAlchemyRepository(AbstractProductRepositoriy):
     """
     Основной класс-репозиторий для работы с приложением
+    loading_strategy - стратегия загрузки партий и размещенных позиций продукта (см. product_loader_options)
+    lock_policy - блокировка строки продукта при загрузке (см. ProductLockPolicy), по умолчанию без блокировки
     """
 
-    def __init__(self, session):
+    def __init__(self, session, loading_strategy: str = 'selectin', lock_policy: ProductLockPolicy = None):
         super().__init__()      # для инициализации множества seen
         self.session = session
+        self.loader_options = product_loader_options(loading_strategy)
+        self.lock_policy = lock_policy or ProductLockPolicy()
+
+    def _query(self, lock: bool = False):
+        query = self.session.query(models.Product).options(*self.loader_options)
+        if lock:
+            query = query.with_for_update(of=models.Product)    # OF: при joined загрузке блокируется только строка продукта
+        return query
+
+    def _begin_for_lock(self):
+        """
+        Уровень изоляции транзакции можно задать, только пока сеанс не начал ее
+        """
+        if self.lock_policy.execution_options and not self.session.in_transaction():
+            self.session.connection(execution_options=self.lock_policy.execution_options)
 
     def _add(self, product):
         self.session.add(product)
 
     def _get(self, sku):
-        return self.session.query(models.Product).filter_by(sku=sku).first()
+        lock = self.lock_policy.locks(sku)
+        if lock:
+            self._begin_for_lock()
+        return self._query(lock).filter_by(sku=sku).first()
     
     def _get_by_batchref(self, batchref):   # поиск продукта по ссылке партии
-        return self.session.query(models.Product).join(models.Batch).filter(orm.batches.c.reference == batchref).first()
+        if self.lock_policy.may_lock:   # артикул до загрузки неизвестен: определяем его по партии, затем загружаем продукт
+            self._begin_for_lock()
+            sku = self.session.query(models.Batch.sku).filter(orm.batches.c.reference == batchref).scalar()
+            return self._get(sku) if sku is not None else None
+        return self._query().join(models.Batch).filter(orm.batches.c.reference == batchref).first()
+
+    def version(self, sku) -> Optional[int]:
+        """
+        Версия продукта в БД без загрузки агрегата (с блокировкой строки, если ее требует lock_policy);
+        None - продукта нет
+        """
+        lock = self.lock_policy.locks(sku)
+        if lock:
+            self._begin_for_lock()
+        statement = select(orm.products.c.version_number).where(orm.products.c.sku == sku)
+        if lock:
+            statement = statement.with_for_update()
+        return self.session.execute(statement).scalar()
+
+    def attach(self, product: models.Product) -> None:
+        """
+        Присоединение к сеансу агрегата, загруженного другим (уже закрытым) сеансом, без запросов к БД
+        """
+        self.session.add(product)
+
+
+class AbstractAsyncProductRepository(ABC):
+    """
+    Базовый абстрактный класс асинхронного репозитория
+    Операции чтения - корутины, add() синхронный, так как только регистрирует продукт в сеансе
+    """
+
+    def __init__(self) -> None:
+        self.seen = set()   # атрибут, отслеживающий агрегаты, type: set[models.Product]
+
+    def add(self, product: models.Product):
+        self._add(product)
+        self.seen.add(product)
+
+    async def get(self, sku) -> models.Product:
+        product = await self._get(sku)
+        if product:
+            self.seen.add(product)
+        return product
+
+    async def get_by_batchref(self, batchref) -> models.Product:
+        product = await self._get_by_batchref(batchref)
+        if product:
+            self.seen.add(product)
+        return product
+
+    @abstractmethod
+    def _add(self, product: models.Product):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _get(self, sku: str) -> models.Product:
+        raise NotImplementedError
+
+    @abstractmethod
+    async def _get_by_batchref(self, batchref: str) -> models.Product:
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyRepository(AbstractAsyncProductRepository):
+    """
+    Репозиторий на AsyncSession (sqlalchemy.ext.asyncio)
+    Неявная ленивая загрузка в асинхронном сеансе невозможна, поэтому агрегат всегда загружается целиком
+    """
+
+    def __init__(self, session, loading_strategy: str = 'selectin', lock_policy: ProductLockPolicy = None):
+        super().__init__()
+        if loading_strategy == 'lazy':
+            raise ValueError('Асинхронный репозиторий не поддерживает ленивую загрузку агрегата')
+        self.session = session
+        self.loader_options = product_loader_options(loading_strategy)
+        self.lock_policy = lock_policy or ProductLockPolicy()
+
+    def _select(self, lock: bool = False):
+        statement = select(models.Product).options(*self.loader_options)
+        if lock:
+            statement = statement.with_for_update(of=models.Product)
+        return statement
+
+    async def _begin_for_lock(self):
+        if self.lock_policy.execution_options and not self.session.in_transaction():
+            await self.session.connection(execution_options=self.lock_policy.execution_options)
+
+    def _add(self, product):
+        self.session.add(product)
+
+    async def _get(self, sku):
+        lock = self.lock_policy.locks(sku)
+        if lock:
+            await self._begin_for_lock()
+        result = await self.session.execute(self._select(lock).filter_by(sku=sku))
+        return result.unique().scalars().first()
 
+    async def _get_by_batchref(self, batchref):
+        if self.lock_policy.may_lock:
+            await self._begin_for_lock()
+            sku = (await self.session.execute(
+                select(models.Batch.sku).filter(orm.batches.c.reference == batchref)
+            )).scalar()
+            return await self._get(sku) if sku is not None else None
+        result = await self.session.execute(
+            self._select().join(models.Batch).filter(orm.batches.c.reference == batchref)
+        )
+        return result.unique().scalars().first()
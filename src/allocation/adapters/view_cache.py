@@ -0,0 +1,278 @@
+import json
+import time
+import asyncio
+import logging
+import threading
+import redis
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, NamedTuple, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+Allocations = List[Dict[str, str]]     # ответ модели чтения: [{'sku': ..., 'batchref': ...}]
+
+
+class CacheStats:
+    """
+    Счетчики кеша: попадания по уровням, промахи, вытеснения по размеру и по времени жизни, инвалидации,
+    отброшенные заполнения после инвалидации
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.local_hits = 0
+        self.remote_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+        self.stale_fills = 0    # значения, не записанные в кеш: заказ инвалидирован, пока читатель шел в БД
+
+    def increment(self, name: str, value: int = 1) -> None:
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            hits = self.local_hits + self.remote_hits
+            total = hits + self.misses
+            return {
+                'hits': hits,
+                'local_hits': self.local_hits,
+                'remote_hits': self.remote_hits,
+                'misses': self.misses,
+                'hit_ratio': hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+                'invalidations': self.invalidations,
+                'stale_fills': self.stale_fills,
+            }
+
+
+class LruTtlCache:
+    """
+    Кеш процесса: не больше max_size записей, давно не читанные вытесняются первыми,
+    запись старше ttl секунд считается отсутствующей
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 5.0, stats: Optional[CacheStats] = None,
+                 clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stats = stats or CacheStats()
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._items: OrderedDict = OrderedDict()     # ключ -> (срок годности, значение)
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return None
+            expires, value = item
+            if expires <= self.clock():
+                del self._items[key]
+                self.stats.increment('expirations')
+                return None
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key: str, value) -> None:
+        with self._lock:
+            self._items[key] = (self.clock() + self.ttl, value)
+            self._items.move_to_end(key)
+            evicted = 0
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+                evicted += 1
+        if evicted:
+            self.stats.increment('evictions', evicted)
+
+    def delete(self, key: str) -> None:
+        with self._lock:
+            self._items.pop(key, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+
+class RedisCache:
+    """
+    Кеш в Redis, общий для процессов: значение - JSON под ключом <prefix><ключ> со сроком жизни ttl
+    Рядом хранится поколение ключа <prefix>generation:<ключ>, delete его увеличивает; значение записывается
+    с поколением, прочитанным до запроса к БД, и при чтении не совпадающее поколение - промах:
+    значение, прочитанное до инвалидации, но записанное после нее, никому не выдается
+    Недоступность Redis - промах, а не ошибка запроса
+    """
+
+    def __init__(self, client: redis.Redis, ttl: float = 300.0, prefix: str = 'allocations_view:') -> None:
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def _generation_key(self, key: str) -> str:
+        return f'{self.prefix}generation:{key}'
+
+    def lookup(self, key: str) -> Tuple[Optional[Any], Optional[int]]:
+        """
+        Значение и текущее поколение ключа одним MGET; поколение None - Redis недоступен
+        """
+        try:
+            value, generation = self.client.mget(self.prefix + key, self._generation_key(key))
+        except redis.RedisError:
+            logger.exception('Не удалось прочитать %s из кеша Redis', key)
+            return None, None
+        generation = int(generation or 0)
+        if value is None:
+            return None, generation
+        entry = json.loads(value)
+        return (entry['value'] if entry['generation'] == generation else None), generation
+
+    def get(self, key: str):
+        return self.lookup(key)[0]
+
+    def set(self, key: str, value, generation: Optional[int] = None) -> None:
+        """
+        generation - поколение ключа на момент начала чтения из БД, None - текущее
+        """
+        try:
+            if generation is None:
+                generation = int(self.client.get(self._generation_key(key)) or 0)
+            self.client.set(
+                self.prefix + key, json.dumps({'generation': generation, 'value': value}), px=int(self.ttl * 1000)
+            )
+        except redis.RedisError:
+            logger.exception('Не удалось записать %s в кеш Redis', key)
+
+    def delete(self, key: str) -> None:
+        """
+        Поколение живет вдвое дольше значения: значение, записанное с прежним поколением, истекает раньше,
+        чем поколение могло бы пропасть и начаться заново с нуля
+        """
+        try:
+            pipe = self.client.pipeline(transaction=True)
+            pipe.incr(self._generation_key(key))
+            pipe.pexpire(self._generation_key(key), int(self.ttl * 2000))
+            pipe.delete(self.prefix + key)
+            pipe.execute()
+        except redis.RedisError:
+            logger.exception('Не удалось удалить %s из кеша Redis', key)
+
+
+class FillToken(NamedTuple):
+    """
+    Состояние кеша на момент промаха, с которым читатель потом записывает прочитанное из БД значение
+    """
+    epoch: int                  # счетчик инвалидаций кеша процесса
+    started: float              # время промаха (time.monotonic)
+    generation: Optional[int]   # поколение ключа в Redis, None - второго уровня нет или Redis недоступен
+
+
+class ViewCache:
+    """
+    Кеш модели чтения allocations_view по номеру заказа: кеш процесса и, если задан remote, кеш Redis
+    Обработчики модели чтения инвалидируют заказ после фиксации своей транзакции; в других процессах
+    (другие воркеры API, потребитель потоков) запись кеша процесса живет до истечения ttl,
+    кеш Redis инвалидируется для всех сразу
+    Заполнение после промаха защищено от гонки с инвалидацией: lookup возвращает FillToken, и set по нему
+    не записывает значение, если заказ был инвалидирован после промаха (читатель мог получить строки
+    до фиксации проекции) или если с промаха прошло больше fill_window секунд
+    """
+
+    def __init__(self, local: LruTtlCache, remote: Optional[RedisCache] = None, fill_window: float = 30.0) -> None:
+        self.local = local
+        self.remote = remote
+        self.stats = local.stats
+        self.fill_window = min(fill_window, remote.ttl) if remote is not None else fill_window
+        self._lock = threading.Lock()
+        self._epoch = 0
+        self._invalidated: OrderedDict = OrderedDict()     # заказ -> (epoch инвалидации, time.monotonic)
+
+    def begin(self, orderid: str) -> FillToken:
+        generation = None
+        if self.remote is not None:
+            _, generation = self.remote.lookup(orderid)
+        return FillToken(self._epoch, time.monotonic(), generation)
+
+    def lookup(self, orderid: str) -> Tuple[Optional[Allocations], FillToken]:
+        """
+        Значение из кеша и маркер для записи значения, прочитанного из БД после промаха
+        Маркер снимается до чтения уровней кеша, поэтому любая последующая инвалидация его отменит
+        """
+        token = FillToken(self._epoch, time.monotonic(), None)
+        value = self.local.get(orderid)
+        if value is not None:
+            self.stats.increment('local_hits')
+            return value, token
+        if self.remote is not None:
+            value, generation = self.remote.lookup(orderid)
+            token = token._replace(generation=generation)
+            if value is not None:
+                self.stats.increment('remote_hits')
+                self._fill_local(orderid, value, token)
+                return value, token
+        self.stats.increment('misses')
+        return None, token
+
+    def get(self, orderid: str) -> Optional[Allocations]:
+        return self.lookup(orderid)[0]
+
+    def set(self, orderid: str, value: Allocations, token: Optional[FillToken] = None) -> None:
+        """
+        token - маркер lookup, полученный до чтения из БД; None - запись без проверки (значение заведомо актуально)
+        """
+        if token is None:
+            token = self.begin(orderid)
+        if not self._fill_local(orderid, value, token):
+            return
+        if self.remote is not None and token.generation is not None:
+            self.remote.set(orderid, value, token.generation)
+
+    def _fill_local(self, orderid: str, value: Allocations, token: FillToken) -> bool:
+        with self._lock:    # проверка и запись - под той же блокировкой, что и инвалидация
+            if time.monotonic() - token.started > self.fill_window:
+                return False
+            invalidated = self._invalidated.get(orderid)
+            if invalidated is not None and invalidated[0] > token.epoch:
+                self.stats.increment('stale_fills')
+                return False
+            self.local.set(orderid, value)
+            return True
+
+    def invalidate(self, orderid: str) -> None:
+        self.stats.increment('invalidations')
+        now = time.monotonic()
+        with self._lock:
+            self._epoch += 1
+            self._invalidated[orderid] = (self._epoch, now)
+            self._invalidated.move_to_end(orderid)
+            # маркеры старше fill_window недействительны сами, помнить более ранние инвалидации незачем
+            while self._invalidated and next(iter(self._invalidated.values()))[1] < now - self.fill_window:
+                self._invalidated.popitem(last=False)
+            self.local.delete(orderid)
+        if self.remote is not None:
+            self.remote.delete(orderid)
+
+    # Асинхронные версии: кеш процесса читается на месте, обращения к Redis - в пуле потоков
+
+    async def async_lookup(self, orderid: str) -> Tuple[Optional[Allocations], FillToken]:
+        if self.remote is None:
+            return self.lookup(orderid)
+        return await asyncio.to_thread(self.lookup, orderid)
+
+    async def async_get(self, orderid: str) -> Optional[Allocations]:
+        return (await self.async_lookup(orderid))[0]
+
+    async def async_set(self, orderid: str, value: Allocations, token: Optional[FillToken] = None) -> None:
+        if self.remote is None:
+            return self.set(orderid, value, token)
+        await asyncio.to_thread(self.set, orderid, value, token)
+
+    async def async_invalidate(self, orderid: str) -> None:
+        if self.remote is None:
+            return self.invalidate(orderid)
+        await asyncio.to_thread(self.invalidate, orderid)
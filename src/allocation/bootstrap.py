@@ -1,43 +1,112 @@
-from typing import Callable
+from typing import Callable, Optional
+from src.allocation import config
 from src.allocation.service_layer import unit_of_work, messagebus, handlers
-from src.allocation.adapters import redis_eventpublisher, orm, notifications
+from src.allocation.service_layer.dispatcher import BackgroundEventDispatcher
+from src.allocation.service_layer.projector import ReadModelProjector
+from src.allocation.adapters import orm, notifications, redis_eventpublisher
+from src.allocation.adapters.view_cache import LruTtlCache, RedisCache, ViewCache
 from src.allocation.domain import commands, events
 
 def bootstrap(
         start_orm: bool = True,
-        uow: unit_of_work.AbstractUnitOfWork = unit_of_work.SqlAlchemyUnitOfWork(),
+        uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
         notifications: notifications.AbstractNotifications = notifications.EmailNotifications(),
-        publish: Callable = redis_eventpublisher.publish
+        publish: Optional[Callable] = None,
+        async_uow_factory: Callable[[], unit_of_work.AbstractAsyncUnitOfWork] = unit_of_work.AsyncSqlAlchemyUnitOfWork,
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork] = unit_of_work.SqlAlchemyUnitOfWork,
+        event_dispatcher: Optional[BackgroundEventDispatcher] = None,
+        view_cache: Optional[ViewCache] = None
 ) -> messagebus.MessageBus:
+    """
+    uow_factory - фабрика UoW: каждый вызов bus.handle работает со своим сеансом и репозиторием
+    uow - единственный UoW для всех вызовов вместо фабрики (тесты с фейковым UoW)
+    event_dispatcher - пул фоновой обработки событий, по умолчанию создается, если включен bus_background_events
+    publish - публикация событий во внешние каналы прямо в обработке запроса (тесты без БД);
+    по умолчанию None: события попадают в outbox при фиксации UoW и публикуются ретранслятором outbox_relay
+    view_cache - кеш модели чтения, по умолчанию создается по настройкам view_cache_*
+    Модель чтения обновляет ReadModelProjector: события одного вызова handle применяются одной транзакцией
+    """
     
     if start_orm:
         orm.start_mappers()     # инициализация при запуске приложения
-        
-    injected_event_handlers = {     # создание внедренных версий попарных сопоставлений обработчиков и собыйти/команд
-        events.Allocated: [
-            handlers.PublishAllocatedEventHandler(publish),
-            handlers.AddAllocationToReadModelHandler(uow)
-        ],
-        events.Deallocated: [
-            handlers.RemoveAllocationFromReadModelHandler(uow),
-            # handlers.Reallocatehandler(uow)
-        ],
-        events.OutOfStock: [
-            handlers.SendOutOfStockNotificationHandler(notifications)
-        ]
-    }
-
-    injected_command_handlers = {
-        commands.Allocate: handlers.AllocateHandler(uow),
-        commands.Deallocate: handlers.DeallocateHandler(uow),
-        commands.CreateBatch: handlers.AddBatchHandler(uow),
-        commands.ChangeBatchQuantity: handlers.ChangeBatchQuantityHandler(uow)
-    }
+
+    if uow is not None:
+        uow_factory = lambda: uow
+
+    if event_dispatcher is None and config.bus_settings.bus_background_events:
+        event_dispatcher = BackgroundEventDispatcher(**config.get_event_dispatcher_options())
+
+    if view_cache is None and config.view_cache_settings.view_cache_enabled:
+        view_cache = default_view_cache()
+
+    publish_handlers = [handlers.PublishAllocatedEventHandler(publish)] if publish is not None else []
+    projector = ReadModelProjector(uow_factory, async_uow_factory, view_cache)
+
+    def inject_handlers(uow: unit_of_work.AbstractUnitOfWork):
+        """
+        Создание внедренных версий попарных сопоставлений обработчиков и событий/команд для UoW отдельного вызова handle
+        """
+        injected_event_handlers = {
+            events.Allocated: publish_handlers + [projector],
+            events.Deallocated: [
+                projector,
+                # handlers.Reallocatehandler(uow)
+            ],
+            events.OutOfStock: [
+                handlers.SendOutOfStockNotificationHandler(notifications)
+            ]
+        }
+
+        injected_command_handlers = {
+            commands.Allocate: handlers.AllocateHandler(uow),
+            commands.AllocateMany: handlers.AllocateManyHandler(uow),
+            commands.Deallocate: handlers.DeallocateHandler(uow),
+            commands.CreateBatch: handlers.AddBatchHandler(uow),
+            commands.ChangeBatchQuantity: handlers.ChangeBatchQuantityHandler(uow)
+        }
+        return injected_event_handlers, injected_command_handlers
+
+    def inject_async_handlers(async_uow: unit_of_work.AbstractAsyncUnitOfWork):
+        """
+        Внедрение асинхронного UoW отдельного вызова handle_async в обработчики
+        Обработчики без ввода-вывода в БД остаются синхронными и выполняются шиной в пуле потоков
+        """
+        async_event_handlers = {
+            events.Allocated: publish_handlers + [projector.project_async],
+            events.Deallocated: [projector.project_async],
+            events.OutOfStock: [
+                handlers.SendOutOfStockNotificationHandler(notifications)
+            ]
+        }
+        async_command_handlers = {
+            commands.Allocate: handlers.AsyncAllocateHandler(async_uow),
+            commands.AllocateMany: handlers.AsyncAllocateManyHandler(async_uow),
+            commands.Deallocate: handlers.AsyncDeallocateHandler(async_uow),
+            commands.CreateBatch: handlers.AsyncAddBatchHandler(async_uow),
+            commands.ChangeBatchQuantity: handlers.AsyncChangeBatchQuantityHandler(async_uow)
+        }
+        return async_event_handlers, async_command_handlers
 
     return messagebus.MessageBus(
+        uow_factory=uow_factory,
+        handlers=inject_handlers,
+        async_uow_factory=async_uow_factory,
+        async_handlers=inject_async_handlers,
         uow=uow,
-        event_handlers=injected_event_handlers,
-        command_handlers=injected_command_handlers
+        max_conflict_attempts=config.db_settings.db_conflict_attempts,
+        max_cascade_depth=config.bus_settings.bus_max_cascade_depth,
+        max_cascade_length=config.bus_settings.bus_max_cascade_length,
+        event_dispatcher=event_dispatcher,
+        view_cache=view_cache,
+        message_scope=projector.message_scope,
+        async_message_scope=projector.async_message_scope
     )
 
+
+def default_view_cache() -> ViewCache:
+    remote = None
+    if config.view_cache_settings.view_cache_redis:
+        remote = RedisCache(redis_eventpublisher.get_redis_client(), ttl=config.view_cache_settings.view_cache_redis_ttl)
+    return ViewCache(LruTtlCache(**config.get_view_cache_options()), remote)
+
 bus = bootstrap()
\ No newline at end of file
@@ -1,3 +1,4 @@
+from typing import List
 from pydantic_settings import BaseSettings, SettingsConfigDict
 
 class PostgresSettings(BaseSettings):
@@ -6,6 +7,56 @@ class PostgresSettings(BaseSettings):
     db_password: str
     db_user: str = 'allocation'
     db_name: str = 'allocation'
+    db_loading_strategy: str = 'selectin'    # загрузка агрегата Product: lazy, selectin или joined
+    db_pool_size: int = 5               # число постоянно открытых соединений в пуле
+    db_max_overflow: int = 10           # сколько соединений можно открыть сверх db_pool_size при пиковой нагрузке
+    db_pool_timeout: float = 30.0       # сколько секунд ждать свободного соединения
+    db_pool_recycle: int = 1800         # переоткрывать соединения старше стольких секунд, -1 - никогда
+    db_pool_pre_ping: bool = True       # проверять соединение перед выдачей из пула
+    db_conflict_attempts: int = 3       # сколько раз выполнять команду, если фиксация упала из-за параллельного изменения продукта
+    db_lock_mode: str = 'optimistic'    # блокировка продукта при загрузке: optimistic или pessimistic (SELECT ... FOR UPDATE)
+    db_pessimistic_skus: List[str] = []     # горячие артикулы, которые блокируются и в режиме optimistic (JSON-список)
+    db_lock_isolation_level: str = 'READ COMMITTED'     # уровень изоляции транзакций с блокировкой продукта
+    db_read_host: str = ''              # реплика для запросов модели чтения, пусто - основной сервер db_host
+    db_read_port: int = 0               # порт реплики, 0 - db_port
+
+    model_config = SettingsConfigDict(extra='ignore', env_file=".env")
+
+class MessageBusSettings(BaseSettings):
+    bus_max_cascade_depth: int = 100        # предел глубины каскада сообщений одного вызова handle
+    bus_max_cascade_length: int = 100_000   # предел числа сообщений в каскаде одного вызова handle
+    bus_background_events: bool = False     # обрабатывать события команд в фоновом пуле потоков, а не в запросе
+    bus_event_workers: int = 4              # число потоков фоновой обработки событий
+    bus_event_retry_attempts: int = 5       # попыток на обработчик события в фоновом пуле
+    bus_event_retry_wait_max: float = 10.0  # предел ожидания между попытками, сек
+
+    model_config = SettingsConfigDict(extra='ignore', env_file=".env")
+
+class OutboxSettings(BaseSettings):
+    outbox_batch_size: int = 100        # сколько событий ретранслятор публикует одним конвейером Redis
+    outbox_poll_interval: float = 0.5   # пауза между опросами outbox, если неопубликованных событий нет, сек
+
+    model_config = SettingsConfigDict(extra='ignore', env_file=".env")
+
+class ViewCacheSettings(BaseSettings):
+    view_cache_enabled: bool = True     # кешировать ответы модели чтения allocations_view
+    view_cache_size: int = 10_000       # сколько заказов хранить в кеше процесса (LRU)
+    view_cache_ttl: float = 5.0         # время жизни записи кеша процесса, сек (предел устаревания между процессами)
+    view_cache_redis: bool = False      # второй уровень кеша в Redis, общий для всех процессов
+    view_cache_redis_ttl: float = 300.0     # время жизни записи кеша в Redis, сек
+
+    model_config = SettingsConfigDict(extra='ignore', env_file=".env")
+
+class ProductCacheSettings(BaseSettings):
+    product_cache_enabled: bool = False     # переиспользовать загруженные агрегаты Product между вызовами UoW
+    product_cache_size: int = 1000          # сколько продуктов хранить в кеше процесса (LRU)
+
+    model_config = SettingsConfigDict(extra='ignore', env_file=".env")
+
+class PlannerSettings(BaseSettings):
+    planner_cache_enabled: bool = True      # кешировать снимки остатков продуктов для планов размещения
+    planner_cache_size: int = 10_000        # сколько продуктов хранить в кеше процесса (LRU)
+    planner_cache_ttl: float = 1.0          # время жизни снимка, сек (предел устаревания плана)
 
     model_config = SettingsConfigDict(extra='ignore', env_file=".env")
 
@@ -18,19 +69,83 @@ class ApiSettings(BaseSettings):
 class RedisSettings(BaseSettings):
     redis_host: str
     redis_port: int = 6379
+    redis_max_connections: int = 50     # предел соединений в пуле клиента Redis
+    redis_socket_timeout: float = 5.0   # таймаут операций с Redis, сек
+    redis_consumer_group: str = 'allocation'    # группа потребителей потоков Redis
+    redis_consumer_name: str = ''       # имя потребителя в группе, по умолчанию <хост>-<pid>
+    redis_stream_batch_size: int = 100  # сколько записей потоков собирать в одну пачку
+    redis_stream_batch_window_ms: int = 50  # сколько мс после первой записи дочитывать пачку до batch_size
+    redis_stream_block_ms: int = 1000   # сколько ждать новых записей, мс
+    redis_stream_claim_idle_ms: int = 30_000    # через сколько мс неподтвержденную запись перехватывает другой потребитель
+    redis_stream_max_deliveries: int = 5        # после стольких доставок запись уходит в поток <поток>.dead
+    redis_consumer_workers: int = 0     # 0 - команды обрабатывает сам потребитель, N - N процессов, разбиение по артикулу
+    redis_consumer_result_timeout: float = 60.0     # сколько секунд ждать обработки пачки процессами
 
     model_config = SettingsConfigDict(extra='ignore', env_file=".env")
 
 api_settings = ApiSettings()
 db_settings = PostgresSettings()
 redis_settings = RedisSettings()
+bus_settings = MessageBusSettings()
+outbox_settings = OutboxSettings()
+view_cache_settings = ViewCacheSettings()
+product_cache_settings = ProductCacheSettings()
+planner_settings = PlannerSettings()
 
-def get_postgres_uri():
+def get_postgres_uri(driver: str = None, read_only: bool = False):
     host = db_settings.db_host    
     port = db_settings.db_port
+    if read_only:   # запросы модели чтения могут идти на реплику
+        host = db_settings.db_read_host or host
+        port = db_settings.db_read_port or port
     password = db_settings.db_password
     user, db_name = db_settings.db_user, db_settings.db_name
-    return f'postgresql://{user}:{password}@{host}:{port}/{db_name}'
+    scheme = f'postgresql+{driver}' if driver else 'postgresql'
+    return f'{scheme}://{user}:{password}@{host}:{port}/{db_name}'
+
+
+def get_postgres_pool_options():
+    return dict(
+        pool_size=db_settings.db_pool_size,
+        max_overflow=db_settings.db_max_overflow,
+        pool_timeout=db_settings.db_pool_timeout,
+        pool_recycle=db_settings.db_pool_recycle,
+        pool_pre_ping=db_settings.db_pool_pre_ping,
+    )
+
+
+def get_product_lock_options():
+    return dict(
+        mode=db_settings.db_lock_mode,
+        pessimistic_skus=db_settings.db_pessimistic_skus,
+        isolation_level=db_settings.db_lock_isolation_level,
+    )
+
+
+def get_event_dispatcher_options():
+    return dict(
+        max_workers=bus_settings.bus_event_workers,
+        retry_attempts=bus_settings.bus_event_retry_attempts,
+        retry_wait_max=bus_settings.bus_event_retry_wait_max,
+    )
+
+
+def get_view_cache_options():
+    return dict(
+        max_size=view_cache_settings.view_cache_size,
+        ttl=view_cache_settings.view_cache_ttl,
+    )
+
+
+def get_product_cache_options():
+    return dict(max_size=product_cache_settings.product_cache_size)
+
+
+def get_planner_cache_options():
+    return dict(
+        max_size=planner_settings.planner_cache_size,
+        ttl=planner_settings.planner_cache_ttl,
+    )
 
 
 def get_api_url():
@@ -39,6 +154,23 @@ def get_api_url():
     return f"http://{host}:{port}"
 
 
+def get_redis_pool_options():
+    return dict(
+        max_connections=redis_settings.redis_max_connections,
+        socket_timeout=redis_settings.redis_socket_timeout,
+    )
+
+
+def get_redis_stream_options():
+    return dict(
+        batch_size=redis_settings.redis_stream_batch_size,
+        batch_window_ms=redis_settings.redis_stream_batch_window_ms,
+        block_ms=redis_settings.redis_stream_block_ms,
+        claim_idle_ms=redis_settings.redis_stream_claim_idle_ms,
+        max_deliveries=redis_settings.redis_stream_max_deliveries,
+    )
+
+
 def get_redis_host_and_port():
     host = redis_settings.redis_host
     port = redis_settings.redis_port
@@ -7,6 +7,17 @@ class PostAllocateModel(BaseModel):
     sku: str
     qty: int
 
+class PostAllocateManyModel(BaseModel):
+    lines: List[PostAllocateModel]
+
+class PlanLineModel(BaseModel):
+    sku: str
+    qty: int
+    orderid: str = ''
+
+class PostPlanModel(BaseModel):
+    lines: List[PlanLineModel]
+
 class PostAddBatchModel(BaseModel):
     ref: str
     sku: str
@@ -1,30 +1,34 @@
-from typing import Optional
+from typing import Optional, List
 from datetime import date
 from dataclasses import dataclass
 
 class Command:      # родительский класс команд
-    pass
+    __slots__ = ()  # команды - dataclass(slots=True): без __dict__ у экземпляра
 
-@dataclass
+@dataclass(slots=True)
 class Allocate(Command):    # команда размещения заказа
     orderid: str
     sku: str
     qty: int
 
-@dataclass
+@dataclass(slots=True)
+class AllocateMany(Command):    # команда размещения нескольких товарных позиций в одной транзакции
+    lines: List[Allocate]
+
+@dataclass(slots=True)
 class Deallocate(Command):    # команда отмены размещения заказа
     orderid: str
     sku: str
     qty: int
 
-@dataclass
+@dataclass(slots=True)
 class CreateBatch(Command):     # команда создания партии
     ref: str
     sku: str
     qty: int
     eta: Optional[date] = None
 
-@dataclass
+@dataclass(slots=True)
 class ChangeBatchQuantity(Command):     # команда изменения размера партии
     ref: str
     qty: int
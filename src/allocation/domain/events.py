@@ -4,20 +4,20 @@ from dataclasses import dataclass
 
 # Общий родительский класс для различных событий
 class Event:
-    pass
+    __slots__ = ()  # события - dataclass(slots=True): без __dict__ у экземпляра
 
-@dataclass
+@dataclass(slots=True)
 class OutOfStock(Event):    # событие отсутствия товара
     sku: str
 
-@dataclass
+@dataclass(slots=True)
 class Allocated(Event):     # событие о размещение товарной позиции в определенной партии
     orderid: str
     sku: str
     qty: int
     batchref: str
 
-@dataclass
+@dataclass(slots=True)
 class Deallocated(Event):     # событие отмены размещения товарной позиции
     orderid: str
     sku: str
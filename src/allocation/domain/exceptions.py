@@ -7,3 +7,11 @@ class NoOrderInBatch(Exception):
 
 class InvalidSku(Exception):
     pass
+
+
+class ConcurrencyConflict(Exception):
+    """
+    Исключение, если агрегат был изменен параллельной транзакцией после его загрузки:
+    версия продукта в БД не совпала с ожидаемой либо БД отменила транзакцию из-за конфликта сериализации
+    """
+    pass
@@ -1,4 +1,6 @@
-from typing import Optional, List
+import sys
+from typing import Deque, Iterable, Optional, List, Dict
+from collections import deque
 
 from datetime import date
 from dataclasses import dataclass
@@ -13,11 +15,16 @@ class OrderLine:
     Модель данных для хранения данных заказа без какого-либо поведения и изменения
     unsafe_hash = True: Явное определение метода __hash()__, когда класс логически неизменяем,
     но, тем не менее может быть изменен
+    __slots__ невозможен: ORM хранит состояние отображаемого объекта и значения атрибутов в его __dict__,
+    поэтому память экономится на значениях - артикул, общий для всех позиций продукта, интернируется
     """
     orderid: str
     sku: str
     qty: int
 
+    def __post_init__(self) -> None:
+        self.sku = sys.intern(self.sku)
+
 
 class Batch:
     """
@@ -27,12 +34,15 @@ class Batch:
     qty - количество товара
     eta - предполагаемый срок прибытия
     """
+    _allocated_quantity: Optional[int] = None   # накопленная сумма размещенных позиций, None - еще не посчитана
+
     def __init__(self, ref: str, sku: str, qty: int, eta: Optional[date]) -> None:
         self.reference = ref
         self.sku = sku
         self.eta = eta
         self._purchased_quantity = qty
         self._allocations = set()
+        self._allocated_quantity = 0
 
     def __eq__(self, other):
         """
@@ -60,19 +70,37 @@ class Batch:
         return self.eta > other.eta
 
     def allocate(self, line: OrderLine) -> None:
-        if self.can_allocate(line):
+        if self.can_allocate(line) and line not in self._allocations:
+            self._allocated_quantity = self.allocated_quantity + line.qty
             self._allocations.add(line)
 
     def deallocate(self, line: OrderLine) -> None:
         if self.can_deallocate(line):
+            self._allocated_quantity = self.allocated_quantity - line.qty
             self._allocations.remove(line)
     
     def deallocate_one(self) -> OrderLine:
-        return self._allocations.pop()
+        allocated = self.allocated_quantity
+        line = self._allocations.pop()
+        self._allocated_quantity = allocated - line.qty
+        return line
+
+    def reset_allocated_quantity(self) -> None:
+        """
+        Сброс накопленной суммы, она будет пересчитана по _allocations при следующем обращении
+        Вызывается ORM, когда коллекция _allocations загружается или обновляется из БД
+        """
+        self._allocated_quantity = None
 
     @property   # позволяет сделать метод вычисляемым свойством
     def allocated_quantity(self) -> int:
-        return sum(line.qty for line in self._allocations)
+        """
+        Сумма хранится и обновляется в allocate/deallocate/deallocate_one, поэтому обращение к ней - O(1)
+        Полный пересчет выполняется один раз: для партии, загруженной ORM без вызова __init__
+        """
+        if self._allocated_quantity is None:
+            self._allocated_quantity = sum(line.qty for line in self._allocations)
+        return self._allocated_quantity
 
     @property
     def available_quantity(self) -> int:
@@ -85,8 +113,83 @@ class Batch:
         return line in self._allocations
 
 
+def batch_priority(batch: Batch):
+    """
+    Ключ приоритета размещения партии: сначала складские партии (eta = None), затем по сроку прибытия
+    Совпадает с порядком sorted() по Batch.__gt__
+    """
+    return (batch.eta is not None, batch.eta or date.min)
+
+
+class BatchPriorityIndex:
+    """
+    Индекс партий продукта в порядке приоритета размещения
+    ordered - партии, упорядоченные по batch_priority (при равенстве - в порядке добавления)
+    Поверх них строится дерево отрезков по максимуму available_quantity:
+    первая по приоритету партия, в которой хватает товара, находится за O(log n),
+    изменение остатка одной партии учитывается за O(log n)
+    """
+    def __init__(self, batches: List[Batch]) -> None:
+        self.ordered = sorted(batches, key=batch_priority)
+        self._positions = {batch: i for i, batch in enumerate(self.ordered)}
+        self._size = 1
+        while self._size < len(self.ordered):
+            self._size *= 2
+        self._tree = [float('-inf')] * (2 * self._size)   # листья дерева - остатки партий, узлы - максимум потомков
+        for i, batch in enumerate(self.ordered):
+            self._tree[self._size + i] = batch.available_quantity
+        for node in range(self._size - 1, 0, -1):
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+
+    def __len__(self) -> int:
+        return len(self.ordered)
+
+    def update(self, batch: Batch) -> None:
+        """
+        Пересчет остатка партии после размещения, отмены размещения или изменения размера партии
+        """
+        self._set(self._positions[batch], batch.available_quantity)
+
+    def reserve(self, batch: Batch, qty: int) -> None:
+        """
+        Уменьшение остатка партии только в индексе, сама партия не меняется (пробное размещение)
+        """
+        position = self._positions[batch]
+        self._set(position, self._tree[self._size + position] - qty)
+
+    def copy(self) -> 'BatchPriorityIndex':
+        """
+        Копия для пробного размещения: партии общие с исходным индексом, дерево остатков - свое
+        """
+        index = object.__new__(BatchPriorityIndex)
+        index.ordered, index._positions, index._size = self.ordered, self._positions, self._size
+        index._tree = list(self._tree)
+        return index
+
+    def _set(self, position: int, available: int) -> None:
+        node = self._size + position
+        self._tree[node] = available
+        node //= 2
+        while node:
+            self._tree[node] = max(self._tree[2 * node], self._tree[2 * node + 1])
+            node //= 2
+
+    def find(self, qty: int) -> Optional[Batch]:
+        """
+        Первая по приоритету партия, остаток которой не меньше qty
+        """
+        if not self.ordered or self._tree[1] < qty:
+            return None
+        node = 1
+        while node < self._size:    # спуск к самому левому листу с достаточным остатком
+            node = 2 * node if self._tree[2 * node] >= qty else 2 * node + 1
+        return self.ordered[node - self._size]
+
+
 class Product:
-    events: List[Event] = []    # тип: List[events.Event], события предметной области
+    events: Deque[Event] = deque()    # тип: Deque[events.Event], очередь событий предметной области
+    _batch_index: Optional[BatchPriorityIndex] = None   # строится при первом обращении, в т.ч. для продукта из ORM
+    _line_index: Optional[Dict[OrderLine, Batch]] = None     # позиция -> партия, в которой она размещена
     """
     Агрегат, который содержит в себе партии определенного артикула как единое целое
     Для доступа к партиям и к службам предметной области теперь используется Product
@@ -96,40 +199,115 @@ class Product:
     def __init__(self, sku: str, batches: List[Batch], version_number: int = 0) -> None:
         self.sku = sku      # артикул разных партий, которые представляют себя единым целым - продуктом
         self.batches = batches      # список партий одного артикула
-        self.version_number = version_number    # маркер, позволяющий отслеживать изменение версий продукта при параллелизме транзакций
-        self.events = []
-
-    def allocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_allocate(line))
-            batch.allocate(line)
-            self.version_number += 1
-            self.events.append(events.Allocated(    # инициализация события для регистрации размещения заказа
-                orderid=line.orderid, sku=line.sku, qty=line.qty,
-                batchref=batch.reference
-            ))
-            return batch.reference
-        except StopIteration:
+        self.version_number = version_number    # маркер версии продукта: растет при каждом изменении агрегата, ORM сверяет его при UPDATE (CAS)
+        self.events = deque()
+
+    @property
+    def batch_index(self) -> BatchPriorityIndex:
+        """
+        Индекс партий по приоритету размещения
+        Перестраивается, если партии были добавлены в обход add_batch (например, product.batches.append)
+        """
+        if self._batch_index is None or len(self._batch_index) != len(self.batches):
+            self._batch_index = BatchPriorityIndex(self.batches)
+        return self._batch_index
+
+    @property
+    def line_index(self) -> Dict[OrderLine, Batch]:
+        """
+        Обратный индекс размещенных позиций: позиция -> партия
+        Ключ - позиция целиком (orderid, sku, qty), как и равенство OrderLine: позиции одного заказа и артикула
+        с разным количеством - разные позиции, и каждая может лежать в своей партии
+        Строится по коллекциям _allocations при первом обращении и далее поддерживается
+        методами allocate, deallocate и change_batch_quantity
+        """
+        if self._line_index is None:
+            self._line_index = self._build_line_index()
+        return self._line_index
+
+    def _build_line_index(self) -> Dict[OrderLine, Batch]:
+        return {line: batch for batch in self.batches for line in batch._allocations}
+
+    def line_index_is_consistent(self) -> bool:
+        """
+        Проверка, что обратный индекс позиций совпадает с содержимым _allocations партий
+        """
+        return self._line_index is None or self._line_index == self._build_line_index()
+
+    def reset_indexes(self) -> None:
+        """
+        Сброс индексов агрегата, они будут построены заново при следующем обращении
+        Вызывается ORM, когда состояние продукта загружается или обновляется из БД
+        """
+        self._batch_index = None
+        self._line_index = None
+
+    def add_batch(self, batch: Batch) -> None:
+        self.batches.append(batch)
+        self._batch_index = None
+        self.version_number += 1
+
+    def allocate(self, line: OrderLine, dry_run: bool = False) -> str:
+        """
+        dry_run - только выбрать партию: продукт, партии, версия и события не меняются,
+        None - товара нет в наличии
+        """
+        if dry_run:
+            return self.plan([line])[0]
+        batch = self.batch_index.find(line.qty)
+        if batch is None or not batch.can_allocate(line):
             self.events.append(events.OutOfStock(line.sku))     # инициировать OutOfStock(f'Артикула {line.sku} нет в наличии')
-            return None 
+            return None
+        batch.allocate(line)
+        self.batch_index.update(batch)
+        if self._line_index is not None:
+            self._line_index[line] = batch
+        self.version_number += 1
+        self.events.append(events.Allocated(    # инициализация события для регистрации размещения заказа
+            orderid=line.orderid, sku=line.sku, qty=line.qty,
+            batchref=batch.reference
+        ))
+        return batch.reference
+
+    def plan(self, lines: Iterable[OrderLine]) -> List[Optional[str]]:
+        """
+        Пробное размещение позиций корзины по текущим остаткам: позиции размещаются по порядку,
+        и каждая уменьшает остаток выбранной партии для следующих, как при последовательных allocate
+        Состояние продукта не меняется, поэтому один продукт можно планировать из нескольких потоков
+        """
+        index = self.batch_index.copy()
+        batchrefs = []
+        for line in lines:
+            batch = index.find(line.qty)
+            if batch is None or batch.sku != line.sku:
+                batchrefs.append(None)
+                continue
+            index.reserve(batch, line.qty)
+            batchrefs.append(batch.reference)
+        return batchrefs
 
     def deallocate(self, line: OrderLine) -> str:
-        try:
-            batch = next(b for b in sorted(self.batches) if b.can_deallocate(line))
-            batch.deallocate(line)
-            self.version_number -= 1
-            self.events.append(events.Deallocated(    # инициализация события для регистрации отмены размещения заказа
-                orderid=line.orderid, sku=line.sku, qty=line.qty
-            ))
-            return batch.reference
-        except StopIteration:
+        batch = self.line_index.get(line)
+        if batch is None or not batch.can_deallocate(line):
             raise NoOrderInBatch(f'Товарная позиция {line.sku} не размещена ни в одной партии')
+        batch.deallocate(line)
+        self.batch_index.update(batch)
+        del self._line_index[line]
+        self.version_number += 1
+        self.events.append(events.Deallocated(    # инициализация события для регистрации отмены размещения заказа
+            orderid=line.orderid, sku=line.sku, qty=line.qty
+        ))
+        return batch.reference
 
     def change_batch_quantity(self, ref: str, qty: int):
         batch = next(b for b in self.batches if b.reference == ref)
         batch._purchased_quantity = qty
         while batch.available_quantity < 0:
             line = batch.deallocate_one()
+            if self._line_index is not None:
+                self._line_index.pop(line, None)
             self.events.append(
                 commands.Allocate(line.orderid, line.sku, line.qty)
             )
+        self.batch_index.update(batch)
+        self.version_number += 1
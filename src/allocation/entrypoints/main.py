@@ -3,12 +3,22 @@ from fastapi import FastAPI
 
 from src.allocation.entrypoints.routes.allocate import allocate_router
 from src.allocation.entrypoints.routes.batches import batches_router
+from src.allocation.entrypoints.routes.metrics import metrics_router
+from src.allocation.bootstrap import bus
 
 app = FastAPI()
 
 # Register routes
 app.include_router(allocate_router, prefix="/allocate")
 app.include_router(batches_router, prefix="/batches")
+app.include_router(metrics_router, prefix="/metrics")
+
+@app.on_event("shutdown")
+def shutdown_event_dispatcher():
+    """
+    Дообработка событий, отправленных в фоновый пул, перед остановкой приложения
+    """
+    bus.shutdown(timeout=30)
 
 @app.get("/")
 async def home():
@@ -0,0 +1,37 @@
+import time
+import redis
+import logging
+from sqlalchemy import exc
+from src.allocation import config
+from src.allocation.adapters import orm, redis_eventpublisher
+from src.allocation.adapters.outbox import OutboxRelay
+from src.allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """
+    Ретранслятор outbox: публикует в Redis события, зафиксированные приложением, пачками по outbox_batch_size
+    Пока есть неопубликованные события, пачки читаются без паузы, иначе - опрос раз в outbox_poll_interval секунд
+    """
+    orm.start_mappers()
+    relay = OutboxRelay(
+        unit_of_work.default_session_factory(),
+        redis_eventpublisher.get_redis_client(),
+        batch_size=config.outbox_settings.outbox_batch_size
+    )
+    logger.debug('Outbox relay started')
+    while True:
+        try:
+            relayed = relay.relay_once()
+        except (redis.RedisError, exc.DBAPIError):
+            logger.exception('Не удалось опубликовать события из outbox, повтор через %s с',
+                             config.outbox_settings.outbox_poll_interval)
+            relayed = 0
+        if not relayed:
+            time.sleep(config.outbox_settings.outbox_poll_interval)
+
+
+if __name__ == "__main__":
+    main()
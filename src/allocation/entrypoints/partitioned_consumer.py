@@ -0,0 +1,227 @@
+import time
+import queue
+import signal
+import hashlib
+import bisect
+import logging
+import multiprocessing
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import select
+
+from src.allocation.adapters import orm
+from src.allocation.domain import commands
+from src.allocation.entrypoints.redis_eventconsumer import StreamConsumer, entry_age
+
+logger = logging.getLogger(__name__)
+
+
+def _hash(key: str) -> int:
+    # встроенный hash() строк меняется от процесса к процессу (PYTHONHASHSEED), поэтому - blake2b
+    return int.from_bytes(hashlib.blake2b(key.encode('utf-8'), digest_size=8).digest(), 'big')
+
+
+class HashRing:
+    """
+    Согласованное хеширование: у каждого узла replicas точек на кольце, ключ достается первому узлу
+    по часовой стрелке от хеша ключа; при изменении числа узлов переезжает лишь ~1/N ключей
+    """
+
+    def __init__(self, nodes: Iterable[Hashable], replicas: int = 100) -> None:
+        points = sorted((_hash(f'{node}:{i}'), node) for node in nodes for i in range(replicas))
+        self._hashes = [h for h, _ in points]
+        self._nodes = [node for _, node in points]
+
+    def node_for(self, key: str):
+        i = bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)
+        return self._nodes[i]
+
+
+class BatchSkuResolver:
+    """
+    Артикул партии по ее ссылке; артикул партии не меняется, поэтому найденные значения кешируются
+    """
+
+    def __init__(self, session_factory) -> None:
+        self.session_factory = session_factory
+        self._skus: Dict[str, str] = {}
+
+    def __call__(self, batchref: str) -> Optional[str]:
+        sku = self._skus.get(batchref)
+        if sku is None:
+            session = self.session_factory()
+            try:
+                sku = session.execute(
+                    select(orm.batches.c.sku).where(orm.batches.c.reference == batchref)
+                ).scalar()
+            finally:
+                session.close()
+            if sku is not None:
+                self._skus[batchref] = sku
+        return sku
+
+
+def default_bus():
+    from src.allocation.bootstrap import bus    # шина (движок, пул соединений) создается в процессе-обработчике
+    return bus
+
+
+def default_sku_resolver() -> BatchSkuResolver:
+    from src.allocation.service_layer import unit_of_work
+    return BatchSkuResolver(unit_of_work.default_session_factory())
+
+
+def run_worker(index: int, bus_factory: Callable, tasks, results) -> None:
+    """
+    Процесс-обработчик: получает команды своих артикулов по порядку и обрабатывает их своей шиной
+    Остановку (SIGINT/SIGTERM) координирует родительский процесс: обработчик завершается, получив None
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    worker = StreamConsumer(None, bus_factory(), group='', consumer=f'worker-{index}')
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        batch_no, stream, parsed = task
+        failed, commands_before = worker.stats.failed, worker.stats.commands
+        acked = worker.handle_entries(stream, parsed)
+        results.put((index, batch_no, acked, worker.stats.failed - failed, worker.stats.commands - commands_before))
+
+
+class PartitionedStreamConsumer(StreamConsumer):
+    """
+    Потребитель потоков с обработкой команд в workers процессах: запись направляется процессу
+    по согласованному хешу артикула (ChangeBatchQuantity - по артикулу партии), поэтому команды одного продукта
+    обрабатываются одним процессом по порядку, а разные продукты размещаются параллельно без конкуренции
+    за одну строку products
+    Родительский процесс читает пачку, раздает ее процессам, ждет результатов и подтверждает записи одним XACK
+    У каждого процесса не больше одной необработанной пачки: следующая отдается ему только после результата
+    предыдущей, даже если ожидание превысило result_timeout
+    """
+
+    def __init__(
+            self,
+            client,
+            group: str,
+            consumer: str,
+            workers: int = 4,
+            bus_factory: Callable = default_bus,
+            resolve_sku: Optional[Callable[[str], Optional[str]]] = None,
+            mp_context=None,
+            result_timeout: float = 60.0,
+            **options
+    ) -> None:
+        super().__init__(client, None, group, consumer, **options)
+        self.workers = workers
+        self.ring = HashRing(range(workers))
+        self.bus_factory = bus_factory
+        self._resolve_sku = resolve_sku
+        self.mp_context = mp_context or multiprocessing.get_context('spawn')
+        self.result_timeout = result_timeout
+        self.results = self.mp_context.Queue()
+        self.tasks: List = [None] * workers
+        self.processes: List = [None] * workers
+        self.outstanding: Dict[int, Tuple[int, str, int]] = {}     # процесс -> (номер пачки, поток, число записей)
+        self._batch_no = 0
+
+    @property
+    def resolve_sku(self) -> Callable[[str], Optional[str]]:
+        if self._resolve_sku is None:
+            self._resolve_sku = default_sku_resolver()
+        return self._resolve_sku
+
+    def start(self) -> None:
+        for index in range(self.workers):
+            self._start_worker(index)
+
+    def _start_worker(self, index: int) -> None:
+        self.tasks[index] = self.mp_context.Queue()
+        self.processes[index] = self.mp_context.Process(
+            target=run_worker, args=(index, self.bus_factory, self.tasks[index], self.results),
+            name=f'{self.consumer}-worker-{index}', daemon=True
+        )
+        self.processes[index].start()
+
+    def partition_key(self, command: commands.Command) -> str:
+        if isinstance(command, commands.ChangeBatchQuantity):
+            return self.resolve_sku(command.ref) or command.ref
+        return command.sku
+
+    def handle_entries(self, stream: str, parsed: List[Tuple[bytes, commands.Command]]) -> List[bytes]:
+        chunks: Dict[int, List] = {}
+        for entry_id, command in parsed:
+            chunks.setdefault(self.ring.node_for(self.partition_key(command)), []).append((entry_id, command))
+        self._batch_no += 1
+        acked = []
+        for index, chunk in chunks.items():
+            # процесс еще обрабатывает пачку, по которой истек result_timeout: новые команды его артикулов
+            # нельзя ни отдать ему раньше, ни оставить на повтор позже (это нарушило бы порядок), поэтому ждем
+            while index in self.outstanding:
+                acked.extend(self._receive(1.0))
+            self.tasks[index].put((self._batch_no, stream, chunk))
+            self.outstanding[index] = (self._batch_no, stream, len(chunk))
+        return acked + self._collect(set(chunks))
+
+    def _collect(self, indexes: Set[int]) -> List[bytes]:
+        """
+        Ожидание результатов процессов по текущей пачке не дольше result_timeout
+        Процесс, не успевший за это время, остается занятым: его результат подтверждается, когда придет
+        """
+        acked = []
+        deadline = time.monotonic() + self.result_timeout
+        while indexes & self.outstanding.keys() and time.monotonic() < deadline:
+            acked.extend(self._receive(min(1.0, max(0.0, deadline - time.monotonic()))))
+        for index in indexes & self.outstanding.keys():
+            logger.error('Процесс-обработчик %s не обработал %s записей за %s с',
+                         index, self.outstanding[index][2], self.result_timeout)
+        return acked
+
+    def _receive(self, timeout: float) -> List[bytes]:
+        """
+        Прием одного результата; возвращает записи текущей пачки для подтверждения, записи запоздавшей
+        пачки подтверждаются сразу - команды уже зафиксированы, повторять их нельзя
+        Если процесс упал, он перезапускается, а его записи остаются неподтвержденными и будут перехвачены повторно
+        """
+        try:
+            index, batch_no, worker_acked, failed, commands_count = self.results.get(timeout=timeout)
+        except queue.Empty:
+            for index in [i for i in self.outstanding if not self.processes[i].is_alive()]:
+                _, _, entries = self.outstanding.pop(index)
+                logger.error('Процесс-обработчик %s завершился, %s записей не обработано', index, entries)
+                self.stats.failed += entries
+                self._start_worker(index)
+            return []
+        _, stream, _ = self.outstanding.pop(index)
+        self.stats.failed += failed
+        self.stats.commands += commands_count
+        if batch_no == self._batch_no:
+            return worker_acked
+        logger.warning('Запоздавший результат пачки %s процесса %s: подтверждается %s записей',
+                       batch_no, index, len(worker_acked))
+        if worker_acked:
+            for entry_id in worker_acked:
+                self.stats.record(entry_age(entry_id))
+            self.client.xack(stream, self.group, *worker_acked)
+        return []
+
+    def close(self, timeout: float = 30.0) -> None:
+        """
+        Корректная остановка: процессы дообрабатывают полученные команды и завершаются
+        """
+        for tasks in self.tasks:
+            if tasks is not None:
+                tasks.put(None)
+        for process in self.processes:
+            if process is None:
+                continue
+            process.join(timeout)
+            if process.is_alive():
+                logger.error('Процесс-обработчик %s не завершился за %s с', process.name, timeout)
+                process.terminate()
+
+    def run(self, should_stop: Callable[[], bool] = lambda: False) -> None:
+        self.start()
+        try:
+            super().run(should_stop)
+        finally:
+            self.close()
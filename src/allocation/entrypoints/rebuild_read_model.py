@@ -0,0 +1,53 @@
+import argparse
+import logging
+from typing import Callable, Optional
+from src.allocation import config
+from src.allocation.adapters import redis_eventpublisher
+from src.allocation.adapters.projection_rebuild import AllocationsViewRebuild
+from src.allocation.adapters.view_cache import RedisCache
+from src.allocation.service_layer import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+
+def cache_invalidator() -> Optional[Callable[[str], None]]:
+    """
+    Инвалидация кеша модели чтения из отдельного процесса возможна только через общий уровень Redis:
+    RedisCache.delete увеличивает поколение ключа, и запись заказа перестает выдаваться всем процессам
+    Кеши процессов воркеров API из этого процесса недоступны - их записи живут до истечения view_cache_ttl
+    """
+    settings = config.view_cache_settings
+    if not settings.view_cache_enabled:
+        return None
+    if not settings.view_cache_redis:
+        logger.warning(
+            'Кеш модели чтения без уровня Redis: процессы API будут выдавать прежние размещения '
+            'до истечения view_cache_ttl (%s с)', settings.view_cache_ttl
+        )
+        return None
+    return RedisCache(redis_eventpublisher.get_redis_client(), ttl=settings.view_cache_redis_ttl).delete
+
+
+def main(argv=None):
+    """
+    Перестроение модели чтения allocations_view из таблиц записи
+    Повторный запуск после сбоя продолжает с контрольных точек; --status - только показать прогресс
+    """
+    parser = argparse.ArgumentParser(description='Перестроение allocations_view из batches/allocations/order_lines')
+    parser.add_argument('--chunk-size', type=int, default=50_000, help='сколько allocations.id копировать за транзакцию')
+    parser.add_argument('--workers', type=int, default=4, help='число потоков копирования')
+    parser.add_argument('--status', action='store_true', help='показать прогресс прерванного перестроения и выйти')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    rebuild = AllocationsViewRebuild(
+        unit_of_work.get_engine(), chunk_size=args.chunk_size, workers=args.workers, invalidate=cache_invalidator()
+    )
+    if args.status:
+        print(rebuild.progress() or 'Перестроение не выполняется')
+        return
+    rebuild.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,348 @@
-import redis
-import logging
+import os
 import json
+import time
+import socket
+import signal
+import logging
+import threading
+import redis
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
 from src.allocation import config
-from src.allocation.bootstrap import bus
+from src.allocation.adapters import redis_eventpublisher
 from src.allocation.domain import commands
 
-r = redis.Redis(**config.get_redis_host_and_port())
 logger = logging.getLogger(__name__)
 
+Entry = Tuple[bytes, Dict[bytes, bytes]]    # (идентификатор записи потока, поля записи)
 
-def main():
 
-    pubsub = r.pubsub(ignore_subscribe_messages=True)
-    pubsub.subscribe('change_batch_quantity', 'allocate')       # подписка клиента (веб-приложения) на каналы
-    logging.debug("Subscribed to change_batch_quantity and allocate topic")
-    for m in pubsub.listen():       # при получении сообщения вызывается соответсвующий каналу обработчик
-        channel = m['channel'].decode('utf-8')
-        if channel == 'change_batch_quantity':
-            handle_change_quantity(m, bus)
+def change_quantity_command(data: Dict) -> commands.ChangeBatchQuantity:
+    return commands.ChangeBatchQuantity(ref=data['batchref'], qty=data['qty'])
+
+def allocate_command(data: Dict) -> commands.Allocate:
+    return commands.Allocate(orderid=data['orderid'], sku=data['sku'], qty=data['qty'])
+
+
+STREAM_HANDLERS: Dict[str, Callable[[Dict], commands.Command]] = {     # поток Redis -> команда из данных записи
+    'change_batch_quantity': change_quantity_command,
+    'allocate': allocate_command,
+}
+
+
+def coalesce(entries: List[Tuple[bytes, commands.Command]]) -> List[Tuple[List[bytes], commands.Command]]:
+    """
+    Объединение команд пачки в группы (идентификаторы записей, команда), каждая группа - один вызов шины:
+    размещения одного артикула - одна команда AllocateMany (одна транзакция на продукт),
+    из изменений размера одной партии остается последнее - предыдущие им перекрыты
+    Группы идут в порядке первой записи группы
+    """
+    groups: Dict[Tuple, Tuple[List[bytes], List[commands.Command]]] = {}
+    for entry_id, command in entries:
+        if isinstance(command, commands.Allocate):
+            key = (commands.Allocate, command.sku)
+        elif isinstance(command, commands.ChangeBatchQuantity):
+            key = (commands.ChangeBatchQuantity, command.ref)
         else:
-            handle_allocate(m, bus)
-        logging.debug(f"Message: {m}")
-
-def handle_change_quantity(m, bus):
-    logging.debug('handling %s', m)
-    data = json.loads(m['data'])
-    cmd = commands.ChangeBatchQuantity(ref=data['batchref'], qty=data['qty'])
-    bus.handle(cmd)
-
-def handle_allocate(m, bus):
-    logging.debug('handling %s', m)
-    data = json.loads(m['data'])
-    cmd = commands.Allocate(orderid=data['orderid'], sku=data['sku'], qty=data['qty'])
-    bus.handle(cmd)
+            key = (entry_id,)
+        entry_ids, group = groups.setdefault(key, ([], []))
+        entry_ids.append(entry_id)
+        group.append(command)
+
+    result = []
+    for key, (entry_ids, group) in groups.items():
+        if key[0] is commands.Allocate and len(group) > 1:
+            result.append((entry_ids, commands.AllocateMany(lines=group)))
+        else:
+            result.append((entry_ids, group[-1]))
+    return result
+
+
+def _decode(value) -> str:
+    return value.decode('utf-8') if isinstance(value, bytes) else value
+
+
+def entry_age(entry_id) -> float:
+    """
+    Сколько секунд запись провела в потоке: идентификатор записи начинается с времени ее добавления в мс
+    """
+    return max(0.0, time.time() - int(_decode(entry_id).split('-')[0]) / 1000)
+
+
+class ConsumerStats:
+    """
+    Статистика потребителя: обработанные, упавшие, перехваченные у других потребителей и отправленные
+    в поток недоставленных записи, число вызовов шины после объединения записей в группы,
+    пропускная способность и задержка от добавления записи до ее обработки
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.started = time.perf_counter()
+        self.processed = 0
+        self.commands = 0
+        self.failed = 0
+        self.claimed = 0
+        self.dead_lettered = 0
+        self.total_age = 0.0
+        self.max_age = 0.0
+
+    def record(self, age: float, failed: bool = False) -> None:
+        with self._lock:
+            if failed:
+                self.failed += 1
+                return
+            self.processed += 1
+            self.total_age += age
+            self.max_age = max(self.max_age, age)
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            elapsed = time.perf_counter() - self.started
+            return {
+                'processed': self.processed,
+                'failed': self.failed,
+                'claimed': self.claimed,
+                'dead_lettered': self.dead_lettered,
+                'commands': self.commands,
+                'throughput_per_second': self.processed / elapsed if elapsed else 0.0,
+                'avg_age_seconds': self.total_age / self.processed if self.processed else 0.0,
+                'max_age_seconds': self.max_age,
+            }
+
+
+class StreamConsumer:
+    """
+    Потребитель потоков Redis в группе потребителей (XREADGROUP/XACK):
+    несколько процессов с разными именами consumer в одной группе делят записи потоков между собой,
+    записи, не подтвержденные потребителем дольше claim_idle_ms (упал или завис), перехватываются другим,
+    после max_deliveries неудачных доставок запись переносится в поток <поток>.dead
+    Записи читаются пачками: после первой записи пачка дочитывается, пока не наберется batch_size записей
+    или не пройдет batch_window_ms, и обрабатывается группами (см. coalesce)
+    """
+
+    def __init__(
+            self,
+            client: redis.Redis,
+            bus,
+            group: str,
+            consumer: str,
+            handlers: Dict[str, Callable[[Dict], commands.Command]] = STREAM_HANDLERS,
+            batch_size: int = 100,
+            batch_window_ms: int = 50,
+            block_ms: int = 1000,
+            claim_idle_ms: int = 30_000,
+            max_deliveries: int = 5
+    ) -> None:
+        self.client = client
+        self.bus = bus
+        self.group = group
+        self.consumer = consumer
+        self.handlers = handlers
+        self.batch_size = batch_size
+        self.batch_window_ms = batch_window_ms
+        self.block_ms = block_ms
+        self.claim_idle_ms = claim_idle_ms
+        self.max_deliveries = max_deliveries
+        self.stats = ConsumerStats()
+
+    def ensure_groups(self) -> None:
+        for stream in self.handlers:
+            try:
+                self.client.xgroup_create(stream, self.group, id='0', mkstream=True)
+            except redis.ResponseError as e:
+                if 'BUSYGROUP' not in str(e):     # группа уже создана другим потребителем
+                    raise
+
+    def read_batch(self) -> int:
+        """
+        Чтение пачки новых записей всех потоков, возвращает число обработанных записей
+        count в XREADGROUP ограничивает каждый поток в отдельности, поэтому потоки читаются по одному
+        с остатком пачки, а ожидание новых записей берет не больше одной записи на поток
+        """
+        batch: Dict[str, List[Entry]] = {}
+        total = 0
+        deadline = None
+        streams = list(self.handlers)
+        while total < self.batch_size:
+            for stream in streams:
+                if total >= self.batch_size:
+                    break
+                total += self.read_streams(batch, [stream], self.batch_size - total)
+            if total >= self.batch_size:
+                break
+            if deadline is None and total:
+                deadline = time.monotonic() + self.batch_window_ms / 1000
+            block = self.block_ms if deadline is None else int((deadline - time.monotonic()) * 1000)
+            if block <= 0:      # block=0 в XREADGROUP - ждать бесконечно
+                break
+            waited = self.read_streams(batch, streams[:self.batch_size - total], 1, block)
+            if not waited:
+                break
+            total += waited
+        return sum(self.process(stream, entries) for stream, entries in batch.items())
+
+    def read_streams(
+            self, batch: Dict[str, List[Entry]], streams: List[str], count: int, block: Optional[int] = None
+    ) -> int:
+        """
+        Один XREADGROUP по потокам streams с добавлением записей в batch, возвращает число прочитанных записей;
+        без block - не ждать новых записей
+        """
+        response = self.client.xreadgroup(
+            self.group, self.consumer, {stream: '>' for stream in streams}, count=count, block=block
+        )
+        read = 0
+        for stream, entries in response or []:
+            batch.setdefault(_decode(stream), []).extend(entries)
+            read += len(entries)
+        return read
+
+    def claim_stale(self) -> int:
+        """
+        Перехват записей, которые другие потребители получили, но не подтвердили за claim_idle_ms
+        """
+        claimed = 0
+        for stream in self.handlers:
+            pending = self.client.xpending_range(
+                stream, self.group, min='-', max='+', count=self.batch_size, idle=self.claim_idle_ms
+            )
+            if not pending:
+                continue
+            exhausted = [p['message_id'] for p in pending if p['times_delivered'] >= self.max_deliveries]
+            retry = [p['message_id'] for p in pending if p['times_delivered'] < self.max_deliveries]
+            if exhausted:
+                self.dead_letter(stream, exhausted)
+            if retry:
+                entries = self.client.xclaim(stream, self.group, self.consumer, self.claim_idle_ms, retry)
+                entries = [entry for entry in entries if entry and entry[1]]    # запись могла быть удалена из потока
+                self.stats.claimed += len(entries)
+                claimed += self.process(stream, entries)
+        return claimed
+
+    def dead_letter(self, stream: str, message_ids: List) -> None:
+        entries = self.client.xclaim(stream, self.group, self.consumer, self.claim_idle_ms, message_ids)
+        pipe = self.client.pipeline(transaction=False)
+        for entry in entries:
+            if entry and entry[1]:
+                pipe.xadd(f'{stream}.dead', entry[1])
+        pipe.xack(stream, self.group, *message_ids)
+        pipe.execute()
+        self.stats.dead_lettered += len(message_ids)
+        logger.error('%s записей потока %s не обработаны за %s попыток', len(message_ids), stream, self.max_deliveries)
+
+    def process(self, stream: str, entries: Iterable[Entry]) -> int:
+        """
+        Обработка записей группами (см. coalesce); подтверждение всех успешно обработанных - одним XACK,
+        упавшие остаются в списке ожидающих группы и будут перехвачены повторно
+        """
+        parsed, ages = self.parse(stream, entries)
+        acked = self.handle_entries(stream, parsed)
+        for entry_id in acked:
+            self.stats.record(ages[entry_id])
+        if acked:
+            self.client.xack(stream, self.group, *acked)
+        return len(acked)
+
+    def parse(self, stream: str, entries: Iterable[Entry]) -> Tuple[List[Tuple[bytes, commands.Command]], Dict]:
+        """
+        Команды из записей потока и возраст каждой записи; некорректные записи считаются упавшими
+        """
+        parse = self.handlers[stream]
+        parsed, ages = [], {}
+        for entry_id, fields in entries:
+            try:
+                parsed.append((entry_id, parse(json.loads(fields[b'data'] if b'data' in fields else fields['data']))))
+            except Exception:
+                logger.exception('Некорректная запись %s потока %s', entry_id, stream)
+                self.stats.record(0.0, failed=True)
+                continue
+            ages[entry_id] = entry_age(entry_id)
+        return parsed, ages
+
+    def handle_entries(self, stream: str, parsed: List[Tuple[bytes, commands.Command]]) -> List[bytes]:
+        """
+        Передача команд шине группами, возвращает идентификаторы обработанных записей
+        """
+        acked = []
+        for entry_ids, command in coalesce(parsed):
+            acked.extend(self.handle_group(stream, entry_ids, command))
+        return acked
+
+    def handle_group(self, stream: str, entry_ids: List[bytes], command: commands.Command) -> List[bytes]:
+        """
+        Передача группы шине, возвращает идентификаторы обработанных записей
+        Если не удалась команда AllocateMany, ее позиции повторяются по одной, чтобы одна ошибочная запись
+        не возвращала в очередь весь артикул
+        """
+        self.stats.commands += 1
+        try:
+            self.bus.handle(command)
+            return entry_ids
+        except Exception:
+            logger.exception('Ошибка обработки записей %s потока %s', entry_ids, stream)
+        if not isinstance(command, commands.AllocateMany):
+            for _ in entry_ids:
+                self.stats.record(0.0, failed=True)
+            return []
+        handled = []
+        for entry_id, line in zip(entry_ids, command.lines):
+            handled.extend(self.handle_group(stream, [entry_id], line))
+        return handled
+
+    def lag(self) -> Dict[str, Dict]:
+        """
+        Отставание группы по потокам: pending - выданы потребителям и не подтверждены,
+        lag - еще не выданы ни одному потребителю (Redis >= 7)
+        """
+        result = {}
+        for stream in self.handlers:
+            for group in self.client.xinfo_groups(stream):
+                if _decode(group['name']) == self.group:
+                    result[stream] = {'pending': group['pending'], 'lag': group.get('lag')}
+        return result
+
+    def run(self, should_stop: Callable[[], bool] = lambda: False) -> None:
+        self.ensure_groups()
+        last_claim = 0.0
+        while not should_stop():
+            if time.monotonic() - last_claim >= self.claim_idle_ms / 1000:
+                self.claim_stale()
+                last_claim = time.monotonic()
+            self.read_batch()
+
+
+def consumer_name() -> str:
+    return config.redis_settings.redis_consumer_name or f'{socket.gethostname()}-{os.getpid()}'
+
+
+def main():
+    """
+    redis_consumer_workers = 0 - команды обрабатывает сам потребитель, иначе - процессы PartitionedStreamConsumer
+    SIGTERM/SIGINT останавливают чтение после текущей пачки (не позже чем через redis_stream_block_ms)
+    """
+    stop = threading.Event()
+    for signum in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(signum, lambda *args: stop.set())
+
+    client = redis_eventpublisher.get_redis_client()
+    options = dict(
+        group=config.redis_settings.redis_consumer_group,
+        consumer=consumer_name(),
+        **config.get_redis_stream_options()
+    )
+    if config.redis_settings.redis_consumer_workers:
+        from src.allocation.entrypoints.partitioned_consumer import PartitionedStreamConsumer
+        consumer = PartitionedStreamConsumer(
+            client,
+            workers=config.redis_settings.redis_consumer_workers,
+            result_timeout=config.redis_settings.redis_consumer_result_timeout,
+            **options
+        )
+    else:
+        from src.allocation.bootstrap import bus     # шина (и привязка ORM) создается при запуске процесса, а не при импорте
+        consumer = StreamConsumer(client, bus, **options)
+    logger.debug('Consumer %s of group %s reading streams %s', consumer.consumer, consumer.group, list(STREAM_HANDLERS))
+    consumer.run(should_stop=stop.is_set)
 
 
 if __name__ == "__main__":
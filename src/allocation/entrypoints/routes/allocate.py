@@ -1,14 +1,17 @@
-from typing import Dict
+from typing import Dict, List
 
-from fastapi import APIRouter, HTTPException, status
+from fastapi import APIRouter, HTTPException, Query, status
 from fastapi.responses import JSONResponse, ORJSONResponse
 from fastapi.encoders import jsonable_encoder
 
-from src.allocation.domain.api_models import PostAllocateModel, PostDeallocateModel, GetAllocationsModel
+from src.allocation.domain.api_models import (
+    PostAllocateModel, PostAllocateManyModel, PostDeallocateModel, GetAllocationsModel, PostPlanModel
+)
 from src.allocation.domain import commands, models
 from src.allocation.domain.exceptions import InvalidSku
 from src.allocation.bootstrap import bus
-from src.allocation import views
+from src.allocation import views, planner
+from src.allocation.adapters import read_model
 
 allocate_router = APIRouter(tags=["Allocate"])
 
@@ -19,7 +22,7 @@ async def allocate_endpoint(body: PostAllocateModel) -> Dict:
     """
     try:
         command = commands.Allocate(body.orderid, body.sku, body.qty)       # создание экземпляра события размещения заказа
-        result = bus.handle(command)      # передача его cценарий начальной загрузки
+        result = await bus.handle_async(command)      # передача его cценарий начальной загрузки
     except InvalidSku as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -30,6 +33,34 @@ async def allocate_endpoint(body: PostAllocateModel) -> Dict:
         content={'batchref': result.pop(0)}
     )
 
+@allocate_router.post("/bulk")
+async def allocate_many_endpoint(body: PostAllocateManyModel) -> Dict:
+    """
+    Конечная точка для размещения нескольких товарных позиций в одной транзакции
+    Для каждой позиции возвращается ссылка на партию, либо out_of_stock, если товара нет в наличии
+    """
+    try:
+        command = commands.AllocateMany([
+            commands.Allocate(line.orderid, line.sku, line.qty) for line in body.lines
+        ])
+        result = await bus.handle_async(command)
+    except InvalidSku as e:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=str(e))
+
+    batchrefs = result.pop(0)
+    return JSONResponse(
+        status_code=status.HTTP_200_OK,
+        content={'allocations': [
+            {
+                'orderid': line.orderid, 'sku': line.sku, 'qty': line.qty,
+                'batchref': batchref, 'out_of_stock': batchref is None
+            }
+            for line, batchref in zip(body.lines, batchrefs)
+        ]}
+    )
+
 @allocate_router.delete("/")
 async def deallocate_endpoint(body: PostDeallocateModel) -> Dict:
     """
@@ -37,7 +68,7 @@ async def deallocate_endpoint(body: PostDeallocateModel) -> Dict:
     """
     try:
         command = commands.Deallocate(body.orderid, body.sku, body.qty)
-        result = bus.handle(command)
+        result = await bus.handle_async(command)
     except (models.NoOrderInBatch, InvalidSku) as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -49,12 +80,36 @@ async def deallocate_endpoint(body: PostDeallocateModel) -> Dict:
         content={'batchref': result.pop(0)}
     )
 
+async def plan_response(lines: List[models.OrderLine]) -> JSONResponse:
+    result = await planner.plan_async(lines, read_model.default_async_reader(), planner.default_plan_cache())
+    return JSONResponse(status_code=status.HTTP_200_OK, content={'allocations': result})
+
+@allocate_router.post("/plan")
+async def plan_endpoint(body: PostPlanModel) -> Dict:
+    """
+    Конечная точка для пробного размещения корзины: для каждой позиции - партия, в которую она попала бы,
+    или нехватка товара; ничего не записывается и события не порождаются
+    """
+    return await plan_response([models.OrderLine(line.orderid, line.sku, line.qty) for line in body.lines])
+
+@allocate_router.get("/plan")
+async def plan_query_endpoint(sku: List[str] = Query(), qty: List[int] = Query()) -> Dict:
+    """
+    Пробное размещение корзины из параметров запроса: /allocate/plan?sku=LAMP&qty=2&sku=TABLE&qty=1
+    """
+    if len(sku) != len(qty):
+        raise HTTPException(
+            status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+            detail='Число параметров sku и qty должно совпадать'
+        )
+    return await plan_response([models.OrderLine('', s, q) for s, q in zip(sku, qty)])
+
 @allocate_router.get("/{orderid}", response_model=GetAllocationsModel)
 async def allocations_view_endpoint(orderid) -> Dict:
     """
     Конечная точка для просмотра размещенных заказов модели данных для чтения
     """
-    result = views.allocations(orderid, bus.uow)
+    result = await views.allocations_async(orderid, read_model.default_async_reader(), bus.view_cache)
     if not result:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
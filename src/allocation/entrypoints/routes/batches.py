@@ -18,7 +18,7 @@ async def add_batch(body: PostAddBatchModel) -> Dict:
     """
     try:
         command = commands.CreateBatch(body.ref, body.sku, body.qty, body.eta)
-        bus.handle(command)
+        await bus.handle_async(command)
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -0,0 +1,56 @@
+from typing import Dict
+
+from fastapi import APIRouter, status
+from fastapi.responses import JSONResponse
+
+from src.allocation.adapters import read_model
+from src.allocation.service_layer import unit_of_work
+from src.allocation.bootstrap import bus
+
+
+metrics_router = APIRouter(tags=["Metrics"])
+
+@metrics_router.get('/pool')
+async def pool_metrics() -> Dict:
+    """
+    Конечная точка для просмотра состояния пулов соединений с БД: движки записи (UoW) и модели чтения,
+    каждый - асинхронный и синхронный; null - движок в этом процессе не создавался
+    """
+    content = {'write': unit_of_work.pool_status(), 'read': read_model.pool_status()}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+@metrics_router.get('/cascades')
+async def cascade_metrics() -> Dict:
+    """
+    Конечная точка для просмотра статистики каскадов сообщений шины: число сообщений и время на один вызов
+    """
+    return JSONResponse(status_code=status.HTTP_200_OK, content=bus.cascade_metrics.as_dict())
+
+
+@metrics_router.get('/events')
+async def event_dispatcher_metrics() -> Dict:
+    """
+    Конечная точка для просмотра состояния фоновой обработки событий
+    """
+    content = bus.event_dispatcher.stats() if bus.event_dispatcher is not None else {'enabled': False}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+@metrics_router.get('/view-cache')
+async def view_cache_metrics() -> Dict:
+    """
+    Конечная точка для просмотра попаданий и промахов кеша модели чтения
+    """
+    content = bus.view_cache.stats.as_dict() if bus.view_cache is not None else {'enabled': False}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
+
+
+@metrics_router.get('/product-cache')
+async def product_cache_metrics() -> Dict:
+    """
+    Конечная точка для просмотра попаданий кеша агрегатов и сэкономленного на загрузке времени
+    """
+    cache = unit_of_work.default_product_cache()
+    content = cache.stats.as_dict() if cache is not None else {'enabled': False}
+    return JSONResponse(status_code=status.HTTP_200_OK, content=content)
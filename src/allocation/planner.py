@@ -0,0 +1,115 @@
+# Планировщик размещения: куда попали бы позиции корзины и каких не хватит, без записи в БД и без событий
+import threading
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Set
+from sqlalchemy import Date, bindparam
+from sqlalchemy.sql import text
+
+from src.allocation import config
+from src.allocation.adapters.read_model import ReadOnlyDatabase, AsyncReadOnlyDatabase
+from src.allocation.adapters.view_cache import LruTtlCache
+from src.allocation.domain.models import Batch, OrderLine, Product
+
+# Остатки партий запрошенных артикулов одним запросом: позиции не загружаются, их сумма считается на сервере
+BATCH_STOCK = text(
+    'SELECT b.sku, b.reference, b.eta, b._purchased_quantity - COALESCE(SUM(ol.qty), 0) AS available'
+    ' FROM batches b'
+    ' LEFT JOIN allocations a ON a.batch_id = b.id'
+    ' LEFT JOIN order_lines ol ON ol.id = a.orderline_id'
+    ' WHERE b.sku IN :skus'
+    ' GROUP BY b.id, b.sku, b.reference, b.eta, b._purchased_quantity'
+    ' ORDER BY b.id'
+).bindparams(bindparam('skus', expanding=True)).columns(eta=Date)
+
+_plan_cache = None
+_cache_lock = threading.Lock()
+
+
+def default_plan_cache() -> Optional[LruTtlCache]:
+    """
+    Кеш снимков продуктов процесса, None - кеш выключен (planner_cache_enabled)
+    """
+    global _plan_cache
+    if not config.planner_settings.planner_cache_enabled:
+        return None
+    with _cache_lock:
+        if _plan_cache is None:
+            _plan_cache = LruTtlCache(**config.get_planner_cache_options())
+        return _plan_cache
+
+
+def snapshots(skus: Iterable[str], rows) -> Dict[str, Product]:
+    """
+    Снимки продуктов для планирования: партия снимка - остаток реальной партии без размещенных позиций
+    Артикул без партий (в т.ч. неизвестный) - продукт без партий, все его позиции окажутся в дефиците
+    """
+    batches = defaultdict(list)
+    for sku, reference, eta, available in rows:
+        batches[sku].append(Batch(reference, sku, available, eta))
+    return {sku: Product(sku, batches[sku]) for sku in skus}
+
+
+def plan_lines(lines: List[OrderLine], products: Dict[str, Product]) -> List[Dict]:
+    """
+    Позиции размещаются пробно (Product.plan) в порядке корзины, позиции одного артикула - одним планом
+    shortage - сколько товара позиции не хватило: позиция размещается в одной партии целиком или не размещается
+    """
+    lines_by_sku = defaultdict(list)
+    for i, line in enumerate(lines):
+        lines_by_sku[line.sku].append((i, line))
+
+    batchrefs = [None] * len(lines)
+    for sku, numbered in lines_by_sku.items():
+        for (i, _), batchref in zip(numbered, products[sku].plan(line for _, line in numbered)):
+            batchrefs[i] = batchref
+    return [
+        {
+            'orderid': line.orderid, 'sku': line.sku, 'qty': line.qty,
+            'batchref': batchref, 'shortage': 0 if batchref is not None else line.qty
+        }
+        for line, batchref in zip(lines, batchrefs)
+    ]
+
+
+def _cached(skus: Set[str], cache: Optional[LruTtlCache]) -> Dict[str, Product]:
+    products = {}
+    if cache is not None:
+        for sku in skus:
+            product = cache.get(sku)
+            if product is not None:
+                products[sku] = product
+        cache.stats.increment('local_hits', len(products))
+        cache.stats.increment('misses', len(skus) - len(products))
+    return products
+
+
+def _store(products: Dict[str, Product], cache: Optional[LruTtlCache]) -> None:
+    if cache is not None:
+        for sku, product in products.items():
+            product.batch_index     # индекс строится до публикации снимка, дальше снимок только читается
+            cache.set(sku, product)
+
+
+def plan(lines: List[OrderLine], db: ReadOnlyDatabase, cache: Optional[LruTtlCache] = None) -> List[Dict]:
+    """
+    План размещения корзины по текущим остаткам партий (снимок из кеша не старше planner_cache_ttl)
+    """
+    skus = {line.sku for line in lines}
+    products = _cached(skus, cache)
+    missing = skus - products.keys()
+    if missing:
+        loaded = snapshots(missing, db.fetch_all(BATCH_STOCK, skus=list(missing)))
+        _store(loaded, cache)
+        products.update(loaded)
+    return plan_lines(lines, products)
+
+
+async def plan_async(lines: List[OrderLine], db: AsyncReadOnlyDatabase, cache: Optional[LruTtlCache] = None) -> List[Dict]:
+    skus = {line.sku for line in lines}
+    products = _cached(skus, cache)
+    missing = skus - products.keys()
+    if missing:
+        loaded = snapshots(missing, await db.fetch_all(BATCH_STOCK, skus=list(missing)))
+        _store(loaded, cache)
+        products.update(loaded)
+    return plan_lines(lines, products)
@@ -0,0 +1,83 @@
+# Фоновая обработка событий вне пути запроса
+from __future__ import annotations
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from tenacity import stop_after_attempt, wait_exponential
+from typing import Any, Callable, Dict, List, Optional
+from src.allocation.domain import events
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundEventDispatcher:
+    """
+    Пул потоков для обработки событий, порожденных командами: шина возвращает результат команды сразу после
+    ее фиксации, а обработчики событий (публикация в Redis, модель чтения, уведомления) выполняются в пуле
+    со своей политикой повтора retry_attempts / retry_wait_max
+    События одного вызова handle отправляются одной пачкой: рабочий поток обрабатывает ее в одной области
+    message_scope шины (ContextVar-буферы вызывающего потока в пул не переходят)
+    drain - дождаться обработки всех отправленных событий (тесты), shutdown - корректная остановка пула
+    """
+
+    def __init__(self, max_workers: int = 4, retry_attempts: int = 5, retry_wait_max: float = 10.0) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='event-dispatcher')
+        self._idle = threading.Condition()
+        self._pending = 0       # пачки событий, отправленные в пул и еще не обработанные
+        self._closed = False
+        self.retry_policy = dict(
+            stop=stop_after_attempt(retry_attempts),
+            wait=wait_exponential(max=retry_wait_max)
+        )
+        self.submitted = 0
+        self.failed = 0
+
+    def submit(
+            self, handle: Callable[[List[events.Event], Optional[Dict[str, Any]]], Any], batch: List[events.Event]
+    ) -> None:
+        """
+        Отправка пачки событий в пул, handle - метод шины, обрабатывающий пачку (каждое событие с собственным UoW)
+        После shutdown пачка обрабатывается в вызывающем потоке, чтобы не потерять события
+        """
+        with self._idle:
+            if not self._closed:
+                self._pending += 1
+                self.submitted += 1
+                future = self._executor.submit(handle, batch, self.retry_policy)
+                future.add_done_callback(lambda f, batch=batch: self._done(f, batch))
+                return
+        logger.warning('Пул обработки событий остановлен, события %s обрабатываются синхронно', batch)
+        handle(batch, self.retry_policy)
+
+    def _done(self, future: Future, batch: List[events.Event]) -> None:
+        error = future.exception()
+        with self._idle:
+            if error is not None:
+                self.failed += 1
+            self._pending -= 1
+            if self._pending == 0:
+                self._idle.notify_all()
+        if error is not None:
+            logger.error('Фоновая обработка событий %s завершилась ошибкой', batch, exc_info=error)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ожидание, пока не будут обработаны все события, включая порожденные фоновыми обработчиками
+        Возвращает False, если за timeout секунд очередь не опустела
+        """
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending == 0, timeout=timeout)
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        """
+        Остановка пула: новые события больше не принимаются, уже отправленные обрабатываются до конца
+        """
+        drained = self.drain(timeout)
+        with self._idle:
+            self._closed = True
+        self._executor.shutdown(wait=drained)
+        return drained
+
+    def stats(self) -> Dict:
+        with self._idle:
+            return {'submitted': self.submitted, 'pending': self._pending, 'failed': self.failed}
@@ -1,7 +1,7 @@
 from __future__ import annotations
 from dataclasses import asdict
-from typing import TYPE_CHECKING, Callable
-from sqlalchemy.sql import text
+from collections import defaultdict
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
 
 from src.allocation.domain.models import OrderLine, Batch, Product
 from src.allocation.domain.exceptions import InvalidSku
@@ -11,6 +11,43 @@ from src.allocation.adapters import notifications
 if TYPE_CHECKING:   # для разрешения конфликта циклического импорта
     from . import unit_of_work    
 
+# Шаги предметной области команд над уже загруженным продуктом, общие для синхронных и асинхронных обработчиков:
+# обработчики отличаются только работой с UoW и репозиторием
+
+def checked(product: Optional[Product], sku: str) -> Product:
+    if product is None:     # проверка на правильность введенных данных
+        raise InvalidSku(f'Недопустимый артикул {sku}')
+    return product
+
+def allocate_line(product: Optional[Product], line: OrderLine) -> Optional[str]:
+    return checked(product, line.sku).allocate(line)       # вызов службы предметной области
+
+def deallocate_line(product: Optional[Product], line: OrderLine) -> Optional[str]:
+    return checked(product, line.sku).deallocate(line)
+
+def lines_by_sku(cmd: commands.AllocateMany) -> Dict[str, List[Tuple[int, OrderLine]]]:
+    """
+    Позиции команды, сгруппированные по артикулу: артикул -> [(номер позиции в команде, позиция)]
+    """
+    grouped = defaultdict(list)
+    for i, c in enumerate(cmd.lines):
+        grouped[c.sku].append((i, OrderLine(c.orderid, c.sku, c.qty)))
+    return grouped
+
+def allocate_lines(product: Optional[Product], sku: str, lines: List[Tuple[int, OrderLine]], batchrefs: List[Optional[str]]) -> None:
+    product = checked(product, sku)
+    for i, line in lines:
+        batchrefs[i] = product.allocate(line)
+
+def add_batch(products, product: Optional[Product], cmd: commands.CreateBatch) -> None:
+    """
+    products - репозиторий UoW: новый продукт добавляется в него (add синхронный и у асинхронного репозитория)
+    """
+    if product is None:
+        product = Product(cmd.sku, batches=[])
+        products.add(product)
+    product.add_batch(Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))
+
 class AllocateHandler:
     """
     Обработчик размещения товарной позиции в партии
@@ -22,13 +59,27 @@ class AllocateHandler:
     def __call__(self, cmd: commands.Allocate) -> str:
         line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
         with self.uow:
-            product = self.uow.products.get(sku=line.sku)
-            if product is None:     # проверка на правильность введенных данных
-                raise InvalidSku(f'Недопустимый артикул {line.sku}')
-            batchref = product.allocate(line)       # вызов службы предметной области
+            batchref = allocate_line(self.uow.products.get(sku=line.sku), line)
             self.uow.commit()
             return batchref
 
+class AllocateManyHandler:
+    """
+    Обработчик размещения нескольких товарных позиций за одну транзакцию:
+    позиции группируются по артикулу, каждый продукт загружается один раз, фиксация - одна на все позиции
+    """
+
+    def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
+        self.uow = uow
+
+    def __call__(self, cmd: commands.AllocateMany) -> List[Optional[str]]:
+        batchrefs = [None] * len(cmd.lines)     # ссылка на партию для каждой позиции, None - товара нет в наличии
+        with self.uow:
+            for sku, lines in lines_by_sku(cmd).items():
+                allocate_lines(self.uow.products.get(sku=sku), sku, lines, batchrefs)
+            self.uow.commit()
+        return batchrefs
+
 class DeallocateHandler:
     """
     Обработчик события отмены размещения товарной позиции в партии
@@ -40,10 +91,7 @@ class DeallocateHandler:
     def __call__(self, cmd: commands.Deallocate) -> str:
         line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
         with self.uow:
-            product = self.uow.products.get(sku=line.sku)
-            if product is None:     # проверка на правильность введенных данных
-                raise InvalidSku(f'Недопустимый артикул {line.sku}')
-            batchref = product.deallocate(line)
+            batchref = deallocate_line(self.uow.products.get(sku=line.sku), line)
             self.uow.commit()
         return batchref
 
@@ -57,11 +105,7 @@ class AddBatchHandler:
 
     def __call__(self, cmd: commands.CreateBatch) -> None:
         with self.uow:
-            product = self.uow.products.get(sku=cmd.sku)
-            if product is None:
-                product = Product(cmd.sku, batches=[])
-                self.uow.products.add(product)
-            product.batches.append(Batch(cmd.ref, cmd.sku, cmd.qty, cmd.eta))    
+            add_batch(self.uow.products, self.uow.products.get(sku=cmd.sku), cmd)
             self.uow.commit()
 
 class ChangeBatchQuantityHandler:
@@ -103,47 +147,93 @@ class PublishAllocatedEventHandler:
     def __call__(self, event: events.Allocated) -> None:
         self.publish(event)
 
-class AddAllocationToReadModelHandler:
+class Reallocatehandler:
+    """
+    Обработчик события отмены размещения заказа для его повторного размещения
     """
-    Обработчик события регистрации события размещения заказа для обновление модели чтения данных
-    """   
 
     def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
         self.uow = uow
-    
-    def __call__(self, event: events.Allocated) -> None:
+
+    def __call__(self, event: events.Deallocated) -> None:
         with self.uow:
-            self.uow.session.execute(text(
-                'INSERT INTO allocations_view (orderid, sku, batchref)'
-                ' VALUES (:orderid, :sku, :batchref)'
-            ).bindparams(orderid=event.orderid, sku=event.sku, batchref=event.batchref))
+            product = self.uow.products.get(sku=event.sku)
+            product.events.append(commands.Allocate(**asdict(event)))
             self.uow.commit()
 
-class RemoveAllocationFromReadModelHandler:
+
+# Асинхронные версии обработчиков, работающих с БД, для AbstractAsyncUnitOfWork
+# Шаги предметной области общие с синхронными обработчиками, асинхронны только операции UoW и репозитория
+
+class AsyncAllocateHandler:
     """
-    Обработичк события отмены размещения заказа для обновления модели чтения данных
+    Асинхронный обработчик размещения товарной позиции в партии
     """
 
-    def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    def __init__(self, uow: unit_of_work.AbstractAsyncUnitOfWork) -> None:
         self.uow = uow
 
-    def __call__(self, event: events.Deallocated) -> None:
-        with self.uow:
-            self.uow.session.execute(text(
-                'DELETE FROM allocations_view WHERE orderid = :orderid AND sku = :sku'
-            ).bindparams(orderid=event.orderid, sku=event.sku))
-            self.uow.commit()
+    async def __call__(self, cmd: commands.Allocate) -> str:
+        line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+        async with self.uow:
+            batchref = allocate_line(await self.uow.products.get(sku=line.sku), line)
+            await self.uow.commit()
+            return batchref
 
-class Reallocatehandler:
+class AsyncAllocateManyHandler:
     """
-    Обработчик события отмены размещения заказа для его повторного размещения
+    Асинхронный обработчик размещения нескольких товарных позиций за одну транзакцию
     """
 
-    def __init__(self, uow: unit_of_work.AbstractUnitOfWork) -> None:
+    def __init__(self, uow: unit_of_work.AbstractAsyncUnitOfWork) -> None:
         self.uow = uow
 
-    def __call__(self, event: events.Deallocated) -> None:
-        with self.uow:
-            product = self.uow.products.get(sku=event.sku)
-            product.events.append(commands.Allocate(**asdict(event)))
-            self.uow.commit()
\ No newline at end of file
+    async def __call__(self, cmd: commands.AllocateMany) -> List[Optional[str]]:
+        batchrefs = [None] * len(cmd.lines)
+        async with self.uow:
+            for sku, lines in lines_by_sku(cmd).items():
+                allocate_lines(await self.uow.products.get(sku=sku), sku, lines, batchrefs)
+            await self.uow.commit()
+        return batchrefs
+
+class AsyncDeallocateHandler:
+    """
+    Асинхронный обработчик отмены размещения товарной позиции в партии
+    """
+
+    def __init__(self, uow: unit_of_work.AbstractAsyncUnitOfWork) -> None:
+        self.uow = uow
+
+    async def __call__(self, cmd: commands.Deallocate) -> str:
+        line = OrderLine(cmd.orderid, cmd.sku, cmd.qty)
+        async with self.uow:
+            batchref = deallocate_line(await self.uow.products.get(sku=line.sku), line)
+            await self.uow.commit()
+        return batchref
+
+class AsyncAddBatchHandler:
+    """
+    Асинхронный обработчик пополнения товарных запасов партии
+    """
+
+    def __init__(self, uow: unit_of_work.AbstractAsyncUnitOfWork) -> None:
+        self.uow = uow
+
+    async def __call__(self, cmd: commands.CreateBatch) -> None:
+        async with self.uow:
+            add_batch(self.uow.products, await self.uow.products.get(sku=cmd.sku), cmd)
+            await self.uow.commit()
+
+class AsyncChangeBatchQuantityHandler:
+    """
+    Асинхронный обработчик изменения размера партии
+    """
+
+    def __init__(self, uow: unit_of_work.AbstractAsyncUnitOfWork) -> None:
+        self.uow = uow
+
+    async def __call__(self, cmd: commands.ChangeBatchQuantity) -> None:
+        async with self.uow:
+            product = await self.uow.products.get_by_batchref(batchref=cmd.ref)
+            product.change_batch_quantity(ref=cmd.ref, qty=cmd.qty)
+            await self.uow.commit()
@@ -1,16 +1,139 @@
 # Шина сообщений
 from __future__ import annotations
+import asyncio
+import inspect
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
-from tenacity import Retrying, RetryError, stop_after_attempt, wait_exponential
-from typing import TYPE_CHECKING, Dict, Type, List, Callable, Union
+from collections import deque
+from contextlib import nullcontext
+from tenacity import (
+    AsyncRetrying, Retrying, RetryError, retry_if_exception_type,
+    stop_after_attempt, wait_exponential, wait_random_exponential
+)
+from typing import TYPE_CHECKING, Any, AsyncContextManager, ContextManager, Deque, Dict, Iterable, Type, List, Callable, Union, Tuple, Optional
 from src.allocation.domain import events, commands
+from src.allocation.domain.exceptions import ConcurrencyConflict
 
 if TYPE_CHECKING:
     from . import unit_of_work
+    from .dispatcher import BackgroundEventDispatcher
+    from src.allocation.adapters.view_cache import ViewCache
 
 logger = logging.getLogger(__name__)
 Message = Union[commands.Command, events.Event]     # message - команда либо событие
+EventHandlers = Dict[Type[events.Event], List[Callable]]
+CommandHandlers = Dict[Type[commands.Command], Callable]
+# Фабрика обработчиков: внедряет в обработчики UoW конкретного вызова handle/handle_async
+HandlersFactory = Callable[[Any], Tuple[EventHandlers, CommandHandlers]]
+
+
+class CascadeLimitExceeded(Exception):
+    """
+    Исключение, если сообщение породило слишком длинный или слишком глубокий каскад событий и команд
+    Сообщения, обработанные до превышения предела, остаются зафиксированными
+    """
+    pass
+
+
+class MessageQueue:
+    """
+    Очередь сообщений одного вызова handle: FIFO на deque (O(1) на операцию),
+    для каждого сообщения хранится глубина каскада - 0 у исходного, +1 у порожденных при его обработке
+    """
+
+    def __init__(
+            self, message: Message, max_depth: int, max_length: int, event_retry: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self._queue: Deque[Tuple[Message, int]] = deque([(message, 0)])
+        self.root = message
+        self.event_retry = event_retry      # параметры повтора обработчиков событий этого вызова, None - политика шины
+        self.max_depth = max_depth
+        self.max_length = max_length
+        self.depth = 0          # глубина текущего обрабатываемого сообщения
+        self.max_depth_reached = 0
+        self.enqueued = 1       # сколько сообщений всего попало в очередь за вызов handle
+        self.started = time.perf_counter()
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def extend(self, messages: Iterable[Message]) -> None:
+        depth = self.depth + 1
+        for message in messages:
+            self._queue.append((message, depth))
+            self.enqueued += 1
+
+    def popleft(self) -> Message:
+        message, self.depth = self._queue.popleft()
+        self.max_depth_reached = max(self.max_depth_reached, self.depth)
+        if self.depth > self.max_depth:
+            raise CascadeLimitExceeded(f'{self.root} породило каскад глубже {self.max_depth} уровней')
+        if self.enqueued > self.max_length:
+            raise CascadeLimitExceeded(f'{self.root} породило каскад длиннее {self.max_length} сообщений')
+        return message
+
+    def stats(self) -> Dict:
+        return {
+            'message': type(self.root).__name__,
+            'messages': self.enqueued,
+            'depth': self.max_depth_reached,
+            'seconds': time.perf_counter() - self.started,
+        }
+
+
+class CascadeMetrics:
+    """
+    Статистика каскадов по вызовам handle/handle_async: во сколько сообщений развернулось исходное и сколько это заняло
+    recent - последние вызовы, остальное - накопленные значения
+    """
+
+    def __init__(self, recent: int = 100) -> None:
+        self._lock = threading.Lock()
+        self.recent: Deque[Dict] = deque(maxlen=recent)
+        self.handled = 0
+        self.limit_exceeded = 0
+        self.total_messages = 0
+        self.max_messages = 0
+        self.max_depth = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def record(self, stats: Dict, limit_exceeded: bool = False) -> None:
+        with self._lock:
+            self.recent.append(stats)
+            self.handled += 1
+            self.limit_exceeded += limit_exceeded
+            self.total_messages += stats['messages']
+            self.max_messages = max(self.max_messages, stats['messages'])
+            self.max_depth = max(self.max_depth, stats['depth'])
+            self.total_seconds += stats['seconds']
+            self.max_seconds = max(self.max_seconds, stats['seconds'])
+
+    def as_dict(self) -> Dict:
+        with self._lock:
+            return {
+                'handled': self.handled,
+                'limit_exceeded': self.limit_exceeded,
+                'total_messages': self.total_messages,
+                'avg_messages': self.total_messages / self.handled if self.handled else 0.0,
+                'max_messages': self.max_messages,
+                'max_depth': self.max_depth,
+                'avg_seconds': self.total_seconds / self.handled if self.handled else 0.0,
+                'max_seconds': self.max_seconds,
+                'recent': list(self.recent),
+            }
+
+
+async def call_handler(handler: Callable, message: Message):
+    """
+    Вызов обработчика из асинхронного кода: корутины ожидаются в цикле событий,
+    синхронные обработчики (отправка уведомлений, публикация в Redis) выполняются в пуле потоков
+    """
+    if inspect.iscoroutinefunction(handler) or inspect.iscoroutinefunction(getattr(handler, '__call__', None)):
+        return await handler(message)
+    return await asyncio.to_thread(handler, message)
 
 class AbstractMessageBus(ABC):
     """
@@ -18,24 +141,22 @@ class AbstractMessageBus(ABC):
     """
     def __init__(
             self,
-            uow: unit_of_work.AbstractUnitOfWork,
-            event_handlers: Dict[Type[events.Event], List[Callable]],
-            command_handlers: Dict[Type[commands.Command], Callable]
+            uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+            handlers: HandlersFactory
     ) -> None:
-        self.uow = uow
-        self.event_handlers = event_handlers
-        self.command_handlers = command_handlers
+        self.uow_factory = uow_factory
+        self.handlers = handlers
 
     @abstractmethod
     def handle(self, message: Message):
         raise NotImplementedError
 
     @abstractmethod
-    def handle_event(self, event: events.Event):
+    def handle_event(self, event: events.Event, uow, event_handlers: EventHandlers, queue: MessageQueue):
         raise NotImplementedError
 
     @abstractmethod
-    def handle_command(self, command: commands.Command):
+    def handle_command(self, command: commands.Command, uow, command_handlers: CommandHandlers, queue: MessageQueue):
         raise NotImplementedError
 
 
@@ -43,56 +164,230 @@ class AbstractMessageBus(ABC):
 class MessageBus(AbstractMessageBus):
     """
     Реальная шина сообщений
+    Каждый вызов handle получает от uow_factory собственный UoW, а от handlers - обработчики с этим UoW,
+    поэтому шину можно вызывать одновременно из нескольких потоков
+    uow - UoW, внедренный напрямую вместо фабрики (используется тестами для доступа к фейковому хранилищу)
+    max_conflict_attempts - сколько раз выполнять команду, если ее фиксация упала с ConcurrencyConflict
+    max_cascade_depth, max_cascade_length - пределы каскада сообщений одного вызова handle (см. CascadeLimitExceeded)
+    event_dispatcher - пул фоновой обработки событий: если задан, события, порожденные командами,
+    обрабатываются в нем, и handle возвращает результат сразу после фиксации команды
+    message_scope, async_message_scope - фабрики контекстных менеджеров, охватывающих один вызов handle/handle_async
+    (например, буфер событий модели чтения, применяемый одной транзакцией)
+    view_cache - кеш модели чтения, который обновляют обработчики событий и читают представления
     """
     
     def __init__(
         self,
-        uow: unit_of_work.AbstractUnitOfWork,
-        event_handlers: Dict[Type[events.Event], List[Callable]],
-        command_handlers: Dict[Type[commands.Command], Callable]
+        uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+        handlers: HandlersFactory,
+        async_uow_factory: Optional[Callable[[], unit_of_work.AbstractAsyncUnitOfWork]] = None,
+        async_handlers: Optional[HandlersFactory] = None,
+        uow: Optional[unit_of_work.AbstractUnitOfWork] = None,
+        max_conflict_attempts: int = 3,
+        max_cascade_depth: int = 100,
+        max_cascade_length: int = 100_000,
+        event_dispatcher: Optional[BackgroundEventDispatcher] = None,
+        view_cache: Optional[ViewCache] = None,
+        message_scope: Callable[[], ContextManager] = nullcontext,
+        async_message_scope: Callable[[], AsyncContextManager] = nullcontext
     ) -> None:
+        self.uow_factory = uow_factory
+        self.handlers = handlers
+        self.async_uow_factory = async_uow_factory
+        self.async_handlers = async_handlers
         self.uow = uow
-        self.event_handlers = event_handlers
-        self.command_handlers = command_handlers
+        self.max_conflict_attempts = max_conflict_attempts
+        self.max_cascade_depth = max_cascade_depth
+        self.max_cascade_length = max_cascade_length
+        self.cascade_metrics = CascadeMetrics()
+        self.event_dispatcher = event_dispatcher
+        self.view_cache = view_cache
+        self.message_scope = message_scope
+        self.async_message_scope = async_message_scope
 
-    def handle(self, message: Message):
+    def new_queue(self, message: Message, event_retry: Optional[Dict[str, Any]] = None) -> MessageQueue:
+        return MessageQueue(message, self.max_cascade_depth, self.max_cascade_length, event_retry)
+
+    def event_retry_policy(self, queue: MessageQueue) -> Dict[str, Any]:
+        """
+        Повторение обработчика события до 3 раз с экспоненциально увеличивающимся ожиданием между попытками,
+        если вызов handle не задал свою политику (фоновая обработка)
+        """
+        return queue.event_retry or dict(stop=stop_after_attempt(3), wait=wait_exponential())
+
+    def dispatches_in_background(self, queue: MessageQueue) -> bool:
+        """
+        Событие, порожденное при обработке сообщения, уходит в фоновый пул; исходное событие вызова handle
+        (в т.ч. в самом пуле) обрабатывается на месте
+        """
+        return self.event_dispatcher is not None and queue.depth > 0
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """
+        Ожидание завершения фоновой обработки событий (для тестов)
+        """
+        return self.event_dispatcher.drain(timeout) if self.event_dispatcher is not None else True
+
+    def shutdown(self, timeout: Optional[float] = None) -> bool:
+        return self.event_dispatcher.shutdown(timeout) if self.event_dispatcher is not None else True
+
+    def record_cascade(self, queue: MessageQueue, limit_exceeded: bool = False) -> None:
+        stats = queue.stats()
+        logger.debug('cascade of %s: %s messages, depth %s, %.4fs', stats['message'], stats['messages'], stats['depth'], stats['seconds'])
+        self.cascade_metrics.record(stats, limit_exceeded)
+
+    def handle(self, message: Message, event_retry: Optional[Dict[str, Any]] = None):
+        with self.message_scope():
+            return self._handle(message, event_retry)
+
+    def handle_batch(self, batch: List[events.Event], event_retry: Optional[Dict[str, Any]] = None) -> None:
+        """
+        Фоновая обработка событий одного вызова handle (см. BackgroundEventDispatcher) в одной области message_scope:
+        модель чтения применяет всю пачку одной транзакцией, как и при обработке на месте
+        Сбой одного события не мешает обработке остальных, первая ошибка поднимается после всей пачки
+        """
+        error = None
+        with self.message_scope():
+            for event in batch:
+                try:
+                    self._handle(event, event_retry)
+                except Exception as e:
+                    logger.exception('Exception handling event %s', event)
+                    error = error or e
+        if error is not None:
+            raise error
+
+    def _submit(self, batch: List[events.Event]) -> None:
+        if batch:
+            self.event_dispatcher.submit(self.handle_batch, batch)
+
+    def _handle(self, message: Message, event_retry: Optional[Dict[str, Any]] = None):
         results = []        # временно: ссылка на размещенную партию
-        self.queue = [message]     # очередь сообщений
-        while self.queue:
-            message = self.queue.pop(0)
-            if isinstance(message, events.Event):
-                self.handle_event(message)
-            elif isinstance(message, commands.Command):
-                cmd_result = self.handle_command(message)
-                results.append(cmd_result)
-            else:
-                raise Exception(f'{message} was not an Event or Command')
-        
+        uow = self.uow_factory()
+        event_handlers, command_handlers = self.handlers(uow)
+        queue = self.new_queue(message, event_retry)     # очередь сообщений
+        background = []     # события для фонового пула, отправляются одной пачкой после обработки вызова
+        try:
+            while queue:
+                message = queue.popleft()
+                if isinstance(message, events.Event) and self.dispatches_in_background(queue):
+                    background.append(message)
+                elif isinstance(message, events.Event):
+                    self.handle_event(message, uow, event_handlers, queue)
+                elif isinstance(message, commands.Command):
+                    cmd_result = self.handle_command(message, uow, command_handlers, queue)
+                    results.append(cmd_result)
+                else:
+                    raise Exception(f'{message} was not an Event or Command')
+        except CascadeLimitExceeded:
+            self.record_cascade(queue, limit_exceeded=True)
+            raise
+        finally:
+            self._submit(background)    # события уже зафиксированных команд не теряются и при ошибке
+        self.record_cascade(queue)
         return results
 
-    def handle_event(self, event: events.Event):
-        for handler in self.event_handlers[type(event)]:
+    def handle_event(self, event: events.Event, uow, event_handlers: EventHandlers, queue: MessageQueue):
+        for handler in event_handlers[type(event)]:
             try:
-                for attempt in Retrying(        # повторение операций до 3 раз с экспоненциально увеличивающимся ожиданием между попытками
-                    stop=stop_after_attempt(3),
-                    wait=wait_exponential()
-                ):
+                for attempt in Retrying(**self.event_retry_policy(queue)):
                     with attempt:
                         logger.debug('handling event %s with handler %s', event, handler)
                         handler(event)
-                        self.queue.extend(self.uow.collect_new_events())
+                        queue.extend(uow.collect_new_events())
             except RetryError as retry_failure:
                 logger.error('Не получилось обработать событие %s %s раз, отказ!', event, retry_failure.last_attempt.attempt_number)
                 continue
     
-    def handle_command(self, command: commands.Command):
+    def conflict_retry_policy(self, command: commands.Command, uow) -> Dict[str, Any]:
+        """
+        Параметры повтора команды при ConcurrencyConflict: обработчик заново загружает продукт в новом сеансе,
+        ожидание со случайным разбросом разводит конкурирующие транзакции во времени
+        События неудачной попытки отбрасываются, чтобы не обработать их дважды
+        """
+        def discard_events(retry_state):
+            for _ in uow.collect_new_events():
+                pass
+            logger.warning(
+                'Конфликт параллельного изменения при обработке %s, попытка %s', command, retry_state.attempt_number
+            )
+
+        return dict(
+            retry=retry_if_exception_type(ConcurrencyConflict),
+            stop=stop_after_attempt(self.max_conflict_attempts),
+            wait=wait_random_exponential(multiplier=0.01, max=0.2),
+            before_sleep=discard_events,
+            reraise=True
+        )
+
+    def handle_command(self, command: commands.Command, uow, command_handlers: CommandHandlers, queue: MessageQueue):
         logger.debug('handling command %s', command)
         try:
-            handler = self.command_handlers[type(command)]
-            result = handler(command)
-            self.queue.extend(self.uow.collect_new_events())
+            handler = command_handlers[type(command)]
+            for attempt in Retrying(**self.conflict_retry_policy(command, uow)):
+                with attempt:
+                    result = handler(command)
+            queue.extend(uow.collect_new_events())
             return result
         except Exception:
             logger.exception('Exception handling command %s', command)
             raise
 
+    async def handle_async(self, message: Message):
+        """
+        Асинхронная обработка сообщения для вызова из цикла событий (маршруты FastAPI)
+        Каждый вызов получает собственный асинхронный UoW и очередь, поэтому параллельные запросы не мешают друг другу
+        С event_dispatcher события команды уходят в пул потоков одной пачкой и обрабатываются синхронным путем (handle_batch)
+        """
+        if self.async_uow_factory is None or self.async_handlers is None:
+            raise RuntimeError('Асинхронная обработка сообщений не настроена в bootstrap')
+        uow = self.async_uow_factory()
+        event_handlers, command_handlers = self.async_handlers(uow)
+        results = []
+        queue = self.new_queue(message)
+        background = []
+        async with self.async_message_scope():
+            try:
+                while queue:
+                    message = queue.popleft()
+                    if isinstance(message, events.Event) and self.dispatches_in_background(queue):
+                        background.append(message)
+                    elif isinstance(message, events.Event):
+                        await self.handle_event_async(message, uow, event_handlers, queue)
+                    elif isinstance(message, commands.Command):
+                        cmd_result = await self.handle_command_async(message, uow, command_handlers, queue)
+                        results.append(cmd_result)
+                    else:
+                        raise Exception(f'{message} was not an Event or Command')
+            except CascadeLimitExceeded:
+                self.record_cascade(queue, limit_exceeded=True)
+                raise
+            finally:
+                self._submit(background)
+        self.record_cascade(queue)
+        return results
+
+    async def handle_event_async(self, event: events.Event, uow, event_handlers: EventHandlers, queue: MessageQueue):
+        for handler in event_handlers[type(event)]:
+            try:
+                async for attempt in AsyncRetrying(**self.event_retry_policy(queue)):     # ожидание между попытками не блокирует цикл событий
+                    with attempt:
+                        logger.debug('handling event %s with handler %s', event, handler)
+                        await call_handler(handler, event)
+                        queue.extend(uow.collect_new_events())
+            except RetryError as retry_failure:
+                logger.error('Не получилось обработать событие %s %s раз, отказ!', event, retry_failure.last_attempt.attempt_number)
+                continue
+
+    async def handle_command_async(self, command: commands.Command, uow, command_handlers: CommandHandlers, queue: MessageQueue):
+        logger.debug('handling command %s', command)
+        try:
+            handler = command_handlers[type(command)]
+            async for attempt in AsyncRetrying(**self.conflict_retry_policy(command, uow)):
+                with attempt:
+                    result = await call_handler(handler, command)
+            queue.extend(uow.collect_new_events())
+            return result
+        except Exception:
+            logger.exception('Exception handling command %s', command)
+            raise
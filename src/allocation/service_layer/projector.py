@@ -0,0 +1,154 @@
+# Проекция событий размещения в модель чтения allocations_view
+from __future__ import annotations
+import logging
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Tuple, Union
+from sqlalchemy.sql import text
+from tenacity import AsyncRetrying, Retrying, stop_after_attempt, wait_exponential
+
+from src.allocation.adapters.view_cache import ViewCache
+from src.allocation.domain import events
+
+if TYPE_CHECKING:
+    from . import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+ReadModelEvent = Union[events.Allocated, events.Deallocated]
+
+# Вставка идемпотентна: повтор события (или повторное размещение позиции) обновляет batchref существующей строки
+UPSERT_ALLOCATIONS = text(
+    'INSERT INTO allocations_view (orderid, sku, qty, batchref) VALUES (:orderid, :sku, :qty, :batchref)'
+    ' ON CONFLICT (orderid, sku, qty) DO UPDATE SET batchref = excluded.batchref'
+)
+DELETE_ALLOCATIONS = text('DELETE FROM allocations_view WHERE orderid = :orderid AND sku = :sku AND qty = :qty')
+
+
+def net_changes(new_events: Iterable[ReadModelEvent]) -> Tuple[List[Dict], List[Dict]]:
+    """
+    Итоговые изменения модели чтения по событиям в порядке их появления: для каждой позиции (orderid, sku, qty)
+    важно только последнее событие - Allocated дает строку для вставки, Deallocated - для удаления
+    """
+    last: Dict[Tuple[str, str, int], ReadModelEvent] = {}
+    for event in new_events:
+        last[(event.orderid, event.sku, event.qty)] = event
+    upserts = [
+        {'orderid': e.orderid, 'sku': e.sku, 'qty': e.qty, 'batchref': e.batchref}
+        for e in last.values() if isinstance(e, events.Allocated)
+    ]
+    deletes = [
+        {'orderid': e.orderid, 'sku': e.sku, 'qty': e.qty}
+        for e in last.values() if isinstance(e, events.Deallocated)
+    ]
+    return upserts, deletes
+
+
+class ReadModelProjector:
+    """
+    Обработчик событий Allocated/Deallocated для модели чтения
+    Внутри message_scope (один вызов MessageBus.handle) события накапливаются и при выходе из области
+    применяются одной транзакцией: одно DELETE и одно INSERT ... ON CONFLICT на весь набор строк (executemany)
+    Вне области событие применяется сразу отдельной транзакцией
+    cache - кеш модели чтения, заказы измененных строк инвалидируются после фиксации
+    """
+
+    def __init__(
+            self,
+            uow_factory: Callable[[], unit_of_work.AbstractUnitOfWork],
+            async_uow_factory: Optional[Callable[[], unit_of_work.AbstractAsyncUnitOfWork]] = None,
+            cache: Optional[ViewCache] = None,
+            retry_attempts: int = 3
+    ) -> None:
+        self.uow_factory = uow_factory
+        self.async_uow_factory = async_uow_factory
+        self.cache = cache
+        self.retry_policy = dict(stop=stop_after_attempt(retry_attempts), wait=wait_exponential(max=1), reraise=True)
+        self._buffer: ContextVar[Optional[List[ReadModelEvent]]] = ContextVar('read_model_buffer', default=None)
+
+    def __call__(self, event: ReadModelEvent) -> None:
+        buffer = self._buffer.get()
+        if buffer is not None:
+            buffer.append(event)
+        else:
+            self.apply([event])
+
+    async def project_async(self, event: ReadModelEvent) -> None:
+        buffer = self._buffer.get()
+        if buffer is not None:
+            buffer.append(event)
+        else:
+            await self.apply_async([event])
+
+    def apply(self, new_events: List[ReadModelEvent]) -> None:
+        upserts, deletes = net_changes(new_events)
+        uow = self.uow_factory()
+        with uow:
+            if deletes:
+                uow.session.execute(DELETE_ALLOCATIONS, deletes)
+            if upserts:
+                uow.session.execute(UPSERT_ALLOCATIONS, upserts)
+            uow.commit()
+        self._invalidate(upserts + deletes)
+
+    async def apply_async(self, new_events: List[ReadModelEvent]) -> None:
+        upserts, deletes = net_changes(new_events)
+        uow = self.async_uow_factory()
+        async with uow:
+            if deletes:
+                await uow.session.execute(DELETE_ALLOCATIONS, deletes)
+            if upserts:
+                await uow.session.execute(UPSERT_ALLOCATIONS, upserts)
+            await uow.commit()
+        if self.cache is not None:
+            for orderid in {row['orderid'] for row in upserts + deletes}:
+                await self.cache.async_invalidate(orderid)
+
+    def _invalidate(self, rows: List[Dict]) -> None:
+        if self.cache is not None:
+            for orderid in {row['orderid'] for row in rows}:
+                self.cache.invalidate(orderid)
+
+    def _flush_scope(self, buffer: List[ReadModelEvent]) -> None:
+        """
+        Изменения, породившие события, уже зафиксированы, поэтому сбой записи модели чтения
+        после retry_attempts попыток логируется, а не превращается в ошибку запроса
+        """
+        if not buffer:
+            return
+        try:
+            for attempt in Retrying(**self.retry_policy):
+                with attempt:
+                    self.apply(buffer)
+        except Exception:
+            logger.exception('Не удалось обновить модель чтения по %s событиям', len(buffer))
+
+    async def _flush_scope_async(self, buffer: List[ReadModelEvent]) -> None:
+        if not buffer:
+            return
+        try:
+            async for attempt in AsyncRetrying(**self.retry_policy):
+                with attempt:
+                    await self.apply_async(buffer)
+        except Exception:
+            logger.exception('Не удалось обновить модель чтения по %s событиям', len(buffer))
+
+    @contextmanager
+    def message_scope(self):
+        buffer = []
+        token = self._buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            self._buffer.reset(token)
+            self._flush_scope(buffer)
+
+    @asynccontextmanager
+    async def async_message_scope(self):
+        buffer = []
+        token = self._buffer.set(buffer)
+        try:
+            yield buffer
+        finally:
+            self._buffer.reset(token)
+            await self._flush_scope_async(buffer)
@@ -1,15 +1,99 @@
+import threading
 from abc import ABC, abstractmethod
-from sqlalchemy import create_engine
+from typing import Dict, Optional
+from sqlalchemy import create_engine, exc, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
+from sqlalchemy.orm.exc import StaleDataError
 
 from src.allocation import config
-from src.allocation.adapters import repository
+from src.allocation.adapters import repository, db_pool, orm, outbox
+from src.allocation.adapters.product_cache import CachingProductRepository, ProductCache
+from src.allocation.domain.exceptions import ConcurrencyConflict
 
 
-DEFAULT_SESSION_FACTORY = sessionmaker(bind=create_engine(
-    config.get_postgres_uri(),
-    isolation_level="REPEATABLE READ",      # уровень изоляции сеанса для соблюдения правил параллелизма
-    ))
+_engine = None      # движок и фабрика сеансов создаются при первом использовании, а не при импорте
+_session_factory = None
+_async_engine = None
+_async_session_factory = None
+_product_cache = None
+_engine_lock = threading.Lock()
+SERIALIZATION_FAILURE = '40001'     # SQLSTATE: could not serialize access due to concurrent update
+
+
+def get_engine() -> Engine:
+    global _engine
+    with _engine_lock:
+        if _engine is None:
+            _engine = create_engine(
+                config.get_postgres_uri(),
+                isolation_level="REPEATABLE READ",      # уровень изоляции сеанса для соблюдения правил параллелизма
+                poolclass=db_pool.InstrumentedQueuePool,
+                **config.get_postgres_pool_options()
+            )
+        return _engine
+
+
+def default_session_factory() -> sessionmaker:
+    global _session_factory
+    if _session_factory is None:
+        _session_factory = sessionmaker(bind=get_engine())
+    return _session_factory
+
+
+def get_async_engine() -> AsyncEngine:
+    global _async_engine
+    with _engine_lock:
+        if _async_engine is None:
+            _async_engine = create_async_engine(
+                config.get_postgres_uri(driver='asyncpg'),
+                isolation_level="REPEATABLE READ",
+                poolclass=db_pool.InstrumentedAsyncAdaptedQueuePool,
+                **config.get_postgres_pool_options()
+            )
+        return _async_engine
+
+
+def default_async_session_factory() -> sessionmaker:
+    global _async_session_factory
+    if _async_session_factory is None:
+        _async_session_factory = sessionmaker(
+            bind=get_async_engine(),
+            class_=AsyncSession,
+            expire_on_commit=False,     # после фиксации атрибуты нельзя перечитать неявно, без await
+        )
+    return _async_session_factory
+
+
+def default_product_cache() -> Optional[ProductCache]:
+    """
+    Кеш агрегатов процесса, None - кеш выключен (product_cache_enabled)
+    """
+    global _product_cache
+    if not config.product_cache_settings.product_cache_enabled:
+        return None
+    with _engine_lock:
+        if _product_cache is None:
+            _product_cache = ProductCache(**config.get_product_cache_options())
+        return _product_cache
+
+
+def pool_status() -> Dict:
+    """
+    Пулы основного движка: асинхронный обслуживает маршруты API, синхронный - потребителей и фоновые процессы
+    """
+    return db_pool.pools_status(**{'async': _async_engine, 'sync': _engine})
+
+
+def is_concurrency_conflict(error: Exception) -> bool:
+    """
+    Ошибка фиксации из-за параллельного изменения агрегата:
+    UPDATE с проверкой версии не затронул строку либо PostgreSQL отменил транзакцию (REPEATABLE READ / SERIALIZABLE)
+    """
+    if isinstance(error, StaleDataError):
+        return True
+    return isinstance(error, exc.DBAPIError) and getattr(error.orig, 'pgcode', None) == SERIALIZATION_FAILURE
 
 
 class AbstractUnitOfWork(ABC):  # Абстрактный контекстный менеджер
@@ -24,10 +108,16 @@ class AbstractUnitOfWork(ABC):  # Абстрактный контекстный
     def commit(self):
         self._commit()
 
+    def outbox_rows(self):
+        """
+        Строки outbox для событий загруженных агрегатов, еще не переданных шине
+        """
+        return outbox.outbox_rows(event for product in self.products.seen for event in product.events)
+
     def collect_new_events(self):       # UoW делает теперь события доступными
         for product in self.products.seen: 
             while product.events:
-                yield product.events.pop(0)
+                yield product.events.popleft()
 
     @abstractmethod
     def _commit(self):
@@ -40,24 +130,126 @@ class AbstractUnitOfWork(ABC):  # Абстрактный контекстный
 
 class SqlAlchemyUnitOfWork(AbstractUnitOfWork):     # Реализация абстракции UoW
     
-    def __init__(self, session_factory=DEFAULT_SESSION_FACTORY) -> None:
-        self.session_factory = session_factory
+    def __init__(
+            self,
+            session_factory=None,
+            loading_strategy: str = None,
+            lock_policy: repository.ProductLockPolicy = None,
+            product_cache: Optional[ProductCache] = None
+    ) -> None:
+        """
+        product_cache - кеш агрегатов между вызовами UoW (см. CachingProductRepository),
+        None - кеш процесса по настройкам product_cache_* (по умолчанию выключен)
+        """
+        self.session_factory = session_factory      # None - фабрика по умолчанию, создается при первом входе в блок with
+        self.loading_strategy = loading_strategy or config.db_settings.db_loading_strategy
+        if self.loading_strategy not in repository.LOADING_STRATEGIES:
+            raise ValueError(f'Неизвестная стратегия загрузки {self.loading_strategy}')
+        self.lock_policy = lock_policy or repository.ProductLockPolicy(**config.get_product_lock_options())
+        self.product_cache = product_cache if product_cache is not None else default_product_cache()
 
     def __enter__(self):
         """
         Запуск сеанс БД и создание экземпляра реального репозитория
         """
+        if self.session_factory is None:
+            self.session_factory = default_session_factory()
         self.session = self.session_factory() # тип: Session
-        self.products = repository.SqlAlchemyRepository(self.session)
+        self.products = repository.SqlAlchemyRepository(self.session, self.loading_strategy, self.lock_policy)
+        self.committed = False
+        if self.product_cache is not None:
+            # агрегаты из кеша должны сохранить состояние после фиксации и закрытия сеанса
+            self.session.expire_on_commit = False
+            self.products = CachingProductRepository(self.products, self.product_cache)
         return super().__enter__()
 
     # магический метод, который выполняется при выходе в блок with
     def __exit__(self, *args) -> None:
+        clean = self.committed and not (self.session.dirty or self.session.new or self.session.deleted)
         super().__exit__(*args)
         self.session.close()
+        if clean and self.product_cache is not None:
+            self.products.release()
 
     def _commit(self) -> None:
-        self.session.commit()
+        try:
+            rows = self.outbox_rows()
+            if rows:    # события для внешних систем фиксируются вместе с изменением агрегата
+                self.session.execute(insert(orm.outbox), rows)
+            self.session.commit()
+            self.committed = True
+        except Exception as e:
+            if self.product_cache is not None:
+                self.products.invalidate()
+            if not is_concurrency_conflict(e):
+                raise
+            self.session.rollback()
+            raise ConcurrencyConflict(f'Продукт изменен параллельной транзакцией: {e}') from e
 
     def rollback(self) -> None:
         self.session.rollback()
+
+
+class AbstractAsyncUnitOfWork(ABC):     # Абстрактный асинхронный контекстный менеджер (async with)
+    products: repository.AbstractAsyncProductRepository
+
+    async def __aexit__(self, *args):
+        await self.rollback()
+
+    async def __aenter__(self):
+        return self
+
+    async def commit(self):
+        await self._commit()
+
+    collect_new_events = AbstractUnitOfWork.collect_new_events     # сбор событий не требует ввода-вывода
+    outbox_rows = AbstractUnitOfWork.outbox_rows
+
+    @abstractmethod
+    async def _commit(self):
+        raise NotImplementedError
+
+    @abstractmethod
+    async def rollback(self):
+        raise NotImplementedError
+
+
+class AsyncSqlAlchemyUnitOfWork(AbstractAsyncUnitOfWork):     # Реализация UoW на sqlalchemy.ext.asyncio
+
+    def __init__(
+            self,
+            session_factory=None,
+            loading_strategy: str = None,
+            lock_policy: repository.ProductLockPolicy = None
+    ) -> None:
+        self.session_factory = session_factory      # None - фабрика по умолчанию, создается при первом входе в блок async with
+        self.loading_strategy = loading_strategy or config.db_settings.db_loading_strategy
+        if self.loading_strategy not in repository.LOADING_STRATEGIES or self.loading_strategy == 'lazy':
+            raise ValueError(f'Недопустимая стратегия загрузки для асинхронного UoW {self.loading_strategy}')
+        self.lock_policy = lock_policy or repository.ProductLockPolicy(**config.get_product_lock_options())
+
+    async def __aenter__(self):
+        if self.session_factory is None:
+            self.session_factory = default_async_session_factory()
+        self.session = self.session_factory()     # тип: AsyncSession
+        self.products = repository.AsyncSqlAlchemyRepository(self.session, self.loading_strategy, self.lock_policy)
+        return await super().__aenter__()
+
+    async def __aexit__(self, *args) -> None:
+        await super().__aexit__(*args)
+        await self.session.close()
+
+    async def _commit(self) -> None:
+        try:
+            rows = self.outbox_rows()
+            if rows:
+                await self.session.execute(insert(orm.outbox), rows)
+            await self.session.commit()
+        except Exception as e:
+            if not is_concurrency_conflict(e):
+                raise
+            await self.session.rollback()
+            raise ConcurrencyConflict(f'Продукт изменен параллельной транзакцией: {e}') from e
+
+    async def rollback(self) -> None:
+        await self.session.rollback()
@@ -1,10 +1,39 @@
-from src.allocation.service_layer import unit_of_work
+from typing import Optional
 from sqlalchemy.sql import text
+from src.allocation.adapters.read_model import ReadOnlyDatabase, AsyncReadOnlyDatabase
+from src.allocation.adapters.view_cache import ViewCache
 
-def allocations(orderid: str, uow: unit_of_work.SqlAlchemyUnitOfWork):
-    with uow:
-        results = list(uow.session.execute(text(
-            'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid'
-        ).bindparams(orderid=orderid)))
+# Запросы модели чтения создаются один раз при импорте: SQLAlchemy компилирует каждый из них один раз
+ALLOCATIONS_BY_ORDER = text('SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid')
 
-    return [{'sku': sku, 'batchref': batchref} for sku, batchref in results]
\ No newline at end of file
+
+def allocations(orderid: str, db: ReadOnlyDatabase, cache: Optional[ViewCache] = None):
+    """
+    Маркер промаха берется до запроса к БД: если проекция заказа изменится, пока запрос идет,
+    прочитанные строки в кеш не попадут (см. ViewCache)
+    """
+    if cache is not None:
+        cached, token = cache.lookup(orderid)
+        if cached is not None:
+            return cached
+
+    results = db.fetch_all(ALLOCATIONS_BY_ORDER, orderid=orderid)
+
+    result = [{'sku': sku, 'batchref': batchref} for sku, batchref in results]
+    if cache is not None:
+        cache.set(orderid, result, token)
+    return result
+
+
+async def allocations_async(orderid: str, db: AsyncReadOnlyDatabase, cache: Optional[ViewCache] = None):
+    if cache is not None:
+        cached, token = await cache.async_lookup(orderid)
+        if cached is not None:
+            return cached
+
+    results = await db.fetch_all(ALLOCATIONS_BY_ORDER, orderid=orderid)
+
+    result = [{'sku': sku, 'batchref': batchref} for sku, batchref in results]
+    if cache is not None:
+        await cache.async_set(orderid, result, token)
+    return result
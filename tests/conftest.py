@@ -4,7 +4,7 @@ import redis
 import shutil
 import subprocess
 from tenacity import retry, stop_after_delay
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
 from sqlalchemy.orm import sessionmaker, clear_mappers
 from sqlalchemy.exc import OperationalError
 
@@ -28,6 +28,31 @@ def sqlite_session_factory(in_memory_db):
 def sqlite_session(sqlite_session_factory):
     return sqlite_session_factory()
 
+# Файловая БД SQLite для тестов с несколькими потоками: каждая транзакция начинается с BEGIN IMMEDIATE,
+# поэтому пишущие транзакции выстраиваются в очередь, а не падают с "database is locked"
+@pytest.fixture
+def sqlite_file_db(tmp_path):
+    engine = create_engine(
+        f"sqlite:///{tmp_path / 'allocation.db'}",
+        connect_args={'check_same_thread': False, 'timeout': 30}
+    )
+
+    @event.listens_for(engine, 'connect')
+    def disable_pysqlite_transactions(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin_immediate(connection):
+        connection.exec_driver_sql('BEGIN IMMEDIATE')
+
+    metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def sqlite_file_session_factory(sqlite_file_db):
+    yield sessionmaker(bind=sqlite_file_db)
+
 @pytest.fixture
 def mappers():
     clear_mappers()
@@ -20,6 +20,16 @@ def post_to_allocate(orderid, sku, qty, expect_success=True):
         assert r.status_code == 200
     return r
 
+def post_to_allocate_many(lines, expect_success=True):
+    url = config.get_api_url()
+    r = requests.post(
+        f'{url}/allocate/bulk',
+        json={'lines': [{'orderid': orderid, 'sku': sku, 'qty': qty} for orderid, sku, qty in lines]}
+    )
+    if expect_success:
+        assert r.status_code == 200
+    return r
+
 def post_to_deallocate(orderid, sku, qty, expect_success=True):
     url = config.get_api_url()
     r = requests.delete(
@@ -37,4 +47,23 @@ def get_allocation(orderid):
         json={'orderid': orderid}
     )
 
-    return r
\ No newline at end of file
+    return r
+
+
+def post_to_plan(lines):
+    url = config.get_api_url()
+    r = requests.post(
+        f'{url}/allocate/plan',
+        json={'lines': [{'orderid': orderid, 'sku': sku, 'qty': qty} for orderid, sku, qty in lines]}
+    )
+    assert r.status_code == 200
+    return r
+
+def get_plan(lines):
+    url = config.get_api_url()
+    r = requests.get(
+        f'{url}/allocate/plan',
+        params=[param for sku, qty in lines for param in (('sku', sku), ('qty', qty))]
+    )
+    assert r.status_code == 200
+    return r
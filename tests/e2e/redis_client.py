@@ -12,5 +12,5 @@ def subscribe_to(channel):
     assert confirmation["type"] == "subscribe"
     return pubsub
 
-def publish_message(channel, message):
-    r.publish(channel, json.dumps(message))
\ No newline at end of file
+def publish_message(stream, message):
+    r.xadd(stream, {'data': json.dumps(message)})
\ No newline at end of file
@@ -48,6 +48,41 @@ class TestAllocate:
         assert r.status_code == 404
 
 
+class TestAllocateMany:
+    def test_allocates_lines_and_reports_out_of_stock(postgres_db):
+        orderid = random_orderid()
+        sku, othersku = random_sku(), random_sku('other')
+        batch, otherbatch = random_batchref(1), random_batchref(2)
+        api_client.post_to_add_batch(batch, sku, 100, None)
+        api_client.post_to_add_batch(otherbatch, othersku, 5, None)
+
+        r = api_client.post_to_allocate_many([(orderid, sku, 10), (orderid, othersku, 10)])
+
+        assert r.json()['allocations'] == [
+            {'orderid': orderid, 'sku': sku, 'qty': 10, 'batchref': batch, 'out_of_stock': False},
+            {'orderid': orderid, 'sku': othersku, 'qty': 10, 'batchref': None, 'out_of_stock': True},
+        ]
+
+
+class TestAllocationPlan:
+    def test_plan_reports_batches_and_shortage_without_allocating(postgres_db):
+        orderid = random_orderid()
+        sku, othersku = random_sku(), random_sku('other')
+        batch, otherbatch = random_batchref(1), random_batchref(2)
+        api_client.post_to_add_batch(batch, sku, 100, None)
+        api_client.post_to_add_batch(otherbatch, othersku, 5, None)
+
+        r = api_client.post_to_plan([(orderid, sku, 10), (orderid, othersku, 10)])
+
+        assert r.json()['allocations'] == [
+            {'orderid': orderid, 'sku': sku, 'qty': 10, 'batchref': batch, 'shortage': 0},
+            {'orderid': orderid, 'sku': othersku, 'qty': 10, 'batchref': None, 'shortage': 10},
+        ]
+        r = api_client.get_plan([(othersku, 5)])
+        assert r.json()['allocations'][0]['batchref'] == otherbatch
+        assert api_client.get_allocation(orderid).status_code == 404
+
+
 class TestDeallocate:
     def test_deallocate(postgres_db):
         """
@@ -0,0 +1,185 @@
+import time
+import redis
+
+
+def _encode(value):
+    return value if isinstance(value, bytes) else str(value).encode('utf-8')
+
+
+class FakePipeline:
+    """
+    Конвейер фейкового клиента: команды запоминаются и выполняются клиентом за один обмен при execute
+    """
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        def record(*args, **kwargs):
+            self.commands.append((name, args, kwargs))
+            return self
+        return record
+
+    def execute(self):
+        if self.client.down:
+            raise redis.ConnectionError('Redis недоступен')
+        self.client.round_trips += 1
+        results = [getattr(self.client, '_' + name)(*args, **kwargs) for name, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
+
+class FakeRedis:
+    """
+    Фейковый клиент Redis: ключи, каналы pub/sub и потоки с группами потребителей в памяти,
+    запоминает опубликованные сообщения и число обращений к серверу (round trip)
+    down = True - имитация недоступного сервера, advance(seconds) - сдвиг часов для проверки простоя записей
+    """
+
+    def __init__(self) -> None:
+        self.published = []
+        self.round_trips = 0
+        self.down = False
+        self.values = {}        # ключ -> (значение, срок годности в мс или None)
+        self.streams = {}       # поток -> [(идентификатор, поля)]
+        self.groups = {}        # (поток, группа) -> {'last_delivered': идентификатор, 'pending': {идентификатор: {...}}}
+        self._offset = 0.0
+        self._last_id = (0, 0)
+
+    def __getattr__(self, name):
+        # каждая команда вне конвейера - отдельный обмен с сервером
+        method = getattr(type(self), '_' + name, None)
+        if method is None:
+            raise AttributeError(name)
+        def call(*args, **kwargs):
+            if self.down:
+                raise redis.ConnectionError('Redis недоступен')
+            self.round_trips += 1
+            return method(self, *args, **kwargs)
+        return call
+
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+
+    def advance(self, seconds: float) -> None:
+        self._offset += seconds
+
+    def _now_ms(self) -> int:
+        return int((time.time() + self._offset) * 1000)
+
+    @staticmethod
+    def _parse_id(entry_id):
+        ms, seq = entry_id.decode().split('-')
+        return int(ms), int(seq)
+
+    def _get(self, name):
+        value, expires = self.values.get(name, (None, None))
+        if expires is not None and expires <= self._now_ms():
+            del self.values[name]
+            return None
+        return value
+
+    def _set(self, name, value, px=None):
+        self.values[name] = (_encode(value), self._now_ms() + px if px is not None else None)
+        return True
+
+    def _mget(self, *names):
+        return [self._get(name) for name in names]
+
+    def _incr(self, name):
+        value, expires = self.values.get(name, (b'0', None))
+        if expires is not None and expires <= self._now_ms():
+            value, expires = b'0', None
+        self.values[name] = (_encode(int(value) + 1), expires)
+        return int(value) + 1
+
+    def _pexpire(self, name, milliseconds):
+        if name not in self.values:
+            return False
+        self.values[name] = (self.values[name][0], self._now_ms() + milliseconds)
+        return True
+
+    def _delete(self, *names):
+        return sum(self.values.pop(name, None) is not None for name in names)
+
+    def _publish(self, channel, message):
+        self.published.append((channel, message))
+        return 0
+
+    def _xadd(self, name, fields):
+        ms = max(self._now_ms(), self._last_id[0])
+        seq = self._last_id[1] + 1 if ms == self._last_id[0] else 0
+        self._last_id = (ms, seq)
+        entry_id = f'{ms}-{seq}'.encode()
+        self.streams.setdefault(name, []).append((entry_id, {_encode(k): _encode(v) for k, v in fields.items()}))
+        return entry_id
+
+    def _xgroup_create(self, name, groupname, id='$', mkstream=False):
+        if name not in self.streams:
+            if not mkstream:
+                raise redis.ResponseError('ERR The XGROUP subcommand requires the key to exist')
+            self.streams[name] = []
+        if (name, groupname) in self.groups:
+            raise redis.ResponseError('BUSYGROUP Consumer Group name already exists')
+        last = self.streams[name][-1][0] if id == '$' and self.streams[name] else b'0-0'
+        self.groups[(name, groupname)] = {'last_delivered': last, 'pending': {}}
+        return True
+
+    def _xreadgroup(self, groupname, consumername, streams, count=None, block=None, noack=False):
+        response = []
+        for name in streams:
+            group = self.groups[(name, groupname)]
+            last = self._parse_id(group['last_delivered'])
+            new = [entry for entry in self.streams[name] if self._parse_id(entry[0]) > last][:count]
+            if not new:
+                continue
+            group['last_delivered'] = new[-1][0]
+            for entry_id, _ in new:
+                group['pending'][entry_id] = {'consumer': consumername, 'delivered_at': self._now_ms(), 'times': 1}
+            response.append([name.encode(), new])
+        return response
+
+    def _xack(self, name, groupname, *ids):
+        pending = self.groups[(name, groupname)]['pending']
+        return sum(pending.pop(_encode(entry_id), None) is not None for entry_id in ids)
+
+    def _xpending_range(self, name, groupname, min, max, count, consumername=None, idle=None):
+        now = self._now_ms()
+        result = []
+        for entry_id, p in sorted(self.groups[(name, groupname)]['pending'].items(), key=lambda i: self._parse_id(i[0])):
+            if idle is not None and now - p['delivered_at'] < idle:
+                continue
+            if consumername is not None and p['consumer'] != consumername:
+                continue
+            result.append({
+                'message_id': entry_id, 'consumer': p['consumer'].encode(),
+                'time_since_delivered': now - p['delivered_at'], 'times_delivered': p['times']
+            })
+        return result[:count]
+
+    def _xclaim(self, name, groupname, consumername, min_idle_time, message_ids):
+        now = self._now_ms()
+        entries = dict(self.streams[name])
+        pending = self.groups[(name, groupname)]['pending']
+        claimed = []
+        for entry_id in map(_encode, message_ids):
+            p = pending.get(entry_id)
+            if p is None or now - p['delivered_at'] < min_idle_time:
+                continue
+            p.update(consumer=consumername, delivered_at=now, times=p['times'] + 1)
+            claimed.append((entry_id, entries.get(entry_id)))
+        return claimed
+
+    def _xinfo_groups(self, name):
+        result = []
+        for (stream, groupname), group in self.groups.items():
+            if stream != name:
+                continue
+            last = self._parse_id(group['last_delivered'])
+            result.append({
+                'name': groupname.encode(),
+                'pending': len(group['pending']),
+                'lag': sum(self._parse_id(entry_id) > last for entry_id, _ in self.streams[name]),
+            })
+        return result
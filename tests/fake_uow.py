@@ -0,0 +1,101 @@
+# Фейковые репозитории и UoW в памяти для тестов шины и обработчиков без БД
+from src.allocation.adapters import repository
+from src.allocation.service_layer import unit_of_work
+
+
+class FakeRepository(repository.AbstractProductRepositoriy):
+    """
+    Фейковый репозиторий для тестирования приложения
+    """
+
+    def __init__(self, products) -> None:
+        super().__init__()
+        self._products = set(products)
+
+    def _add(self, product):
+        self._products.add(product)
+
+    def _get(self, sku):
+        return next((b for b in self._products if b.sku == sku), None)
+
+    def _get_by_batchref(self, batchref):
+        return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
+
+
+class FakeSession:
+    """
+    Фейковый сеанс, запоминающий выполненные запросы к модели чтения
+    """
+
+    def __init__(self) -> None:
+        self.executed = []
+
+    def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
+
+class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
+    """
+    Фейковая реализация UoW для тестирования
+    """
+
+    def __init__(self) -> None:
+        self.products = FakeRepository([])
+        self.session = FakeSession()
+        self.commited = False
+        self.commits = 0
+
+    def _commit(self) -> None:
+        self.commited = True
+        self.commits += 1
+
+    def rollback(self) -> None:
+        pass
+
+
+class FakeAsyncRepository(repository.AbstractAsyncProductRepository):
+    """
+    Фейковый асинхронный репозиторий, products - общее для всех экземпляров UoW хранилище
+    """
+
+    def __init__(self, products) -> None:
+        super().__init__()
+        self._products = products
+
+    def _add(self, product):
+        self._products.add(product)
+
+    async def _get(self, sku):
+        return next((p for p in self._products if p.sku == sku), None)
+
+    async def _get_by_batchref(self, batchref):
+        return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
+
+
+class FakeAsyncSession:
+    """
+    Фейковый асинхронный сеанс, запоминающий выполненные запросы к модели чтения
+    """
+
+    def __init__(self) -> None:
+        self.executed = []
+
+    async def execute(self, statement, params=None):
+        self.executed.append((statement, params))
+
+
+class FakeAsyncUnitOfWork(unit_of_work.AbstractAsyncUnitOfWork):
+    """
+    Фейковая реализация асинхронного UoW, для каждого вызова handle_async создается новый экземпляр
+    """
+
+    def __init__(self, products) -> None:
+        self.products = FakeAsyncRepository(products)
+        self.session = FakeAsyncSession()
+        self.commited = False
+
+    async def _commit(self) -> None:
+        self.commited = True
+
+    async def rollback(self) -> None:
+        pass
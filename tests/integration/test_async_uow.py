@@ -0,0 +1,118 @@
+import asyncio
+import pytest
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.sql import text
+
+from src.allocation.domain import models, commands
+from src.allocation.service_layer import unit_of_work
+from src.allocation import bootstrap, views
+from src.allocation.adapters.read_model import AsyncReadOnlyDatabase
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+@pytest.fixture
+def async_session_factory(sqlite_file_db):
+    engine = create_async_engine(f'sqlite+aiosqlite:///{sqlite_file_db.url.database}')
+    yield sessionmaker(bind=engine, class_=AsyncSession, expire_on_commit=False)
+    asyncio.run(engine.dispose())
+
+
+def insert_batch(session_factory, ref, sku, qty):
+    async def insert():
+        async with session_factory() as session:
+            await session.execute(text(
+                'INSERT INTO products (sku, version_number) VALUES (:sku, 1)'
+            ).bindparams(sku=sku))
+            await session.execute(text(
+                'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+                ' VALUES (:ref, :sku, :qty, NULL)').bindparams(ref=ref, sku=sku, qty=qty)
+            )
+            await session.commit()
+    asyncio.run(insert())
+
+
+class TestAsyncUoW:
+
+    def test_can_retrieve_a_product_and_allocate_to_it(self, async_session_factory):
+        """
+        Тест для проверки асинхронного UoW: продукт загружается целиком, размещение фиксируется в БД
+        """
+        insert_batch(async_session_factory, 'batch1', 'HIPSTER-WORKBENCH', 100)
+
+        async def allocate():
+            uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+            async with uow:
+                product = await uow.products.get(sku='HIPSTER-WORKBENCH')
+                batchref = product.allocate(models.OrderLine('o1', 'HIPSTER-WORKBENCH', 10))
+                await uow.commit()
+            return batchref
+
+        async def allocated_quantity():
+            uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+            async with uow:
+                product = await uow.products.get_by_batchref('batch1')
+                return product.batches[0].allocated_quantity
+
+        assert asyncio.run(allocate()) == 'batch1'
+        assert asyncio.run(allocated_quantity()) == 10
+
+
+    def test_rolls_back_uncommitted_work_by_default(self, async_session_factory):
+        insert_batch(async_session_factory, 'batch1', 'MEDIUM-PLINTH', 100)
+
+        async def allocate_without_commit():
+            uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+            async with uow:
+                product = await uow.products.get(sku='MEDIUM-PLINTH')
+                product.allocate(models.OrderLine('o1', 'MEDIUM-PLINTH', 10))
+
+        async def count_allocations():
+            async with async_session_factory() as session:
+                return (await session.execute(text('SELECT count(*) FROM allocations'))).scalar()
+
+        asyncio.run(allocate_without_commit())
+        assert asyncio.run(count_allocations()) == 0
+
+
+    def test_commit_writes_events_to_outbox(self, async_session_factory):
+        insert_batch(async_session_factory, 'batch1', 'OUTBOX-PLINTH', 100)
+
+        async def allocate():
+            uow = unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+            async with uow:
+                product = await uow.products.get(sku='OUTBOX-PLINTH')
+                product.allocate(models.OrderLine('o1', 'OUTBOX-PLINTH', 10))
+                await uow.commit()
+
+        async def outbox_channels():
+            async with async_session_factory() as session:
+                return (await session.execute(text('SELECT channel FROM outbox'))).scalars().all()
+
+        asyncio.run(allocate())
+        assert asyncio.run(outbox_channels()) == ['line_allocated']
+
+
+    def test_lazy_loading_strategy_is_rejected(self, async_session_factory):
+        with pytest.raises(ValueError):
+            unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory, loading_strategy='lazy')
+
+
+class TestHandleAsync:
+
+    def test_allocations_view_is_updated_through_async_path(self, async_session_factory):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=None,
+            notifications=lambda *args: None,
+            publish=lambda *args: None,
+            async_uow_factory=lambda: unit_of_work.AsyncSqlAlchemyUnitOfWork(async_session_factory)
+        )
+
+        async def scenario():
+            await bus.handle_async(commands.CreateBatch('sku1batch', 'sku1', 20, None))
+            await bus.handle_async(commands.Allocate('order1', 'sku1', 20))
+            return await views.allocations_async('order1', AsyncReadOnlyDatabase(async_session_factory.kw['bind']))
+
+        assert asyncio.run(scenario()) == [{'sku': 'sku1', 'batchref': 'sku1batch'}]
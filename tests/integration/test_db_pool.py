@@ -0,0 +1,108 @@
+import asyncio
+import pytest
+from sqlalchemy import create_engine, exc
+from sqlalchemy.ext.asyncio import create_async_engine
+from sqlalchemy.sql import text
+from src.allocation.adapters import db_pool, read_model
+from src.allocation.service_layer import unit_of_work
+
+
+@pytest.fixture
+def pooled_engine(tmp_path):
+    engine = create_engine(
+        f'sqlite:///{tmp_path / "pool.db"}',
+        poolclass=db_pool.InstrumentedQueuePool,
+        pool_size=1,
+        max_overflow=1,
+        pool_timeout=0.1,
+    )
+    yield engine
+    engine.dispose()
+
+
+class TestPoolStatus:
+
+    def test_reports_checked_out_connections_and_overflow(self, pooled_engine):
+        """
+        Тест для проверки статистики пула: выданные соединения, переполнение и число выдач
+        """
+        first = pooled_engine.connect()
+        second = pooled_engine.connect()
+
+        status = db_pool.pool_status(pooled_engine)
+        assert status['pool_class'] == 'InstrumentedQueuePool'
+        assert status['checked_out'] == 2
+        assert status['overflow'] == 1
+        assert status['checkouts'] == 2
+
+        first.close()
+        second.close()
+        status = db_pool.pool_status(pooled_engine)
+        assert status['checked_out'] == 0
+        assert status['checked_in'] == 1
+
+
+    def test_counts_checkout_timeouts(self, pooled_engine):
+        connections = [pooled_engine.connect(), pooled_engine.connect()]
+
+        with pytest.raises(exc.TimeoutError):
+            pooled_engine.connect()
+
+        status = db_pool.pool_status(pooled_engine)
+        assert status['timeouts'] == 1
+        assert status['max_wait_seconds'] >= 0.1
+        for connection in connections:
+            connection.close()
+
+
+    def test_status_of_non_queue_pool(self, in_memory_db):
+        status = db_pool.pool_status(in_memory_db)
+        assert status == {'pool_class': 'SingletonThreadPool'}
+
+
+    def test_async_engine_pool_records_waits(self, tmp_path):
+        engine = create_async_engine(
+            f'sqlite+aiosqlite:///{tmp_path / "pool.db"}',
+            poolclass=db_pool.InstrumentedAsyncAdaptedQueuePool,
+            pool_size=1,
+            max_overflow=0,
+        )
+
+        async def scenario():
+            async def query():
+                async with engine.connect() as connection:
+                    await connection.execute(text('SELECT 1'))
+                    await asyncio.sleep(0.05)   # второй запрос ждет единственное соединение
+            await asyncio.gather(query(), query())
+            status = db_pool.pool_status(engine)
+            await engine.dispose()
+            return status
+
+        status = asyncio.run(scenario())
+        assert status['pool_class'] == 'InstrumentedAsyncAdaptedQueuePool'
+        assert status['checkouts'] == 2
+        assert status['max_wait_seconds'] >= 0.04
+
+
+    def test_engines_that_were_not_created_are_not_reported(self, pooled_engine):
+        status = db_pool.pools_status(sync=pooled_engine, read=None)
+        assert status['read'] is None
+        assert status['sync']['pool_class'] == 'InstrumentedQueuePool'
+
+
+    def test_async_engines_of_api_are_instrumented(self, monkeypatch):
+        """
+        Тест для проверки /metrics/pool: асинхронные движки записи и модели чтения, через которые идут
+        запросы API, создаются с пулом со статистикой ожидания (движки не подключаются к БД при создании)
+        """
+        monkeypatch.setattr(unit_of_work, '_async_engine', None)
+        monkeypatch.setattr(read_model, '_async_read_engine', None)
+        monkeypatch.setattr(read_model, '_read_engine', None)
+        unit_of_work.get_async_engine()
+        read_model.get_async_read_engine()
+
+        assert unit_of_work.pool_status()['async']['pool_class'] == 'InstrumentedAsyncAdaptedQueuePool'
+        status = read_model.pool_status()
+        assert status['async']['pool_class'] == 'InstrumentedAsyncAdaptedQueuePool'
+        assert status['async']['checkouts'] == 0
+        assert status['sync'] is None
@@ -0,0 +1,76 @@
+import pytest
+from sqlalchemy.sql import text
+from src.allocation.domain import models
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def insert_allocated_batch(session, ref, sku, qty, line_qtys):
+    session.execute(text(
+        'INSERT INTO products (sku, version_number) VALUES (:sku, 1)'
+    ).bindparams(sku=sku))
+    session.execute(text(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+        ' VALUES (:ref, :sku, :qty, NULL)').bindparams(ref=ref, sku=sku, qty=qty)
+    )
+    [[batch_id]] = session.execute(text('SELECT id FROM batches WHERE reference=:ref').bindparams(ref=ref))
+    for i, line_qty in enumerate(line_qtys):
+        session.execute(text(
+            'INSERT INTO order_lines (orderid, sku, qty) VALUES (:orderid, :sku, :qty)'
+        ).bindparams(orderid=f'order{i}', sku=sku, qty=line_qty))
+        [[line_id]] = session.execute(text(
+            'SELECT id FROM order_lines WHERE orderid=:orderid').bindparams(orderid=f'order{i}')
+        )
+        session.execute(text(
+            'INSERT INTO allocations (orderline_id, batch_id) VALUES (:line_id, :batch_id)'
+        ).bindparams(line_id=line_id, batch_id=batch_id))
+
+
+class TestBatchMapping:
+
+    def test_allocated_quantity_of_loaded_batch_is_counted_from_lazy_allocations(self, sqlite_session):
+        """
+        Тест для проверки, что партия, загруженная ORM без вызова __init__,
+        считает сумму размещенных позиций по лениво загруженной коллекции _allocations
+        """
+        insert_allocated_batch(sqlite_session, 'batch1', 'GREEN-SOFA', 100, [10, 20, 5])
+        sqlite_session.commit()
+
+        [batch] = sqlite_session.query(models.Batch).all()
+
+        assert batch.allocated_quantity == 35
+        assert batch.available_quantity == 65
+
+
+    def test_allocated_quantity_stays_correct_after_commit(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_allocated_batch(session, 'batch1', 'GREEN-SOFA', 100, [10])
+        session.commit()
+
+        product = session.query(models.Product).filter_by(sku='GREEN-SOFA').first()
+        product.allocate(models.OrderLine('order-new', 'GREEN-SOFA', 15))
+        session.commit()
+        [batch] = product.batches
+
+        assert batch.available_quantity == 75
+        other_session = sqlite_session_factory()
+        [loaded] = other_session.query(models.Batch).all()
+        assert loaded.available_quantity == 75
+
+
+class TestProductMapping:
+
+    def test_line_index_is_built_from_hydrated_allocations(self, sqlite_session):
+        """
+        Тест для проверки, что обратный индекс позиций продукта из ORM строится по загруженным _allocations
+        """
+        insert_allocated_batch(sqlite_session, 'batch1', 'GREEN-SOFA', 100, [10, 20])
+        sqlite_session.commit()
+
+        product = sqlite_session.query(models.Product).filter_by(sku='GREEN-SOFA').first()
+        batchref = product.deallocate(models.OrderLine('order1', 'GREEN-SOFA', 20))
+        sqlite_session.commit()
+
+        assert batchref == 'batch1'
+        assert {(line.orderid, line.sku) for line in product.line_index} == {('order0', 'GREEN-SOFA')}
+        assert product.line_index_is_consistent()
@@ -0,0 +1,89 @@
+import json
+import pytest
+import redis
+from sqlalchemy.sql import text
+from src.allocation.adapters.outbox import OutboxRelay
+from src.allocation.domain import models
+from src.allocation.service_layer import unit_of_work
+from tests.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def insert_batch(session, ref, sku, qty):
+    session.execute(text('INSERT INTO products (sku, version_number) VALUES (:sku, 1)').bindparams(sku=sku))
+    session.execute(text(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta) VALUES (:ref, :sku, :qty, NULL)'
+    ).bindparams(ref=ref, sku=sku, qty=qty))
+    session.commit()
+
+
+def allocate(session_factory, orderid, sku, qty, commit=True):
+    uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory)
+    with uow:
+        uow.products.get(sku=sku).allocate(models.OrderLine(orderid, sku, qty))
+        if commit:
+            uow.commit()
+
+
+def unsent_events(session):
+    return list(session.execute(text('SELECT channel, payload FROM outbox WHERE sent_at IS NULL ORDER BY id')))
+
+
+class TestOutbox:
+
+    def test_events_are_written_in_the_same_transaction(self, sqlite_session_factory):
+        """
+        Тест для проверки outbox: событие размещения записывается при фиксации UoW, при откате - не записывается
+        """
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'OUTBOX-LAMP', 100)
+
+        allocate(sqlite_session_factory, 'o1', 'OUTBOX-LAMP', 10)
+        allocate(sqlite_session_factory, 'o2', 'OUTBOX-LAMP', 10, commit=False)
+
+        [(channel, payload)] = unsent_events(session)
+        assert channel == 'line_allocated'
+        assert json.loads(payload) == {'orderid': 'o1', 'sku': 'OUTBOX-LAMP', 'qty': 10, 'batchref': 'batch1'}
+
+    def test_out_of_stock_is_not_published(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'OUTBOX-LAMP', 5)
+
+        allocate(sqlite_session_factory, 'o1', 'OUTBOX-LAMP', 10)
+        assert unsent_events(session) == []
+
+
+class TestOutboxRelay:
+
+    def test_relays_batch_in_one_round_trip_and_marks_it_sent(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'OUTBOX-LAMP', 100)
+        for i in range(5):
+            allocate(sqlite_session_factory, f'o{i}', 'OUTBOX-LAMP', 1)
+        fake_redis = FakeRedis()
+        relay = OutboxRelay(sqlite_session_factory, fake_redis, batch_size=3)
+
+        assert relay.relay_once() == 3
+        assert relay.relay_once() == 2
+        assert relay.relay_once() == 0
+
+        assert fake_redis.round_trips == 2
+        assert [json.loads(payload)['orderid'] for _, payload in fake_redis.published] == [f'o{i}' for i in range(5)]
+        assert unsent_events(session) == []
+
+    def test_events_stay_unsent_if_redis_is_down(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'OUTBOX-LAMP', 100)
+        allocate(sqlite_session_factory, 'o1', 'OUTBOX-LAMP', 10)
+        fake_redis = FakeRedis()
+        fake_redis.down = True
+        relay = OutboxRelay(sqlite_session_factory, fake_redis)
+
+        with pytest.raises(redis.ConnectionError):
+            relay.relay_once()
+        assert len(unsent_events(session)) == 1
+
+        fake_redis.down = False
+        assert relay.relay_once() == 1
+        assert unsent_events(session) == []
@@ -0,0 +1,192 @@
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.sql import text
+from src.allocation.adapters.projection_rebuild import AllocationsViewRebuild, SHADOW
+from src.allocation.domain import commands
+from src.allocation.service_layer import unit_of_work
+from src.allocation import bootstrap, views
+from src.allocation.adapters.read_model import ReadOnlyDatabase
+from src.allocation.adapters.view_cache import LruTtlCache, RedisCache, ViewCache
+from tests.fake_redis import FakeRedis
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+class InterruptedRebuild(AllocationsViewRebuild):
+    """
+    Перестроение, которое падает после copies_before_crash скопированных порций
+    """
+
+    def __init__(self, *args, copies_before_crash: int, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.copies_left = copies_before_crash
+
+    def copy_chunk(self, part):
+        if self.copies_left == 0:
+            raise RuntimeError('Процесс перестроения прерван')
+        self.copies_left -= 1
+        return super().copy_chunk(part)
+
+
+@pytest.fixture
+def file_bus(sqlite_file_session_factory):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+        notifications=lambda *args: None,
+        view_cache=None
+    )
+
+
+def allocate_orders(bus, n_orders, skus=('LAMP', 'TABLE')):
+    for sku in skus:
+        bus.handle(commands.CreateBatch(f'{sku}-batch', sku, n_orders * 10, None))
+    bus.handle(commands.AllocateMany([
+        commands.Allocate(f'order-{i}', sku, 1) for i in range(n_orders) for sku in skus
+    ]))
+
+
+def view_rows(engine):
+    with engine.connect() as connection:
+        return sorted(connection.execute(text('SELECT orderid, sku, qty, batchref FROM allocations_view')).all())
+
+
+def corrupt_view(engine):
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM allocations_view WHERE orderid = 'order-1'"))
+        connection.execute(text("UPDATE allocations_view SET batchref = 'wrong' WHERE orderid = 'order-2'"))
+        connection.execute(text("INSERT INTO allocations_view VALUES ('ghost', 'LAMP', 1, 'LAMP-batch')"))
+
+
+class TestAllocationsViewRebuild:
+
+    def test_rebuild_restores_drifted_view(self, sqlite_file_db, file_bus):
+        allocate_orders(file_bus, 50)
+        expected = view_rows(sqlite_file_db)
+        corrupt_view(sqlite_file_db)
+
+        rows = AllocationsViewRebuild(sqlite_file_db, chunk_size=7, workers=3).run()
+
+        assert rows == 100
+        assert view_rows(sqlite_file_db) == expected
+        assert SHADOW not in inspect(sqlite_file_db).get_table_names()
+        with sqlite_file_db.connect() as connection:
+            assert connection.execute(text('SELECT count(*) FROM projection_checkpoints')).scalar() == 0
+
+    def test_interrupted_rebuild_resumes_from_checkpoint(self, sqlite_file_db, file_bus):
+        allocate_orders(file_bus, 50)
+        expected = view_rows(sqlite_file_db)
+        corrupt_view(sqlite_file_db)
+
+        with pytest.raises(RuntimeError):
+            InterruptedRebuild(sqlite_file_db, chunk_size=10, workers=1, copies_before_crash=4).run()
+        rebuild = AllocationsViewRebuild(sqlite_file_db, chunk_size=10, workers=1)
+        assert rebuild.progress() == {'rows': 40, 'done': 0.4, 'parts': 1}
+
+        copied = []
+        original_copy_chunk = rebuild.copy_chunk
+        rebuild.copy_chunk = lambda part: copied.append(part) or original_copy_chunk(part)
+        rebuild.run()
+
+        assert len(copied) == 6     # скопированные до сбоя порции не повторяются
+        assert view_rows(sqlite_file_db) == expected
+
+    def test_changes_during_rebuild_are_caught_up_at_swap(self, sqlite_file_db, file_bus):
+        """
+        Тест для проверки дельты под блокировкой: изменения, зафиксированные после подготовки, копируются
+        заново только для артикулов с новой версией продукта
+        """
+        allocate_orders(file_bus, 10)
+        rebuild = AllocationsViewRebuild(sqlite_file_db, chunk_size=100, workers=2)
+        parts = rebuild.plan()
+        for part in parts:
+            rebuild.copy_part(part['part'])
+
+        rebuild.prepare()
+
+        file_bus.handle(commands.Deallocate('order-0', 'LAMP', 1))
+        file_bus.handle(commands.Allocate('late-order', 'TABLE', 1))
+        rebuild.swap()
+
+        reader = ReadOnlyDatabase(sqlite_file_db)
+        assert views.allocations('order-0', reader) == [{'sku': 'TABLE', 'batchref': 'TABLE-batch'}]
+        assert views.allocations('late-order', reader) == [{'sku': 'TABLE', 'batchref': 'TABLE-batch'}]
+
+    def test_allocation_committed_out_of_id_order_is_caught_up(self, sqlite_file_db, file_bus):
+        """
+        Тест для проверки досчета: размещение получило id до копирования своей порции,
+        а зафиксировалось после него (строка allocations появляется уже после копирования)
+        """
+        allocate_orders(file_bus, 10)
+        with sqlite_file_db.begin() as connection:
+            in_flight = connection.execute(text(
+                'SELECT id, orderline_id, batch_id FROM allocations ORDER BY id LIMIT 1 OFFSET 5'
+            )).one()
+            connection.execute(text('DELETE FROM allocations WHERE id = :id'), {'id': in_flight.id})
+        expected = view_rows(sqlite_file_db)
+        rebuild = AllocationsViewRebuild(sqlite_file_db, chunk_size=3, workers=2)
+        for part in rebuild.plan():
+            rebuild.copy_part(part['part'])
+
+        with sqlite_file_db.begin() as connection:
+            connection.execute(
+                text('INSERT INTO allocations (id, orderline_id, batch_id) VALUES (:id, :orderline_id, :batch_id)'),
+                dict(in_flight._mapping)
+            )
+        rebuild.prepare()
+        rebuild.swap()
+
+        assert view_rows(sqlite_file_db) == expected
+        assert len(expected) == 20
+
+    def test_swap_invalidates_cached_orders_that_changed(self, sqlite_file_db, file_bus):
+        allocate_orders(file_bus, 5)
+        corrupt_view(sqlite_file_db)
+        cache = ViewCache(LruTtlCache(ttl=60))
+        reader = ReadOnlyDatabase(sqlite_file_db)
+        for orderid in ('order-1', 'order-2', 'order-3', 'ghost'):
+            views.allocations(orderid, reader, cache)
+
+        AllocationsViewRebuild(sqlite_file_db, invalidate=cache.invalidate).run()
+
+        assert cache.get('order-3') is not None     # строки заказа не изменились
+        assert [cache.get(orderid) for orderid in ('order-1', 'order-2', 'ghost')] == [None, None, None]
+        assert views.allocations('order-1', reader, cache) == [
+            {'sku': 'LAMP', 'batchref': 'LAMP-batch'}, {'sku': 'TABLE', 'batchref': 'TABLE-batch'}
+        ]
+
+    def test_swap_copies_only_skus_changed_after_prepare(self, sqlite_file_db, file_bus):
+        allocate_orders(file_bus, 5)
+        rebuild = AllocationsViewRebuild(sqlite_file_db)
+        for part in rebuild.plan():
+            rebuild.copy_part(part['part'])
+        rebuild.prepare()
+
+        file_bus.handle(commands.Allocate('late-order', 'TABLE', 1))
+        with sqlite_file_db.begin() as connection:     # строка без смены версии продукта под блокировкой не ищется
+            connection.execute(text(f"INSERT INTO {SHADOW} VALUES ('marker', 'LAMP', 1, 'LAMP-batch')"))
+        rebuild.swap()
+
+        orders = {orderid for orderid, *_ in view_rows(sqlite_file_db)}
+        assert {'late-order', 'marker'} <= orders
+        rebuild = AllocationsViewRebuild(sqlite_file_db)
+        assert rebuild.run() == 11      # повторное перестроение: имена индексов теневой таблицы свободны
+
+    def test_swap_invalidates_redis_tier_for_other_processes(self, sqlite_file_db, file_bus):
+        """
+        Тест для проверки инвалидации из процесса перестроения: кеш процесса API, читающий уровень Redis,
+        не выдает заказ, строки которого изменились
+        """
+        allocate_orders(file_bus, 5)
+        corrupt_view(sqlite_file_db)
+        fake_redis = FakeRedis()
+        api_cache = ViewCache(LruTtlCache(ttl=60), RedisCache(fake_redis))
+        views.allocations('order-1', ReadOnlyDatabase(sqlite_file_db), api_cache)
+        api_cache.local.clear()
+
+        AllocationsViewRebuild(sqlite_file_db, invalidate=RedisCache(fake_redis).delete).run()
+
+        assert api_cache.get('order-1') is None
+
+    def test_rebuild_of_empty_tables(self, sqlite_file_db):
+        assert AllocationsViewRebuild(sqlite_file_db).run() == 0
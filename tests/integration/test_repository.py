@@ -0,0 +1,145 @@
+import pytest
+from sqlalchemy import event
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.sql import text
+from src.allocation.domain import models
+from src.allocation.adapters import repository
+from src.allocation.entrypoints.partitioned_consumer import BatchSkuResolver
+from src.allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+
+def insert_product_with_allocated_batches(session, sku, n_batches, lines_per_batch):
+    session.execute(text(
+        'INSERT INTO products (sku, version_number) VALUES (:sku, 1)'
+    ).bindparams(sku=sku))
+    for b in range(n_batches):
+        session.execute(text(
+            'INSERT INTO batches (reference, sku, _purchased_quantity, eta)'
+            ' VALUES (:ref, :sku, 100, NULL)').bindparams(ref=f'{sku}-batch{b}', sku=sku)
+        )
+        [[batch_id]] = session.execute(text(
+            'SELECT id FROM batches WHERE reference=:ref').bindparams(ref=f'{sku}-batch{b}')
+        )
+        for i in range(lines_per_batch):
+            session.execute(text(
+                'INSERT INTO order_lines (orderid, sku, qty) VALUES (:orderid, :sku, 1)'
+            ).bindparams(orderid=f'{sku}-order-{b}-{i}', sku=sku))
+            [[line_id]] = session.execute(text(
+                'SELECT id FROM order_lines WHERE orderid=:orderid').bindparams(orderid=f'{sku}-order-{b}-{i}')
+            )
+            session.execute(text(
+                'INSERT INTO allocations (orderline_id, batch_id) VALUES (:line_id, :batch_id)'
+            ).bindparams(line_id=line_id, batch_id=batch_id))
+    session.commit()
+
+
+def count_selects_per_allocation(engine, session_factory, loading_strategy, n_batches):
+    """
+    Количество SELECT-запросов, выполненных при загрузке продукта и размещении одной позиции
+    """
+    sku = f'SKU-{loading_strategy}-{n_batches}'
+    insert_product_with_allocated_batches(session_factory(), sku, n_batches, lines_per_batch=3)
+
+    statements = []
+    def count(conn, cursor, statement, *args):
+        if statement.lstrip().upper().startswith('SELECT'):
+            statements.append(statement)
+
+    event.listen(engine, 'before_cursor_execute', count)
+    try:
+        uow = unit_of_work.SqlAlchemyUnitOfWork(session_factory, loading_strategy=loading_strategy)
+        with uow:
+            product = uow.products.get(sku=sku)
+            product.allocate(models.OrderLine('new-order', sku, 1))
+            uow.commit()
+    finally:
+        event.remove(engine, 'before_cursor_execute', count)
+    return len(statements)
+
+
+class TestLoadingStrategy:
+
+    @pytest.mark.parametrize('loading_strategy, expected_selects', [('selectin', 3), ('joined', 1)])
+    def test_product_is_hydrated_in_fixed_number_of_queries(
+        self, in_memory_db, sqlite_session_factory, loading_strategy, expected_selects
+    ):
+        """
+        Тест для проверки, что число запросов на размещение не зависит от числа партий продукта
+        """
+        for n_batches in (2, 20):
+            selects = count_selects_per_allocation(
+                in_memory_db, sqlite_session_factory, loading_strategy, n_batches
+            )
+            assert selects == expected_selects
+
+
+    def test_lazy_loading_issues_query_per_batch(self, in_memory_db, sqlite_session_factory):
+        selects = count_selects_per_allocation(in_memory_db, sqlite_session_factory, 'lazy', n_batches=20)
+        assert selects == 2 + 20
+
+
+    def test_get_by_batchref_eager_loads_whole_aggregate(self, sqlite_session_factory):
+        insert_product_with_allocated_batches(sqlite_session_factory(), 'BIG-TABLE', 3, lines_per_batch=2)
+
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, loading_strategy='joined')
+        with uow:
+            product = uow.products.get_by_batchref('BIG-TABLE-batch1')
+            assert [b.reference for b in product.batches] == ['BIG-TABLE-batch0', 'BIG-TABLE-batch1', 'BIG-TABLE-batch2']
+            assert all(b.allocated_quantity == 2 for b in product.batches)
+
+
+    def test_unknown_loading_strategy(self, sqlite_session_factory):
+        with pytest.raises(ValueError):
+            unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, loading_strategy='eager')
+
+
+class TestLockPolicy:
+
+    def test_locked_query_selects_product_row_for_update(self, sqlite_session):
+        """
+        Тест для проверки пессимистической блокировки: блокируется только строка продукта, а не партии из JOIN
+        """
+        repo = repository.SqlAlchemyRepository(sqlite_session, loading_strategy='joined')
+        statement = repo._query(lock=True).statement.compile(dialect=postgresql.dialect())
+        assert 'FOR UPDATE OF products' in str(statement)
+        assert 'FOR UPDATE' not in str(repo._query().statement.compile(dialect=postgresql.dialect()))
+
+
+    def test_only_hot_skus_are_locked_in_optimistic_mode(self):
+        policy = repository.ProductLockPolicy('optimistic', pessimistic_skus=['HOT-SOFA'])
+        assert policy.locks('HOT-SOFA')
+        assert not policy.locks('COLD-SOFA')
+        assert repository.ProductLockPolicy('pessimistic').locks('COLD-SOFA')
+        assert not repository.ProductLockPolicy().may_lock
+
+
+    def test_locked_get_by_batchref_loads_whole_aggregate(self, sqlite_session_factory):
+        insert_product_with_allocated_batches(sqlite_session_factory(), 'HOT-TABLE', 2, lines_per_batch=2)
+
+        lock_policy = repository.ProductLockPolicy('pessimistic', isolation_level='SERIALIZABLE')
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, lock_policy=lock_policy)
+        with uow:
+            product = uow.products.get_by_batchref('HOT-TABLE-batch1')
+            assert product.sku == 'HOT-TABLE'
+            assert all(b.allocated_quantity == 2 for b in product.batches)
+            assert uow.products.get_by_batchref('NO-SUCH-BATCH') is None
+
+
+    def test_unknown_lock_mode(self):
+        with pytest.raises(ValueError):
+            repository.ProductLockPolicy('exclusive')
+
+
+class TestBatchSkuResolver:
+
+    def test_resolves_and_caches_batch_sku(self, sqlite_session_factory):
+        insert_product_with_allocated_batches(sqlite_session_factory(), 'RESOLVED-LAMP', n_batches=1, lines_per_batch=0)
+        queries = []
+        resolver = BatchSkuResolver(lambda: queries.append(1) or sqlite_session_factory())
+
+        assert resolver('RESOLVED-LAMP-batch0') == 'RESOLVED-LAMP'
+        assert resolver('RESOLVED-LAMP-batch0') == 'RESOLVED-LAMP'
+        assert resolver('unknown-batch') is None
+        assert len(queries) == 2
@@ -4,9 +4,12 @@ import traceback
 import pytest
 
 from sqlalchemy.sql import text
-from src.allocation.domain import models
+from src.allocation.domain import models, commands
 from src.allocation.service_layer import unit_of_work
+from src.allocation import bootstrap
 from src.allocation.adapters import orm
+from src.allocation.adapters.product_cache import ProductCache
+from src.allocation.domain.exceptions import ConcurrencyConflict
 from tests.random_refs import random_batchref, random_orderid, random_sku
 
 pytestmark = pytest.mark.usefixtures("mappers")
@@ -131,6 +134,7 @@ class TestUoW:
             'SELECT version_number FROM products WHERE sku=:sku').bindparams(sku=sku))
         assert version == 2
         [exception] = exceptions
+        assert isinstance(exception, ConcurrencyConflict)
         assert 'could not serialize access due to concurrent update' in str(exception)
 
         orders = list(session.execute(text(
@@ -142,4 +146,234 @@ class TestUoW:
         assert len(orders) == 1
         uow = unit_of_work.SqlAlchemyUnitOfWork()
         with uow:
-            uow.session.execute(text('select 1'))
\ No newline at end of file
+            uow.session.execute(text('select 1'))
+
+
+    def test_stale_version_raises_concurrency_conflict(self, sqlite_session_factory):
+        """
+        Тест для проверки CAS по версии продукта: UoW, загрузивший продукт до фиксации другой транзакции,
+        не может записать свои изменения поверх нее
+        """
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'STALE-LAMP', 100, None, product_version=1)
+        session.commit()
+
+        stale_uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+        with stale_uow:
+            stale_product = stale_uow.products.get(sku='STALE-LAMP')
+
+            uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory)
+            with uow:
+                uow.products.get(sku='STALE-LAMP').allocate(models.OrderLine('o1', 'STALE-LAMP', 10))
+                uow.commit()
+
+            stale_product.allocate(models.OrderLine('o2', 'STALE-LAMP', 10))
+            with pytest.raises(ConcurrencyConflict):
+                stale_uow.commit()
+
+        [[version]] = session.execute(text('SELECT version_number FROM products WHERE sku=:sku').bindparams(sku='STALE-LAMP'))
+        assert version == 2
+        assert get_allocated_batch_ref(session, 'o1', 'STALE-LAMP') == 'batch1'
+        assert list(session.execute(text("SELECT * FROM order_lines WHERE orderid='o2'"))) == []
+
+
+class CountingConflictsUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    """
+    UoW, подсчитывающий фиксации, завершившиеся конфликтом параллельного изменения
+    """
+    conflicts = 0
+    lock = threading.Lock()
+
+    def _commit(self) -> None:
+        try:
+            super()._commit()
+        except ConcurrencyConflict:
+            with self.lock:
+                type(self).conflicts += 1
+            raise
+
+
+class TestOptimisticConcurrency:
+
+    def test_workers_allocating_same_sku(self, postgres_session_factory):
+        """
+        Замер доли конфликтов и пропускной способности: N потоков размещают позиции одного артикула через шину,
+        каждый конфликт версии повторяется, в итоге все позиции размещены, а версия выросла на число размещений
+        """
+        n_workers, allocations_per_worker = 8, 10
+        sku, batch = random_sku(), random_batchref()
+        session = postgres_session_factory()
+        insert_batch(session, batch, sku, 1000, eta=None, product_version=1)
+        session.commit()
+
+        CountingConflictsUnitOfWork.conflicts = 0
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: CountingConflictsUnitOfWork(postgres_session_factory),
+            notifications=lambda *args: None,
+            publish=lambda *args: None
+        )
+        bus.max_conflict_attempts = 50
+
+        exceptions = []
+        def allocate_many_times(worker):
+            for i in range(allocations_per_worker):
+                try:
+                    bus.handle(commands.Allocate(random_orderid(f'{worker}-{i}'), sku, 1))
+                except Exception as e:
+                    exceptions.append(e)
+
+        threads = [threading.Thread(target=allocate_many_times, args=(w,)) for w in range(n_workers)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+
+        total = n_workers * allocations_per_worker
+        conflicts = CountingConflictsUnitOfWork.conflicts
+        print(
+            f'{n_workers} workers: {total / elapsed:.1f} allocations/s, '
+            f'conflict rate {conflicts / (total + conflicts):.2%} ({conflicts} conflicts)'
+        )
+        assert exceptions == []
+        [[version]] = session.execute(text(
+            'SELECT version_number FROM products WHERE sku=:sku').bindparams(sku=sku))
+        assert version == 1 + total
+
+
+class TestConcurrentBus:
+
+    def test_concurrent_handle_calls_do_not_share_unit_of_work(self, sqlite_file_session_factory):
+        """
+        Стресс-тест шины с фабрикой UoW: потоки одновременно размещают заказы по своим артикулам
+        через общую шину, каждый поток должен получить ссылки только на партии своего артикула
+        """
+        n_threads, allocations_per_thread = 8, 10
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            notifications=lambda *args: None,
+            publish=lambda *args: None
+        )
+        for t in range(n_threads):
+            bus.handle(commands.CreateBatch(f'batch-{t}', f'SKU-{t}', 1000, None))
+
+        results, exceptions = {}, []
+        def allocate_many_times(t):
+            try:
+                results[t] = [
+                    bus.handle(commands.Allocate(f'order-{t}-{i}', f'SKU-{t}', 1))[0]
+                    for i in range(allocations_per_thread)
+                ]
+            except Exception as e:
+                print(traceback.format_exc())
+                exceptions.append(e)
+
+        threads = [threading.Thread(target=allocate_many_times, args=(t,)) for t in range(n_threads)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert exceptions == []
+        for t in range(n_threads):
+            assert results[t] == [f'batch-{t}'] * allocations_per_thread
+        session = sqlite_file_session_factory()
+        [[allocations]] = session.execute(text('SELECT count(*) FROM allocations'))
+        [[view_rows]] = session.execute(text('SELECT count(*) FROM allocations_view'))
+        assert allocations == view_rows == n_threads * allocations_per_thread
+
+
+class TestProductCache:
+
+    def allocate(self, uow, orderid, sku):
+        with uow:
+            product = uow.products.get(sku=sku)
+            batchref = product.allocate(models.OrderLine(orderid, sku, 10))
+            uow.commit()
+        return product, batchref
+
+    def test_committed_product_is_reused_by_next_unit_of_work(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'CACHED-LAMP', 100, None)
+        session.commit()
+        cache = ProductCache()
+
+        first, _ = self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o1', 'CACHED-LAMP')
+        second, _ = self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o2', 'CACHED-LAMP')
+
+        assert second is first
+        assert cache.stats.as_dict()['hits'] == 1
+        assert get_allocated_batch_ref(session, 'o2', 'CACHED-LAMP') == 'batch1'
+        [[version]] = session.execute(text("SELECT version_number FROM products WHERE sku='CACHED-LAMP'"))
+        assert version == second.version_number == 3
+
+    def test_product_changed_elsewhere_is_reloaded(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'CACHED-LAMP', 30, None)
+        session.commit()
+        cache = ProductCache()
+        cached, _ = self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o1', 'CACHED-LAMP')
+
+        self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory), 'o2', 'CACHED-LAMP')   # без кеша
+        product, batchref = self.allocate(
+            unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o3', 'CACHED-LAMP'
+        )
+
+        assert product is not cached
+        assert batchref == 'batch1'
+        assert product.batches[0].available_quantity == 0
+        assert cache.stats.as_dict()['stale'] == 1
+
+    def test_failed_commit_invalidates_cached_product(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'CACHED-LAMP', 100, None)
+        session.commit()
+        cache = ProductCache()
+        self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o1', 'CACHED-LAMP')
+
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache)
+        with uow:
+            product = uow.products.get(sku='CACHED-LAMP')
+            session.execute(text("UPDATE products SET version_number = 10 WHERE sku='CACHED-LAMP'"))
+            session.commit()
+            product.allocate(models.OrderLine('o2', 'CACHED-LAMP', 10))
+            with pytest.raises(ConcurrencyConflict):
+                uow.commit()
+
+        assert len(cache) == 0
+        assert cache.stats.as_dict()['invalidations'] == 1
+
+    def test_uncommitted_product_is_not_returned_to_cache(self, sqlite_session_factory):
+        session = sqlite_session_factory()
+        insert_batch(session, 'batch1', 'CACHED-LAMP', 100, None)
+        session.commit()
+        cache = ProductCache()
+        self.allocate(unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache), 'o1', 'CACHED-LAMP')
+
+        with unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory, product_cache=cache) as uow:
+            uow.products.get(sku='CACHED-LAMP').allocate(models.OrderLine('o2', 'CACHED-LAMP', 10))
+
+        assert len(cache) == 0
+
+    def test_events_stay_with_unit_of_work_that_raised_them(self, sqlite_file_session_factory):
+        cache = ProductCache()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory, product_cache=cache),
+            notifications=lambda *args: None,
+            publish=lambda *args: None,
+            view_cache=None
+        )
+        bus.handle(commands.CreateBatch('batch1', 'CACHED-LAMP', 100, None))
+        for i in range(5):
+            bus.handle(commands.Allocate(f'order-{i}', 'CACHED-LAMP', 1))
+        bus.handle(commands.Deallocate('order-0', 'CACHED-LAMP', 1))
+
+        assert cache.stats.as_dict()['hits'] == 6
+        session = sqlite_file_session_factory()
+        assert [orderid for orderid, in session.execute(text('SELECT orderid FROM allocations_view ORDER BY orderid'))] == [
+            f'order-{i}' for i in range(1, 5)
+        ]
@@ -3,7 +3,12 @@ from datetime import date
 from sqlalchemy.orm import clear_mappers
 from src.allocation.service_layer import unit_of_work
 from src.allocation.domain import commands
-from src.allocation import views, bootstrap
+from src.allocation import views, bootstrap, planner
+from src.allocation.adapters.read_model import ReadOnlyDatabase
+from src.allocation.adapters.view_cache import LruTtlCache, ViewCache
+from src.allocation.domain import events
+from src.allocation.domain.models import OrderLine
+from src.allocation.service_layer.projector import ReadModelProjector
 
 today = date.today()
 
@@ -18,9 +23,13 @@ def sqlite_bus(sqlite_session_factory):
     yield bus
     clear_mappers()
 
+@pytest.fixture
+def sqlite_reader(in_memory_db):
+    return ReadOnlyDatabase(in_memory_db.execution_options(isolation_level='AUTOCOMMIT'))
+
 class TestAllocationsView:
 
-    def test_allocations_view(self, sqlite_bus):
+    def test_allocations_view(self, sqlite_bus, sqlite_reader):
         """Тест для проверки правильного чтения данных размещенных заказов"""
 
         sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
@@ -32,12 +41,12 @@ class TestAllocationsView:
         sqlite_bus.handle(commands.Allocate('otherorder', 'sku1', 30))
         sqlite_bus.handle(commands.Allocate('otherorder', 'sku2', 10))
 
-        assert views.allocations('order1', sqlite_bus.uow) == [
+        assert views.allocations('order1', sqlite_reader) == [
             {'sku': 'sku1', 'batchref': 'sku1batch'},
             {'sku': 'sku2', 'batchref': 'sku2batch'}
         ]
 
-    def test_deallocatin_view(self, sqlite_bus):
+    def test_deallocatin_view(self, sqlite_bus, sqlite_reader):
         """Тест для проверки правильного чтения данных отмененных заказов"""
         sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
         sqlite_bus.handle(commands.CreateBatch('sku2batch', 'sku2', 20, today))
@@ -46,7 +55,123 @@ class TestAllocationsView:
 
         sqlite_bus.handle(commands.Deallocate('order1', 'sku1', 20))
 
-        assert views.allocations('order1', sqlite_bus.uow) == [
+        assert views.allocations('order1', sqlite_reader) == [
             {'sku': 'sku2', 'batchref': 'sku2batch'},
             {'sku': 'sku1', 'batchref': 'sku1batch'}
-        ]
\ No newline at end of file
+        ]
+
+    def test_lines_of_same_order_and_sku_are_separate_rows(self, sqlite_bus, sqlite_reader):
+        """
+        Тест для проверки ключа модели чтения: позиции одного заказа и артикула с разным количеством
+        размещены в разных партиях, отмена одной не удаляет строку другой
+        """
+        sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 5, None))
+        sqlite_bus.handle(commands.CreateBatch('sku1batch-later', 'sku1', 20, today))
+        sqlite_bus.handle(commands.Allocate('order1', 'sku1', 5))
+        sqlite_bus.handle(commands.Allocate('order1', 'sku1', 3))
+
+        assert sorted(views.allocations('order1', sqlite_reader), key=lambda row: row['batchref']) == [
+            {'sku': 'sku1', 'batchref': 'sku1batch'},
+            {'sku': 'sku1', 'batchref': 'sku1batch-later'}
+        ]
+
+        sqlite_bus.handle(commands.Deallocate('order1', 'sku1', 5))
+
+        assert views.allocations('order1', sqlite_reader) == [{'sku': 'sku1', 'batchref': 'sku1batch-later'}]
+
+class TestAllocationsViewCache:
+
+    def test_cached_view_is_invalidated_by_read_model_handlers(self, sqlite_session_factory, sqlite_reader):
+        """Тест для проверки кеша модели чтения: обработчики событий инвалидируют заказ после фиксации"""
+        cache = ViewCache(LruTtlCache(ttl=60))
+        bus = bootstrap.bootstrap(
+            start_orm=True,
+            uow=unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+            notifications=lambda *args: None,
+            view_cache=cache
+        )
+        try:
+            bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
+            assert views.allocations('order1', sqlite_reader, cache) == []
+
+            bus.handle(commands.Allocate('order1', 'sku1', 5))
+            assert views.allocations('order1', sqlite_reader, cache) == [{'sku': 'sku1', 'batchref': 'sku1batch'}]
+            assert views.allocations('order1', sqlite_reader, cache) == [{'sku': 'sku1', 'batchref': 'sku1batch'}]
+
+            bus.handle(commands.Deallocate('order1', 'sku1', 5))
+            assert views.allocations('order1', sqlite_reader, cache) == []
+        finally:
+            clear_mappers()
+
+        stats = cache.stats.as_dict()
+        assert (stats['hits'], stats['misses'], stats['invalidations']) == (1, 3, 2)
+
+
+class TestReadModelProjector:
+
+    @pytest.mark.usefixtures("mappers")
+    def test_replayed_events_do_not_duplicate_rows(self, sqlite_session_factory, sqlite_reader):
+        projector = ReadModelProjector(lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory))
+        allocated = [events.Allocated('order1', 'sku1', 10, 'b1'), events.Allocated('order1', 'sku2', 10, 'b2')]
+
+        for _ in range(2):
+            with projector.message_scope():
+                for event in allocated:
+                    projector(event)
+
+        assert views.allocations('order1', sqlite_reader) == [
+            {'sku': 'sku1', 'batchref': 'b1'},
+            {'sku': 'sku2', 'batchref': 'b2'},
+        ]
+
+    def test_reallocated_line_moves_to_new_batch(self, sqlite_bus, sqlite_reader):
+        """Тест для проверки проекции каскада: позиция, вытесненная уменьшением партии, переезжает в другую партию"""
+        sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
+        sqlite_bus.handle(commands.CreateBatch('sku1batch-later', 'sku1', 20, today))
+        sqlite_bus.handle(commands.Allocate('order1', 'sku1', 15))
+
+        sqlite_bus.handle(commands.ChangeBatchQuantity('sku1batch', 10))
+
+        assert views.allocations('order1', sqlite_reader) == [{'sku': 'sku1', 'batchref': 'sku1batch-later'}]
+
+
+def plan_summary(result):
+    return [(line['sku'], line['batchref'], line['shortage']) for line in result]
+
+
+class TestAllocationPlanner:
+
+    def test_plan_follows_allocation_rules_and_writes_nothing(self, sqlite_bus, sqlite_reader, in_memory_db):
+        """Тест для проверки плана корзины: приоритет партий, остатки после размещений, нехватка товара"""
+        sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
+        sqlite_bus.handle(commands.CreateBatch('sku1batch-later', 'sku1', 20, today))
+        sqlite_bus.handle(commands.Allocate('order1', 'sku1', 15))
+        with in_memory_db.connect() as connection:
+            version_before = connection.exec_driver_sql("SELECT version_number FROM products").scalar()
+
+        result = planner.plan([
+            OrderLine('cart', 'sku1', 5), OrderLine('cart', 'unknown', 1),
+            OrderLine('cart', 'sku1', 20), OrderLine('cart', 'sku1', 1),
+        ], sqlite_reader)
+
+        assert plan_summary(result) == [
+            ('sku1', 'sku1batch', 0), ('unknown', None, 1), ('sku1', 'sku1batch-later', 0), ('sku1', None, 1),
+        ]
+        with in_memory_db.connect() as connection:
+            assert connection.exec_driver_sql("SELECT version_number FROM products").scalar() == version_before
+            assert connection.exec_driver_sql("SELECT count(*) FROM order_lines").scalar() == 1
+        assert views.allocations('cart', sqlite_reader) == []
+
+    def test_cached_snapshot_is_reused_until_ttl(self, sqlite_bus, sqlite_reader):
+        """Тест для проверки кеша снимков: до истечения ttl план строится без запроса к БД"""
+        sqlite_bus.handle(commands.CreateBatch('sku1batch', 'sku1', 20, None))
+        cache = LruTtlCache(ttl=60)
+        cart = [OrderLine('cart', 'sku1', 10)]
+
+        planner.plan(cart, sqlite_reader, cache)
+        sqlite_bus.handle(commands.Allocate('order1', 'sku1', 15))
+
+        assert plan_summary(planner.plan(cart, sqlite_reader, cache)) == [('sku1', 'sku1batch', 0)]
+        assert cache.stats.as_dict()['hits'] == 1
+        cache.clear()
+        assert plan_summary(planner.plan(cart, sqlite_reader, cache)) == [('sku1', None, 10)]
@@ -0,0 +1,74 @@
+# Бенчмарк асинхронного пути шины: запросы, ожидающие ввода-вывода БД, обрабатываются параллельно в одном цикле событий
+import asyncio
+import time
+from src.allocation import bootstrap
+from src.allocation.domain import commands
+from tests.fake_uow import FakeAsyncRepository, FakeAsyncSession, FakeAsyncUnitOfWork
+
+DB_LATENCY = 0.02      # имитация времени выполнения запроса к БД, сек
+CONCURRENT_REQUESTS = 50
+
+
+class SlowAsyncRepository(FakeAsyncRepository):
+
+    async def _get(self, sku):
+        await asyncio.sleep(DB_LATENCY)
+        return await super()._get(sku)
+
+    async def _get_by_batchref(self, batchref):
+        await asyncio.sleep(DB_LATENCY)
+        return await super()._get_by_batchref(batchref)
+
+
+class SlowAsyncSession(FakeAsyncSession):
+
+    async def execute(self, statement, params=None):
+        await asyncio.sleep(DB_LATENCY)
+        await super().execute(statement, params)
+
+
+class SlowAsyncUnitOfWork(FakeAsyncUnitOfWork):
+
+    def __init__(self, products) -> None:
+        super().__init__(products)
+        self.products = SlowAsyncRepository(products)
+        self.session = SlowAsyncSession()
+
+    async def _commit(self) -> None:
+        await asyncio.sleep(DB_LATENCY)
+        await super()._commit()
+
+
+def elapsed_for_concurrent_allocations():
+    products = set()
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=None,
+        notifications=lambda *args: None,
+        publish=lambda *args: None,
+        async_uow_factory=lambda: SlowAsyncUnitOfWork(products)
+    )
+
+    async def scenario():
+        # у каждого запроса свой продукт: фейковые UoW, в отличие от сеансов БД, разделяют объекты агрегатов
+        await asyncio.gather(*[
+            bus.handle_async(commands.CreateBatch(f'batch-{i}', f'SKU-{i}', 100, None)) for i in range(CONCURRENT_REQUESTS)
+        ])
+        start = time.perf_counter()
+        await asyncio.gather(*[
+            bus.handle_async(commands.Allocate(f'order-{i}', f'SKU-{i}', 1)) for i in range(CONCURRENT_REQUESTS)
+        ])
+        return time.perf_counter() - start
+
+    return asyncio.run(scenario())
+
+
+class TestAsyncBusConcurrency:
+
+    def test_requests_waiting_on_db_overlap(self):
+        elapsed = elapsed_for_concurrent_allocations()
+        # одно размещение: get + commit + запись в модель чтения = 4 * DB_LATENCY
+        sequential = CONCURRENT_REQUESTS * 4 * DB_LATENCY
+        print(f'{CONCURRENT_REQUESTS} concurrent allocations: {elapsed:.3f}s (sequential: {sequential:.3f}s)')
+
+        assert elapsed < sequential / 10
@@ -0,0 +1,43 @@
+# Микробенчмарки модели партии: стоимость размещения не должна расти с количеством позиций в партии
+import timeit
+from src.allocation.domain.models import OrderLine, Batch
+
+SIZES = [100, 1_000, 10_000]
+ALLOCATIONS_PER_RUN = 200
+
+
+def make_allocated_batch(n_lines):
+    batch = Batch('batch-001', 'HOT-SKU', qty=n_lines + ALLOCATIONS_PER_RUN * 10, eta=None)
+    for i in range(n_lines):
+        batch.allocate(OrderLine(f'order-{i}', 'HOT-SKU', 1))
+    return batch
+
+
+def cost_per_allocation(n_lines):
+    """
+    Среднее время (сек) размещения одной позиции в партии, уже содержащей n_lines позиций
+    """
+    batch = make_allocated_batch(n_lines)
+    runs = iter(range(10**9))
+
+    def allocate_and_release():
+        run = next(runs)
+        lines = [OrderLine(f'extra-{run}-{i}', 'HOT-SKU', 1) for i in range(ALLOCATIONS_PER_RUN)]
+        for line in lines:
+            batch.allocate(line)
+        for line in lines:
+            batch.deallocate(line)
+
+    best = min(timeit.repeat(allocate_and_release, number=1, repeat=5))
+    return best / ALLOCATIONS_PER_RUN
+
+
+class TestBatchAllocationCost:
+
+    def test_per_allocation_cost_is_flat_as_line_count_grows(self):
+        costs = {n: cost_per_allocation(n) for n in SIZES}
+        for n, cost in costs.items():
+            print(f'{n:>6} lines: {cost * 1e6:.2f} us/allocation')
+
+        # при пересчете суммы на каждое обращение стоимость растет линейно (x100 между крайними размерами)
+        assert costs[SIZES[-1]] < costs[SIZES[0]] * 5
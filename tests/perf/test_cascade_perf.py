@@ -0,0 +1,38 @@
+# Бенчмарк каскада сообщений: уменьшение партии вытесняет n позиций и порождает 2n сообщений,
+# стоимость одного сообщения каскада не должна расти с его длиной
+import time
+from src.allocation import bootstrap
+from src.allocation.domain import commands
+from tests.fake_uow import FakeUnitOfWork
+
+SIZES = [1_000, 8_000]
+
+
+def cost_per_cascade_message(n_lines):
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=lambda *args: None,
+        publish=lambda *args: None
+    )
+    bus.handle(commands.CreateBatch('batch1', 'HOT-SKU', n_lines, None))
+    bus.handle(commands.CreateBatch('batch2', 'HOT-SKU', n_lines, None))
+    bus.handle(commands.AllocateMany([commands.Allocate(f'order-{i}', 'HOT-SKU', 1) for i in range(n_lines)]))
+
+    start = time.perf_counter()
+    bus.handle(commands.ChangeBatchQuantity('batch1', 0))
+    elapsed = time.perf_counter() - start
+
+    last = bus.cascade_metrics.as_dict()['recent'][-1]
+    assert last['messages'] == 1 + 2 * n_lines
+    return elapsed / last['messages']
+
+
+class TestCascadeCost:
+
+    def test_per_message_cost_does_not_grow_with_cascade_length(self):
+        costs = {n: cost_per_cascade_message(n) for n in SIZES}
+        for n, cost in costs.items():
+            print(f'{2 * n + 1:>6} messages: {cost * 1e6:.2f} us/message')
+
+        assert costs[SIZES[-1]] < costs[SIZES[0]] * 3
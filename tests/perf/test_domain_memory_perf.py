@@ -0,0 +1,90 @@
+# Бенчмарк памяти доменных объектов (tracemalloc): байт на событие Allocated с __slots__ и с __dict__,
+# байт на размещенную позицию продукта, загруженного ORM, с интернированием артикула позиций и без него
+import gc
+import tracemalloc
+from dataclasses import dataclass
+import pytest
+from sqlalchemy import event
+from src.allocation.adapters import orm
+from src.allocation.domain import commands, events, models
+from src.allocation.service_layer import unit_of_work
+from src.allocation import bootstrap
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+EVENTS = 100_000
+LINES = 20_000
+
+
+@dataclass
+class DictAllocated:
+    """
+    Прежнее представление события Allocated - экземпляр с __dict__
+    """
+    orderid: str
+    sku: str
+    qty: int
+    batchref: str
+
+
+def traced_bytes(build):
+    """
+    Память, занятая результатом build(), который удерживается до замера
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = build()
+        gc.collect()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return size
+
+
+def allocated_events(event_class, orderids):
+    return [event_class(orderid, 'HOT-SKU', 1, 'hot-batch') for orderid in orderids]
+
+
+def load_product(session_factory):
+    session = session_factory()
+    product = session.query(models.Product).filter_by(sku='HOT-SKU').one()
+    assert len(product.batches[0]._allocations) == LINES
+    return session, product
+
+
+class TestDomainMemory:
+
+    def test_slotted_events_take_less_memory(self):
+        orderids = [f'order-{i}' for i in range(EVENTS)]    # строки общие для обоих замеров
+        slotted = traced_bytes(lambda: allocated_events(events.Allocated, orderids)) / EVENTS
+        with_dict = traced_bytes(lambda: allocated_events(DictAllocated, orderids)) / EVENTS
+        print(f'Allocated: {slotted:.0f} bytes with __slots__, {with_dict:.0f} bytes with __dict__')
+
+        assert not hasattr(events.Allocated('o1', 'HOT-SKU', 1, 'hot-batch'), '__dict__')
+        assert not hasattr(commands.Allocate('o1', 'HOT-SKU', 1), '__dict__')
+        assert slotted < with_dict * 0.7
+
+    def test_loaded_lines_share_interned_sku(self, sqlite_session_factory):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_session_factory),
+            notifications=lambda *args: None,
+            publish=lambda *args: None,
+            view_cache=None
+        )
+        bus.handle(commands.CreateBatch('hot-batch', 'HOT-SKU', LINES, None))
+        bus.handle(commands.AllocateMany([commands.Allocate(f'order-{i}', 'HOT-SKU', 1) for i in range(LINES)]))
+
+        interned = traced_bytes(lambda: load_product(sqlite_session_factory)) / LINES
+        event.remove(models.OrderLine, 'load', orm._intern_line_sku)
+        try:
+            copied = traced_bytes(lambda: load_product(sqlite_session_factory)) / LINES
+        finally:
+            event.listen(models.OrderLine, 'load', orm._intern_line_sku)
+        print(f'Allocated line of a loaded product: {interned:.0f} bytes with interned sku, {copied:.0f} bytes without')
+
+        _, product = load_product(sqlite_session_factory)
+        assert len({id(line.sku) for line in product.batches[0]._allocations}) == 1
+        assert interned < copied
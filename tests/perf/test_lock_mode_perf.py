@@ -0,0 +1,88 @@
+# Бенчмарк режимов блокировки продукта на одном "горячем" артикуле:
+# сколько транзакций отменено из-за конфликта и какова задержка p99 размещения (нужен PostgreSQL)
+import threading
+import time
+import pytest
+from sqlalchemy.sql import text
+from src.allocation import bootstrap
+from src.allocation.adapters import repository
+from src.allocation.domain import commands
+from src.allocation.domain.exceptions import ConcurrencyConflict
+from src.allocation.service_layer import unit_of_work
+from tests.random_refs import random_batchref, random_orderid, random_sku
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+WORKERS = 8
+ALLOCATIONS_PER_WORKER = 20
+
+
+class AbortCountingUnitOfWork(unit_of_work.SqlAlchemyUnitOfWork):
+    """
+    UoW, подсчитывающий фиксации, отмененные из-за конфликта параллельного изменения
+    """
+    aborts = 0
+    lock = threading.Lock()
+
+    def _commit(self) -> None:
+        try:
+            super()._commit()
+        except ConcurrencyConflict:
+            with self.lock:
+                type(self).aborts += 1
+            raise
+
+
+def percentile(values, p):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * p))]
+
+
+def run_contended_allocations(session_factory, lock_mode):
+    sku = random_sku(lock_mode)
+    session = session_factory()
+    session.execute(text('INSERT INTO products (sku, version_number) VALUES (:sku, 1)').bindparams(sku=sku))
+    session.execute(text(
+        'INSERT INTO batches (reference, sku, _purchased_quantity, eta) VALUES (:ref, :sku, 10000, NULL)'
+    ).bindparams(ref=random_batchref(lock_mode), sku=sku))
+    session.commit()
+
+    AbortCountingUnitOfWork.aborts = 0
+    lock_policy = repository.ProductLockPolicy(lock_mode)
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=lambda: AbortCountingUnitOfWork(session_factory, lock_policy=lock_policy),
+        notifications=lambda *args: None,
+        publish=lambda *args: None
+    )
+    bus.max_conflict_attempts = 100
+
+    latencies, exceptions = [], []
+    def allocate_many_times(worker):
+        for i in range(ALLOCATIONS_PER_WORKER):
+            start = time.perf_counter()
+            try:
+                bus.handle(commands.Allocate(random_orderid(f'{worker}-{i}'), sku, 1))
+            except Exception as e:
+                exceptions.append(e)
+            latencies.append(time.perf_counter() - start)
+
+    threads = [threading.Thread(target=allocate_many_times, args=(w,)) for w in range(WORKERS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert exceptions == []
+    return AbortCountingUnitOfWork.aborts, percentile(latencies, 0.99)
+
+
+class TestLockModeOnHotSku:
+
+    def test_pessimistic_lock_avoids_serialization_aborts(self, postgres_session_factory):
+        results = {mode: run_contended_allocations(postgres_session_factory, mode) for mode in repository.LOCK_MODES}
+        for mode, (aborts, p99) in results.items():
+            print(f'{mode:>11}: {aborts} aborts, p99 {p99 * 1e3:.1f} ms')
+
+        assert results['pessimistic'][0] == 0
+        assert results['pessimistic'][0] <= results['optimistic'][0]
@@ -0,0 +1,54 @@
+# Бенчмарк планировщика: корзина из нескольких позиций через настоящее размещение (AllocateMany: загрузка агрегатов,
+# фиксация, модель чтения) и через пробное размещение по кешированным снимкам остатков (planner.plan)
+import time
+import pytest
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import create_engine
+from src.allocation import bootstrap, planner
+from src.allocation.adapters.read_model import ReadOnlyDatabase
+from src.allocation.adapters.view_cache import LruTtlCache
+from src.allocation.domain import commands
+from src.allocation.domain.models import OrderLine
+from src.allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+SKUS = ('LAMP', 'TABLE', 'CHAIR')
+HISTORY = 300       # размещенных позиций каждого артикула до замера
+CARTS = 50
+
+
+def cart(n):
+    return [OrderLine(f'cart-{n}', sku, 1) for sku in SKUS for _ in range(2)]
+
+
+class TestPlannerPerf:
+
+    def test_plan_is_an_order_of_magnitude_faster_than_allocation(self, sqlite_file_db, sqlite_file_session_factory):
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(sqlite_file_session_factory),
+            notifications=lambda *args: None,
+            publish=lambda *args: None,
+            view_cache=None
+        )
+        for sku in SKUS:
+            bus.handle(commands.CreateBatch(f'{sku}-batch', sku, 10**6, None))
+            bus.handle(commands.AllocateMany([commands.Allocate(f'history-{i}', sku, 1) for i in range(HISTORY)]))
+        reader = ReadOnlyDatabase(create_engine(sqlite_file_db.url, poolclass=QueuePool, isolation_level='AUTOCOMMIT'))
+        cache = LruTtlCache(ttl=60)
+
+        start = time.perf_counter()
+        for n in range(CARTS):
+            bus.handle(commands.AllocateMany([commands.Allocate(line.orderid, line.sku, line.qty) for line in cart(n)]))
+        allocate_time = (time.perf_counter() - start) / CARTS
+
+        planner.plan(cart(0), reader, cache)    # снимки попадают в кеш
+        start = time.perf_counter()
+        for n in range(CARTS):
+            result = planner.plan(cart(n), reader, cache)
+        plan_time = (time.perf_counter() - start) / CARTS
+        print(f'allocate: {allocate_time * 1e3:.2f} ms/cart, plan: {plan_time * 1e3:.3f} ms/cart')
+
+        assert all(line['batchref'] is not None for line in result)
+        assert plan_time * 10 < allocate_time
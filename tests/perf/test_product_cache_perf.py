@@ -0,0 +1,53 @@
+# Бенчмарк кеша агрегатов: размещение в горячем артикуле с большой историей размещений,
+# агрегат загружается из БД целиком (партии и позиции) либо берется из кеша после проверки версии
+import time
+import pytest
+from src.allocation.adapters.product_cache import ProductCache
+from src.allocation.domain import commands
+from src.allocation.service_layer import unit_of_work
+from src.allocation import bootstrap
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+HISTORY = 1_000     # размещенных позиций продукта до замера
+ALLOCATIONS = 50
+
+
+def make_bus(session_factory, cache=None):
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow_factory=lambda: unit_of_work.SqlAlchemyUnitOfWork(session_factory, product_cache=cache),
+        notifications=lambda *args: None,
+        publish=lambda *args: None,
+        view_cache=None
+    )
+
+
+def allocate(bus, prefix):
+    start = time.perf_counter()
+    for i in range(ALLOCATIONS):
+        bus.handle(commands.Allocate(f'{prefix}-{i}', 'HOT-SKU', 1))
+    return (time.perf_counter() - start) / ALLOCATIONS
+
+
+class TestProductCachePerf:
+
+    def test_cached_aggregate_skips_full_reload(self, sqlite_file_session_factory):
+        setup_bus = make_bus(sqlite_file_session_factory)
+        setup_bus.handle(commands.CreateBatch('hot-batch', 'HOT-SKU', 10**6, None))
+        setup_bus.handle(commands.AllocateMany([
+            commands.Allocate(f'history-{i}', 'HOT-SKU', 1) for i in range(HISTORY)
+        ]))
+
+        uncached = allocate(make_bus(sqlite_file_session_factory), 'uncached')
+        cache = ProductCache()
+        cached = allocate(make_bus(sqlite_file_session_factory, cache), 'cached')
+        stats = cache.stats.as_dict()
+        print(
+            f'without cache: {uncached * 1e3:.2f} ms/allocation, with cache: {cached * 1e3:.2f} ms/allocation, '
+            f'hit ratio {stats["hit_ratio"]:.2%}, saved {stats["saved_seconds"]:.2f} s'
+        )
+
+        assert stats['hits'] == ALLOCATIONS - 1
+        assert stats['saved_seconds'] > 0
+        assert cached < uncached
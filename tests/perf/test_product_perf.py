@@ -0,0 +1,43 @@
+# Бенчмарк выбора партии в продукте: стоимость размещения должна расти не быстрее log(n) от числа партий
+import timeit
+from datetime import date, timedelta
+from src.allocation.domain.models import OrderLine, Batch, Product
+
+SIZES = [10, 100, 1_000]
+ALLOCATIONS_PER_RUN = 200
+
+
+def make_product(n_batches):
+    """
+    Продукт, у которого товар остался только в последней по сроку партии,
+    поэтому размещение должно пропустить все остальные партии
+    """
+    start = date(2011, 1, 1)
+    batches = [Batch(f'batch-{i}', 'HOT-SKU', 0, eta=start + timedelta(days=i)) for i in range(n_batches - 1)]
+    batches.append(Batch('last-batch', 'HOT-SKU', 10**9, eta=start + timedelta(days=n_batches)))
+    return Product('HOT-SKU', batches=batches)
+
+
+def cost_per_allocation(n_batches):
+    product = make_product(n_batches)
+    runs = iter(range(10**9))
+
+    def allocate_lines():
+        run = next(runs)
+        for i in range(ALLOCATIONS_PER_RUN):
+            product.allocate(OrderLine(f'order-{run}-{i}', 'HOT-SKU', 1))
+        product.events.clear()
+
+    best = min(timeit.repeat(allocate_lines, number=1, repeat=5))
+    return best / ALLOCATIONS_PER_RUN
+
+
+class TestProductAllocationCost:
+
+    def test_per_allocation_cost_grows_logarithmically_with_batch_count(self):
+        costs = {n: cost_per_allocation(n) for n in SIZES}
+        for n, cost in costs.items():
+            print(f'{n:>5} batches: {cost * 1e6:.2f} us/allocation')
+
+        # при сортировке и линейном поиске на каждое размещение стоимость растет в сотни раз
+        assert costs[SIZES[-1]] < costs[SIZES[0]] * 5
@@ -0,0 +1,49 @@
+# Бенчмарк пути чтения: накладные расходы одного запроса allocations_view через UoW (сеанс ORM, репозиторий,
+# транзакция с откатом) и через ReadOnlyDatabase (соединение движка в режиме AUTOCOMMIT)
+import timeit
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql import text
+from src.allocation import views
+from src.allocation.adapters import orm
+from src.allocation.adapters.read_model import ReadOnlyDatabase
+from src.allocation.service_layer import unit_of_work
+
+pytestmark = pytest.mark.usefixtures("mappers")
+
+READS = 2_000
+
+
+def allocations_through_uow(orderid, uow):
+    """
+    Прежний путь чтения views.allocations
+    """
+    with uow:
+        results = list(uow.session.execute(text(
+            'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid'
+        ).bindparams(orderid=orderid)))
+    return [{'sku': sku, 'batchref': batchref} for sku, batchref in results]
+
+
+class TestReadPath:
+
+    def test_read_only_path_has_less_overhead_than_uow(self, tmp_path):
+        url = f'sqlite:///{tmp_path / "read_path.db"}'
+        engine = create_engine(url, poolclass=QueuePool)    # пул соединений, как у движков PostgreSQL приложения
+        orm.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(
+                text('INSERT INTO allocations_view (orderid, sku, qty, batchref) VALUES (:orderid, :sku, 1, :batchref)'),
+                [{'orderid': f'order-{i}', 'sku': 'LAMP', 'batchref': f'batch-{i}'} for i in range(1000)]
+            )
+        uow = unit_of_work.SqlAlchemyUnitOfWork(sessionmaker(bind=engine))
+        reader = ReadOnlyDatabase(create_engine(url, poolclass=QueuePool, isolation_level='AUTOCOMMIT'))
+        assert allocations_through_uow('order-1', uow) == views.allocations('order-1', reader)
+
+        uow_time = min(timeit.repeat(lambda: allocations_through_uow('order-1', uow), number=READS, repeat=3)) / READS
+        reader_time = min(timeit.repeat(lambda: views.allocations('order-1', reader), number=READS, repeat=3)) / READS
+        print(f'UoW: {uow_time * 1e6:.1f} us/read, read-only connection: {reader_time * 1e6:.1f} us/read')
+
+        assert reader_time < uow_time * 0.7
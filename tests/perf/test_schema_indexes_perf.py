@@ -0,0 +1,99 @@
+# Бенчмарк индексов схемы: время запросов модели чтения и поиска партии по ссылке на большом объеме данных
+# до (таблицы без индексов) и после (схема adapters/orm.py); объем - PERF_INDEX_ROWS строк, по умолчанию 1M
+import os
+import timeit
+from sqlalchemy import MetaData, Table, Column, Integer, String, create_engine
+from sqlalchemy.sql import text
+from src.allocation.adapters import orm
+
+ROWS = int(os.environ.get('PERF_INDEX_ROWS', 1_000_000))
+LOOKUPS = 20
+CHUNK = 50_000
+
+
+def unindexed_metadata() -> MetaData:
+    """
+    Таблицы в прежнем виде: без первичного ключа и индексов
+    """
+    metadata = MetaData()
+    Table(
+        'allocations_view', metadata,
+        Column('orderid', String(255)), Column('sku', String(255)), Column('qty', Integer), Column('batchref', String(255))
+    )
+    Table(
+        'batches', metadata,
+        Column('id', Integer, primary_key=True), Column('reference', String(255)), Column('sku', String(255)),
+        Column('_purchased_quantity', Integer), Column('eta', String(10))
+    )
+    return metadata
+
+
+def fill(engine):
+    with engine.begin() as connection:
+        for start in range(0, ROWS, CHUNK):
+            numbers = range(start, min(start + CHUNK, ROWS))
+            connection.execute(
+                text('INSERT INTO allocations_view (orderid, sku, qty, batchref) VALUES (:orderid, :sku, 1, :batchref)'),
+                [{'orderid': f'order-{i // 2}', 'sku': f'sku-{i % 2}', 'batchref': f'batch-{i}'} for i in numbers]
+            )
+            connection.execute(
+                text('INSERT INTO batches (reference, sku, _purchased_quantity) VALUES (:ref, :sku, 100)'),
+                [{'ref': f'batch-{i}', 'sku': f'sku-{i % 1000}'} for i in numbers]
+            )
+
+
+QUERIES = {
+    'select view by orderid': (
+        'SELECT sku, batchref FROM allocations_view WHERE orderid = :orderid', lambda i: {'orderid': f'order-{i}'}
+    ),
+    'delete view by (orderid, sku, qty)': (
+        'DELETE FROM allocations_view WHERE orderid = :orderid AND sku = :sku AND qty = 1',
+        lambda i: {'orderid': f'order-{i}', 'sku': 'sku-0'}
+    ),
+    'select batch by reference': (
+        'SELECT sku FROM batches WHERE reference = :ref', lambda i: {'ref': f'batch-{i}'}
+    ),
+}
+
+
+def query_times(engine):
+    """
+    Среднее время (сек) каждого запроса; удаления откатываются, чтобы не менять данные между прогонами
+    """
+    times = {}
+    with engine.connect() as connection:
+        for name, (sql, params) in QUERIES.items():
+            keys = iter(range(7, 10**9, ROWS // (LOOKUPS * 3) or 1))
+            statement = text(sql)
+
+            def run():
+                transaction = connection.begin()
+                connection.execute(statement, params(next(keys) % (ROWS // 2)))
+                transaction.rollback()
+
+            times[name] = min(timeit.repeat(run, number=LOOKUPS, repeat=3)) / LOOKUPS
+    return times
+
+
+def query_plan(engine, sql, params):
+    with engine.connect() as connection:
+        return ' '.join(str(row[-1]) for row in connection.execute(text(f'EXPLAIN QUERY PLAN {sql}'), params))
+
+
+class TestSchemaIndexes:
+
+    def test_indexes_make_lookups_independent_of_table_size(self):
+        before = create_engine('sqlite://')
+        unindexed_metadata().create_all(before)
+        after = create_engine('sqlite://')
+        orm.metadata.create_all(after)
+        for engine in (before, after):
+            fill(engine)
+
+        before_times, after_times = query_times(before), query_times(after)
+        for name in QUERIES:
+            print(f'{name:<32} {ROWS:>9} rows: {before_times[name] * 1e3:9.3f} ms -> {after_times[name] * 1e3:7.3f} ms')
+
+        for name, (sql, params) in QUERIES.items():
+            assert 'SCAN' not in query_plan(after, sql, params(1)).replace('SCAN CONSTANT', '')
+            assert after_times[name] < before_times[name] / 10
@@ -71,5 +71,41 @@ class TestDeallocateBatches:
         assert batch.available_quantity == 20
 
 
+    def test_deallocate_reduces_allocated_quantity(self):
+        """
+        Тест для проверки уменьшения накопленной суммы размещенных позиций при отмене размещения
+        """
+        batch, line = make_batch_and_line("DECORATIVE-TRINKET", 20, 2)
+        batch.allocate(line)
+        batch.deallocate(line)
+        batch.deallocate(line)
+
+        assert batch.allocated_quantity == 0
+        assert batch.available_quantity == 20
+
 
+    def test_deallocate_one_reduces_allocated_quantity(self):
+        """
+        Тест для проверки уменьшения накопленной суммы размещенных позиций при отмене размещения одной позиции
+        """
+        batch = Batch("batch-001", "DECORATIVE-TRINKET", 20, eta=None)
+        batch.allocate(OrderLine('order-1', "DECORATIVE-TRINKET", 5))
+        batch.allocate(OrderLine('order-2', "DECORATIVE-TRINKET", 7))
+
+        line = batch.deallocate_one()
+
+        assert batch.allocated_quantity == 12 - line.qty
+
+class TestAllocatedQuantity:
+
+    def test_allocated_quantity_is_recalculated_after_reset(self):
+        """
+        Тест для проверки пересчета суммы по _allocations, как это происходит после загрузки партии из БД
+        """
+        batch, line = make_batch_and_line("BLUE-VASE", 20, 2)
+        batch.allocate(line)
+        batch._allocations.add(OrderLine('order-loaded', "BLUE-VASE", 3))   # имитация коллекции, загруженной ORM
+        batch.reset_allocated_quantity()
 
+        assert batch.allocated_quantity == 5
+        assert batch.available_quantity == 15
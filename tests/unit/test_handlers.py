@@ -1,45 +1,33 @@
 # Тесты, касающиеся оркестровки
+import asyncio
+import threading
 from collections import defaultdict
 import pytest
 from datetime import date
 from src.allocation import bootstrap
-from src.allocation.adapters import repository, notifications
-from src.allocation.service_layer import unit_of_work, messagebus, handlers
+from src.allocation.adapters import notifications
+from src.allocation.service_layer import messagebus, handlers
+from src.allocation.service_layer.dispatcher import BackgroundEventDispatcher
+from src.allocation.service_layer.projector import UPSERT_ALLOCATIONS
 from src.allocation.domain import events, commands
+from src.allocation.domain.exceptions import ConcurrencyConflict
+from src.allocation.domain.models import Product, Batch
+from tests.fake_uow import FakeUnitOfWork, FakeAsyncUnitOfWork
 
-class FakeRepository(repository.AbstractProductRepositoriy):
+class ConflictingUnitOfWork(FakeUnitOfWork):
     """
-    Фейковый репозиторий для тестирования приложения
+    Фейковый UoW, фиксация которого первые conflicts раз падает из-за параллельного изменения продукта
     """
-
-    def __init__(self, products) -> None:
+    def __init__(self, conflicts: int) -> None:
         super().__init__()
-        self._products = set(products)
-
-    def _add(self, product):
-        self._products.add(product)
-
-    def _get(self, sku):
-        return next((b for b in self._products if b.sku == sku), None)
-    
-    def _get_by_batchref(self, batchref):
-        return next((p for p in self._products for b in p.batches if b.reference == batchref), None)
-
-    
-
-class FakeUnitOfWork(unit_of_work.AbstractUnitOfWork):
-    """
-    Фейковая реализация UoW для тестирования
-    """
-    def __init__(self) -> None:
-        self.products = FakeRepository([])
-        self.commited = False
+        self.conflicts = conflicts
+        self.attempts = 0
 
     def _commit(self) -> None:
-        self.commited = True
-
-    def rollback(self) -> None:
-        pass
+        self.attempts += 1
+        if self.attempts <= self.conflicts:
+            raise ConcurrencyConflict('Продукт изменен параллельной транзакцией')
+        super()._commit()
 
 def bootstrap_test_app():
     return bootstrap.bootstrap(
@@ -49,6 +37,27 @@ def bootstrap_test_app():
         publish=lambda *args: None
     )
 
+def bootstrap_async_test_app(notifications=lambda *args: None):
+    """
+    Шина с асинхронным путем обработки; возвращает также список созданных асинхронных UoW
+    """
+    products = set()
+    created_uows = []
+
+    def async_uow_factory():
+        uow = FakeAsyncUnitOfWork(products)
+        created_uows.append(uow)
+        return uow
+
+    bus = bootstrap.bootstrap(
+        start_orm=False,
+        uow=FakeUnitOfWork(),
+        notifications=notifications,
+        publish=lambda *args: None,
+        async_uow_factory=async_uow_factory
+    )
+    return bus, created_uows
+
 # TODO: довести до ума
 class FakeMessageBus(messagebus.AbstractMessageBus):
     """
@@ -112,6 +121,77 @@ class TestAllocate:
         assert bus.uow.commited is True
 
 
+class TestAllocateMany:
+
+    def test_allocates_all_lines_in_one_commit(self):
+        """
+        Тест для проверки размещения нескольких позиций разных артикулов с одной фиксацией
+        """
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('b1', 'COMPLICATED-LAMP', 100, None))
+        bus.handle(commands.CreateBatch('b2', 'SMALL-TABLE', 100, None))
+        commits_before = bus.uow.commits
+
+        [batchrefs] = bus.handle(commands.AllocateMany([
+            commands.Allocate('o1', 'COMPLICATED-LAMP', 10),
+            commands.Allocate('o1', 'SMALL-TABLE', 10),
+            commands.Allocate('o2', 'COMPLICATED-LAMP', 10),
+        ]))
+
+        assert batchrefs == ['b1', 'b2', 'b1']
+        # одна фиксация всех размещений и одна на обновление модели чтения всеми событиями Allocated
+        assert bus.uow.commits == commits_before + 2
+        [(_, rows)] = bus.uow.session.executed[-1:]
+        assert sorted((row['orderid'], row['sku']) for row in rows) == [
+            ('o1', 'COMPLICATED-LAMP'), ('o1', 'SMALL-TABLE'), ('o2', 'COMPLICATED-LAMP')
+        ]
+        assert bus.uow.products.get('COMPLICATED-LAMP').batches[0].available_quantity == 80
+
+    def test_returns_none_for_out_of_stock_lines(self):
+        fake_notifs = FakeNotifications()
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=fake_notifs,
+            publish=lambda *args: None
+        )
+        bus.handle(commands.CreateBatch('b1', 'POPULAR-CURTAINS', 15, None))
+
+        [batchrefs] = bus.handle(commands.AllocateMany([
+            commands.Allocate('o1', 'POPULAR-CURTAINS', 10),
+            commands.Allocate('o2', 'POPULAR-CURTAINS', 10),
+        ]))
+
+        assert batchrefs == ['b1', None]
+        assert fake_notifs.sent['stock@made.com'] == [f'Артикула POPULAR-CURTAINS нет в наличии']
+
+    def test_error_for_invalid_sku_allocates_nothing(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('b1', 'EXIST', 100, None))
+        commits_before = bus.uow.commits
+
+        with pytest.raises(handlers.InvalidSku, match=f'Недопустимый артикул NONE'):
+            bus.handle(commands.AllocateMany([
+                commands.Allocate('o1', 'EXIST', 10),
+                commands.Allocate('o1', 'NONE', 10),
+            ]))
+        assert bus.uow.commits == commits_before
+
+
+class TestDeallocate:
+
+    def test_returns_deallocated_batch(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('b1', 'COMPLICATED-LAMP', 100, None))
+        bus.handle(commands.CreateBatch('b2', 'COMPLICATED-LAMP', 100, date.today()))
+        bus.handle(commands.Allocate('o1', 'COMPLICATED-LAMP', 100))
+        bus.handle(commands.Allocate('o2', 'COMPLICATED-LAMP', 10))
+
+        result = bus.handle(commands.Deallocate('o2', 'COMPLICATED-LAMP', 10))
+        assert result.pop(0) == 'b2'
+        assert bus.uow.products.get('COMPLICATED-LAMP').line_index_is_consistent()
+
+
 class TestChangeBatchQuantity:
 
     def test_changes_available_quantity(self):
@@ -150,6 +230,181 @@ class TestChangeBatchQuantity:
         assert batch1.available_quantity == 5
         assert batch2.available_quantity == 30
 
+class TestConcurrencyConflict:
+
+    def bootstrap_conflicting_app(self, conflicts, max_conflict_attempts=3, publish=lambda *args: None):
+        """
+        Шина с продуктом SHARED-LAMP, фиксация изменений которого первые conflicts раз завершается конфликтом
+        """
+        uow = ConflictingUnitOfWork(conflicts)
+        uow.products.add(Product('SHARED-LAMP', [Batch('b1', 'SHARED-LAMP', 100, None)]))
+        bus = bootstrap.bootstrap(
+            start_orm=False,
+            uow=uow,
+            notifications=lambda *args: None,
+            publish=publish
+        )
+        bus.max_conflict_attempts = max_conflict_attempts
+        return bus
+
+    def test_command_is_retried_after_conflict(self):
+        bus = self.bootstrap_conflicting_app(conflicts=2)
+
+        bus.handle(commands.ChangeBatchQuantity('b1', 50))
+        assert bus.uow.attempts == 3
+        assert bus.uow.commits == 1
+        assert bus.uow.products.get('SHARED-LAMP').batches[0].available_quantity == 50
+
+    def test_conflict_is_raised_when_attempts_are_exhausted(self):
+        bus = self.bootstrap_conflicting_app(conflicts=5, max_conflict_attempts=2)
+
+        with pytest.raises(ConcurrencyConflict):
+            bus.handle(commands.ChangeBatchQuantity('b1', 50))
+        assert bus.uow.attempts == 2
+        assert bus.uow.commits == 0
+
+    def test_events_of_failed_attempt_are_discarded(self):
+        published = []
+        bus = self.bootstrap_conflicting_app(conflicts=1, publish=published.append)
+
+        bus.handle(commands.Allocate('o1', 'SHARED-LAMP', 10))
+        assert published == [events.Allocated('o1', 'SHARED-LAMP', 10, 'b1')]
+
+
+class TestCascade:
+
+    def test_reallocation_cascade_is_measured(self):
+        """
+        Тест для проверки метрик каскада: уменьшение партии порождает Allocate и Allocated для каждой вытесненной позиции
+        """
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('batch1', 'INDIFFERENT-TABLE', 50, None))
+        bus.handle(commands.CreateBatch('batch2', 'INDIFFERENT-TABLE', 50, date.today()))
+        for i in range(5):
+            bus.handle(commands.Allocate(f'order{i}', 'INDIFFERENT-TABLE', 10))
+
+        bus.handle(commands.ChangeBatchQuantity('batch1', 20))
+
+        last = bus.cascade_metrics.as_dict()['recent'][-1]
+        assert last['message'] == 'ChangeBatchQuantity'
+        assert last['messages'] == 1 + 3 * 2     # команда, 3 команды Allocate и 3 события Allocated
+        assert last['depth'] == 2
+        assert bus.cascade_metrics.as_dict()['handled'] == 8
+
+    def test_cascade_longer_than_limit_is_stopped(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('batch1', 'INDIFFERENT-TABLE', 50, None))
+        for i in range(5):
+            bus.handle(commands.Allocate(f'order{i}', 'INDIFFERENT-TABLE', 10))
+        bus.max_cascade_length = 3
+
+        with pytest.raises(messagebus.CascadeLimitExceeded):
+            bus.handle(commands.ChangeBatchQuantity('batch1', 20))
+        assert bus.cascade_metrics.as_dict()['limit_exceeded'] == 1
+
+    def test_cascade_deeper_than_limit_is_stopped(self):
+        bus = bootstrap_test_app()
+        bus.handle(commands.CreateBatch('batch1', 'INDIFFERENT-TABLE', 50, None))
+        bus.max_cascade_depth = 0
+
+        with pytest.raises(messagebus.CascadeLimitExceeded):
+            bus.handle(commands.Allocate('order1', 'INDIFFERENT-TABLE', 10))
+
+
+class TestBackgroundEvents:
+
+    def bootstrap_background_app(self, publish, **dispatcher_options):
+        dispatcher_options.setdefault('retry_wait_max', 0)
+        return bootstrap.bootstrap(
+            start_orm=False,
+            uow=FakeUnitOfWork(),
+            notifications=lambda *args: None,
+            publish=publish,
+            event_dispatcher=BackgroundEventDispatcher(**dispatcher_options)
+        )
+
+    def test_command_returns_before_event_handlers_run(self):
+        """
+        Тест для проверки фоновой обработки: результат команды возвращается, пока медленная публикация события еще не завершена
+        """
+        release, published = threading.Event(), []
+        def slow_publish(event):
+            release.wait(timeout=5)
+            published.append(event)
+
+        bus = self.bootstrap_background_app(slow_publish)
+        bus.handle(commands.CreateBatch('b1', 'SLOW-LAMP', 100, None))
+
+        [batchref] = bus.handle(commands.Allocate('o1', 'SLOW-LAMP', 10))
+        assert batchref == 'b1'
+        assert published == []
+
+        release.set()
+        assert bus.drain(timeout=5)
+        assert published == [events.Allocated('o1', 'SLOW-LAMP', 10, 'b1')]
+        bus.shutdown()
+
+    def test_background_handlers_use_dispatcher_retry_policy(self):
+        attempts, published = [], []
+        def flaky_publish(event):
+            attempts.append(event)
+            if len(attempts) < 4:
+                raise ConnectionError('Redis недоступен')
+            published.append(event)
+
+        bus = self.bootstrap_background_app(flaky_publish, retry_attempts=4)
+        bus.handle(commands.CreateBatch('b1', 'FLAKY-LAMP', 100, None))
+        bus.handle(commands.Allocate('o1', 'FLAKY-LAMP', 10))
+
+        assert bus.drain(timeout=5)
+        assert len(attempts) == 4
+        assert published == [events.Allocated('o1', 'FLAKY-LAMP', 10, 'b1')]
+        bus.shutdown()
+
+    def test_async_path_dispatches_events_in_background(self):
+        published = []
+        bus = self.bootstrap_background_app(published.append)
+        bus.async_uow_factory = lambda: FakeAsyncUnitOfWork(bus.uow.products._products)
+
+        async def scenario():
+            await bus.handle_async(commands.CreateBatch('b1', 'ASYNC-LAMP', 100, None))
+            return await bus.handle_async(commands.Allocate('o1', 'ASYNC-LAMP', 10))
+
+        assert asyncio.run(scenario()) == ['b1']
+        assert bus.drain(timeout=5)
+        assert published == [events.Allocated('o1', 'ASYNC-LAMP', 10, 'b1')]
+        assert bus.event_dispatcher.stats() == {'submitted': 1, 'pending': 0, 'failed': 0}
+        bus.shutdown()
+
+    def test_background_events_of_one_call_are_projected_in_one_transaction(self):
+        """
+        Тест для проверки фоновой пачки: события одного вызова handle обрабатываются в рабочем потоке
+        в одной области шины, и модель чтения применяет их одной транзакцией
+        """
+        published = []
+        bus = self.bootstrap_background_app(published.append)
+        bus.handle(commands.CreateBatch('b1', 'BATCH-LAMP', 100, None))
+        executed = len(bus.uow.session.executed)
+
+        bus.handle(commands.AllocateMany([commands.Allocate(f'o{i}', 'BATCH-LAMP', 10) for i in range(3)]))
+
+        assert bus.drain(timeout=5)
+        [(statement, rows)] = bus.uow.session.executed[executed:]
+        assert statement is UPSERT_ALLOCATIONS and len(rows) == 3
+        assert len(published) == 3
+        assert bus.event_dispatcher.stats() == {'submitted': 1, 'pending': 0, 'failed': 0}
+        bus.shutdown()
+
+    def test_events_are_handled_inline_after_shutdown(self):
+        published = []
+        bus = self.bootstrap_background_app(published.append)
+        bus.handle(commands.CreateBatch('b1', 'LATE-LAMP', 100, None))
+        assert bus.shutdown(timeout=5)
+
+        bus.handle(commands.Allocate('o1', 'LATE-LAMP', 10))
+        assert published == [events.Allocated('o1', 'LATE-LAMP', 10, 'b1')]
+
+
 class TestSendNotification:
 
     def test_sends_email_on_out_of_stock_error(self):
@@ -163,4 +418,51 @@ class TestSendNotification:
 
         bus.handle(commands.CreateBatch('b1', 'POPULAR-CURTAINS', 9, None))
         bus.handle(commands.Allocate('o1', 'POPULAR-CURTAINS', 10))
-        assert fake_notifs.sent['stock@made.com'] == [f'Артикула POPULAR-CURTAINS нет в наличии']
\ No newline at end of file
+        assert fake_notifs.sent['stock@made.com'] == [f'Артикула POPULAR-CURTAINS нет в наличии']
+
+
+class TestHandleAsync:
+
+    def test_returns_allocation(self):
+        """
+        Тест для проверки асинхронного пути обработки команд через handle_async
+        """
+        bus, _ = bootstrap_async_test_app()
+
+        async def scenario():
+            await bus.handle_async(commands.CreateBatch('b1', 'COMPLICATED-LAMP', 100, None))
+            return await bus.handle_async(commands.Allocate('o1', 'COMPLICATED-LAMP', 10))
+
+        assert asyncio.run(scenario()) == ['b1']
+
+    def test_each_call_gets_its_own_unit_of_work(self):
+        bus, created_uows = bootstrap_async_test_app()
+
+        async def scenario():
+            await bus.handle_async(commands.CreateBatch('b1', 'COMPLICATED-LAMP', 100, None))
+            await asyncio.gather(*[
+                bus.handle_async(commands.Allocate(f'o{i}', 'COMPLICATED-LAMP', 10)) for i in range(3)
+            ])
+
+        asyncio.run(scenario())
+        # UoW команды и UoW проекции в модель чтения на каждый вызов, кроме CreateBatch (событий Allocated нет)
+        assert len(created_uows) == 7
+        assert all(uow.commited for uow in created_uows)
+        assert sorted(len(uow.session.executed) for uow in created_uows) == [0, 0, 0, 0, 1, 1, 1]
+
+    def test_runs_sync_event_handlers(self):
+        fake_notifs = FakeNotifications()
+        bus, _ = bootstrap_async_test_app(notifications=fake_notifs)
+
+        async def scenario():
+            await bus.handle_async(commands.CreateBatch('b1', 'POPULAR-CURTAINS', 9, None))
+            return await bus.handle_async(commands.Allocate('o1', 'POPULAR-CURTAINS', 10))
+
+        assert asyncio.run(scenario()) == [None]
+        assert fake_notifs.sent['stock@made.com'] == [f'Артикула POPULAR-CURTAINS нет в наличии']
+
+    def test_error_for_invalid_sku(self):
+        bus, _ = bootstrap_async_test_app()
+
+        with pytest.raises(handlers.InvalidSku, match=f'Недопустимый артикул NONE'):
+            asyncio.run(bus.handle_async(commands.Allocate('o1', 'NONE', 10)))
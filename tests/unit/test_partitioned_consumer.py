@@ -0,0 +1,147 @@
+import os
+import time
+import json
+import multiprocessing
+import pytest
+from src.allocation.domain import commands
+from src.allocation.entrypoints.partitioned_consumer import HashRing, PartitionedStreamConsumer
+from tests.fake_redis import FakeRedis
+
+fork = pytest.mark.skipif('fork' not in multiprocessing.get_all_start_methods(), reason='нужен запуск процессов через fork')
+
+
+class RecordingBusFactory:
+    """
+    Фабрика шины процесса-обработчика: каждая обработанная позиция (pid, артикул, заказ) отправляется в очередь теста
+    Процесс завершается аварийно на заказах из crash_orders, заказы из slow_orders обрабатывает дольше секунды
+    """
+
+    def __init__(self, crash_orders=(), slow_orders=()) -> None:
+        self.records = multiprocessing.get_context('fork').Queue()
+        self.crash_orders = set(crash_orders)
+        self.slow_orders = set(slow_orders)
+
+    def __call__(self):
+        return self
+
+    def handle(self, command):
+        lines = command.lines if isinstance(command, commands.AllocateMany) else [command]
+        for line in lines:
+            if getattr(line, 'orderid', None) in self.crash_orders:
+                os._exit(1)
+            if getattr(line, 'orderid', None) in self.slow_orders:
+                time.sleep(1.5)
+            self.records.put((os.getpid(), getattr(line, 'sku', getattr(line, 'ref', None)), getattr(line, 'orderid', None)))
+
+    def drain(self, n):
+        return [self.records.get(timeout=10) for _ in range(n)]
+
+
+def make_consumer(fake_redis, bus_factory, workers=3, **options):
+    consumer = PartitionedStreamConsumer(
+        fake_redis, group='allocation', consumer='runner', workers=workers, bus_factory=bus_factory,
+        resolve_sku={'b-lamp': 'LAMP'}.get, mp_context=multiprocessing.get_context('fork'), **options
+    )
+    consumer.ensure_groups()
+    return consumer
+
+
+def add_allocation(fake_redis, orderid, sku):
+    fake_redis.xadd('allocate', {'data': json.dumps({'orderid': orderid, 'sku': sku, 'qty': 1})})
+
+
+class TestHashRing:
+
+    def test_same_key_same_node(self):
+        ring = HashRing(range(4))
+        assert {ring.node_for('LAMP') for _ in range(10)} == {ring.node_for('LAMP')}
+        assert HashRing(range(4)).node_for('LAMP') == ring.node_for('LAMP')
+
+    def test_keys_are_spread_over_all_nodes(self):
+        ring = HashRing(range(4))
+        counts = [0] * 4
+        for i in range(4000):
+            counts[ring.node_for(f'SKU-{i}')] += 1
+        assert min(counts) > 600
+
+    def test_adding_node_moves_few_keys(self):
+        """
+        Тест для проверки согласованности: при добавлении пятого узла переезжает около 1/5 ключей, а не почти все
+        """
+        before, after = HashRing(range(4)), HashRing(range(5))
+        keys = [f'SKU-{i}' for i in range(4000)]
+        moved = sum(before.node_for(key) != after.node_for(key) for key in keys)
+        assert moved < len(keys) * 0.3
+
+
+class TestPartitioning:
+
+    def test_quantity_change_is_routed_by_batch_sku(self):
+        consumer = make_consumer(FakeRedis(), RecordingBusFactory(), workers=8)
+        assert consumer.partition_key(commands.ChangeBatchQuantity('b-lamp', 5)) == 'LAMP'
+        assert consumer.partition_key(commands.Allocate('o1', 'LAMP', 1)) == 'LAMP'
+        assert consumer.partition_key(commands.ChangeBatchQuantity('b-unknown', 5)) == 'b-unknown'
+
+    @fork
+    def test_workers_keep_per_sku_order(self):
+        fake_redis, bus_factory = FakeRedis(), RecordingBusFactory()
+        consumer = make_consumer(fake_redis, bus_factory, batch_size=10)
+        consumer.start()
+        try:
+            skus = [f'SKU-{i}' for i in range(6)]
+            for n in range(5):
+                for sku in skus:
+                    add_allocation(fake_redis, f'{sku}-{n}', sku)
+
+            assert consumer.read_batch() == 10
+            assert consumer.read_batch() == 10
+            assert consumer.read_batch() == 10
+            records = bus_factory.drain(30)
+        finally:
+            consumer.close()
+
+        for sku in skus:
+            handled = [(pid, orderid) for pid, record_sku, orderid in records if record_sku == sku]
+            assert [orderid for _, orderid in handled] == [f'{sku}-{n}' for n in range(5)]
+            assert len({pid for pid, _ in handled}) == 1    # все команды артикула - в одном процессе
+        assert len({pid for pid, _, _ in records}) > 1
+        assert consumer.lag()['allocate']['pending'] == 0
+        assert not any(process.is_alive() for process in consumer.processes)
+
+    @fork
+    def test_crashed_worker_is_restarted_and_entries_stay_pending(self):
+        fake_redis, bus_factory = FakeRedis(), RecordingBusFactory(crash_orders=['crash'])
+        consumer = make_consumer(fake_redis, bus_factory, workers=1)
+        consumer.start()
+        try:
+            add_allocation(fake_redis, 'crash', 'LAMP')
+            assert consumer.read_batch() == 0
+            assert consumer.lag()['allocate']['pending'] == 1
+
+            add_allocation(fake_redis, 'o1', 'LAMP')
+            assert consumer.read_batch() == 1
+            assert bus_factory.drain(1)[0][2] == 'o1'
+        finally:
+            consumer.close()
+
+    @fork
+    def test_late_result_is_acked_before_next_commands_of_its_worker(self):
+        """
+        Тест для проверки пачки, по которой истек result_timeout: ее команды уже зафиксированы, поэтому
+        записи подтверждаются по приходу результата, а не повторяются после более новых команд артикула
+        """
+        fake_redis, bus_factory = FakeRedis(), RecordingBusFactory(slow_orders=['slow'])
+        consumer = make_consumer(fake_redis, bus_factory, workers=1, result_timeout=0.3)
+        consumer.start()
+        try:
+            add_allocation(fake_redis, 'slow', 'LAMP')
+            assert consumer.read_batch() == 0
+            assert consumer.lag()['allocate']['pending'] == 1
+
+            add_allocation(fake_redis, 'o2', 'LAMP')
+            assert consumer.read_batch() == 1
+            assert [orderid for _, _, orderid in bus_factory.drain(2)] == ['slow', 'o2']
+            assert consumer.lag()['allocate']['pending'] == 0
+            assert consumer.claim_stale() == 0
+        finally:
+            consumer.close()
@@ -1,6 +1,8 @@
+import pytest
 from datetime import date, timedelta
 from src.allocation.domain.models import OrderLine, Batch, Product
 from src.allocation.domain import events
+from src.allocation.domain.exceptions import NoOrderInBatch
 
 
 today = date.today()
@@ -67,4 +69,182 @@ class TestProduct:
         allocation = product.allocate(OrderLine('order2', 'SMALL-FORK', 1))
         assert product.events[-1] == events.OutOfStock(sku='SMALL-FORK')
         assert allocation is None
-    
\ No newline at end of file
+
+
+    def test_every_change_increments_version_number(self):
+        """
+        Тест для проверки, что версия продукта растет при каждом изменении и не повторяется (маркер для CAS)
+        """
+        product = Product(sku='RETRO-CLOCK', batches=[], version_number=7)
+        product.add_batch(Batch('batch1', 'RETRO-CLOCK', 10, eta=None))
+        product.allocate(OrderLine('order1', 'RETRO-CLOCK', 10))
+        product.deallocate(OrderLine('order1', 'RETRO-CLOCK', 10))
+        product.change_batch_quantity('batch1', 5)
+
+        assert product.version_number == 11
+
+
+    def test_out_of_stock_does_not_change_version_number(self):
+        product = Product(sku='RETRO-CLOCK', batches=[Batch('batch1', 'RETRO-CLOCK', 1, eta=None)], version_number=3)
+        product.allocate(OrderLine('order1', 'RETRO-CLOCK', 10))
+        assert product.version_number == 3
+
+
+class TestBatchPriorityIndex:
+
+    def test_allocates_to_first_batch_with_enough_stock_in_priority_order(self):
+        """
+        Тест для проверки, что размещение пропускает приоритетные партии, в которых не хватает товара
+        """
+        small_in_stock = Batch("small-in-stock", "RED-CHAIR", 5, eta=None)
+        large_later = Batch("large-later", "RED-CHAIR", 100, eta=later)
+        large_tomorrow = Batch("large-tomorrow", "RED-CHAIR", 100, eta=tomorrow)
+        product = Product(sku="RED-CHAIR", batches=[small_in_stock, large_later, large_tomorrow])
+
+        assert product.allocate(OrderLine("order1", "RED-CHAIR", 10)) == "large-tomorrow"
+        assert product.allocate(OrderLine("order2", "RED-CHAIR", 5)) == "small-in-stock"
+        assert product.allocate(OrderLine("order3", "RED-CHAIR", 91)) == "large-later"
+
+
+    def test_batches_with_equal_eta_keep_insertion_order(self):
+        first = Batch("first", "RED-CHAIR", 10, eta=today)
+        second = Batch("second", "RED-CHAIR", 10, eta=today)
+        product = Product(sku="RED-CHAIR", batches=[first, second])
+
+        assert product.allocate(OrderLine("order1", "RED-CHAIR", 10)) == "first"
+        assert product.allocate(OrderLine("order2", "RED-CHAIR", 10)) == "second"
+
+
+    def test_index_sees_added_batches(self):
+        """
+        Тест для проверки, что партия, добавленная после построения индекса, участвует в размещении
+        """
+        product = Product(sku="RED-CHAIR", batches=[Batch("later", "RED-CHAIR", 10, eta=later)])
+        product.allocate(OrderLine("order1", "RED-CHAIR", 1))
+
+        product.add_batch(Batch("in-stock", "RED-CHAIR", 10, eta=None))
+        assert product.allocate(OrderLine("order2", "RED-CHAIR", 1)) == "in-stock"
+
+        product.batches.append(Batch("in-stock-2", "RED-CHAIR", 50, eta=None))
+        assert product.allocate(OrderLine("order3", "RED-CHAIR", 20)) == "in-stock-2"
+
+
+    def test_index_follows_batch_quantity_changes(self):
+        batch = Batch("in-stock", "RED-CHAIR", 10, eta=None)
+        product = Product(sku="RED-CHAIR", batches=[batch, Batch("later", "RED-CHAIR", 10, eta=later)])
+        product.allocate(OrderLine("order1", "RED-CHAIR", 10))
+
+        product.change_batch_quantity("in-stock", 30)
+        assert product.allocate(OrderLine("order2", "RED-CHAIR", 20)) == "in-stock"
+
+        product.deallocate(OrderLine("order2", "RED-CHAIR", 20))
+        product.change_batch_quantity("in-stock", 12)
+        assert product.allocate(OrderLine("order3", "RED-CHAIR", 5)) == "later"
+
+
+class TestLineIndex:
+
+    def test_deallocates_from_the_batch_holding_the_line(self):
+        """
+        Тест для проверки отмены размещения позиции через обратный индекс позиция -> партия
+        """
+        in_stock_batch = Batch("in-stock-batch", "BLACK-LAMP", 10, eta=None)
+        shipment_batch = Batch("shipment-batch", "BLACK-LAMP", 100, eta=tomorrow)
+        product = Product(sku="BLACK-LAMP", batches=[in_stock_batch, shipment_batch])
+        product.allocate(OrderLine("order1", "BLACK-LAMP", 10))
+        product.allocate(OrderLine("order2", "BLACK-LAMP", 10))
+
+        assert product.deallocate(OrderLine("order2", "BLACK-LAMP", 10)) == "shipment-batch"
+        assert shipment_batch.available_quantity == 100
+        assert product.line_index_is_consistent()
+
+
+    def test_cannot_deallocate_unallocated_line(self):
+        product = Product(sku="BLACK-LAMP", batches=[Batch("batch1", "BLACK-LAMP", 10, eta=None)])
+        product.allocate(OrderLine("order1", "BLACK-LAMP", 5))
+
+        with pytest.raises(NoOrderInBatch):
+            product.deallocate(OrderLine("order2", "BLACK-LAMP", 5))
+        with pytest.raises(NoOrderInBatch):
+            product.deallocate(OrderLine("order1", "BLACK-LAMP", 3))
+
+
+    def test_index_stays_consistent_with_allocations(self):
+        """
+        Тест для проверки согласованности индекса с _allocations после размещения,
+        отмены размещения и уменьшения партии
+        """
+        batch = Batch("batch1", "BLACK-LAMP", 30, eta=None)
+        product = Product(sku="BLACK-LAMP", batches=[batch, Batch("batch2", "BLACK-LAMP", 30, eta=later)])
+        for i in range(5):
+            product.allocate(OrderLine(f"order{i}", "BLACK-LAMP", 5))
+        product.deallocate(OrderLine("order0", "BLACK-LAMP", 5))
+        assert product.line_index_is_consistent()
+
+        product.change_batch_quantity("batch1", 10)
+        assert product.line_index_is_consistent()
+        assert len(product.line_index) == 2
+        for line in batch._allocations:
+            assert product.line_index[line] is batch
+
+
+    def test_lines_of_one_order_and_sku_with_different_qty_are_indexed_separately(self):
+        """
+        Тест для проверки индекса по позиции целиком: позиции o1/S/5 и o1/S/3 не затирают друг друга
+        """
+        batch = Batch("batch1", "BLACK-LAMP", 100, eta=None)
+        product = Product(sku="BLACK-LAMP", batches=[batch])
+        product.allocate(OrderLine("o1", "BLACK-LAMP", 5))
+        product.allocate(OrderLine("o1", "BLACK-LAMP", 3))
+
+        assert product.deallocate(OrderLine("o1", "BLACK-LAMP", 5)) == "batch1"
+        assert product.line_index_is_consistent()
+        assert product.deallocate(OrderLine("o1", "BLACK-LAMP", 3)) == "batch1"
+        assert batch.available_quantity == 100
+
+
+    def test_lines_of_one_order_and_sku_in_different_batches(self):
+        """
+        Тест для проверки отмены размещения позиции из своей партии, если другая позиция того же заказа
+        и артикула лежит в другой партии
+        """
+        in_stock_batch = Batch("in-stock-batch", "BLACK-LAMP", 5, eta=None)
+        shipment_batch = Batch("shipment-batch", "BLACK-LAMP", 100, eta=tomorrow)
+        product = Product(sku="BLACK-LAMP", batches=[in_stock_batch, shipment_batch])
+        product.allocate(OrderLine("o1", "BLACK-LAMP", 5))
+        product.allocate(OrderLine("o1", "BLACK-LAMP", 3))
+
+        assert product.deallocate(OrderLine("o1", "BLACK-LAMP", 5)) == "in-stock-batch"
+        assert product.deallocate(OrderLine("o1", "BLACK-LAMP", 3)) == "shipment-batch"
+        assert product.line_index_is_consistent()
+
+
+class TestDryRun:
+
+    def test_dry_run_allocation_changes_nothing(self):
+        """
+        Тест для проверки пробного размещения: партия выбрана, но остатки, версия и события продукта прежние
+        """
+        batch = Batch("batch1", "BLACK-LAMP", 10, eta=None)
+        product = Product(sku="BLACK-LAMP", batches=[batch], version_number=3)
+
+        assert product.allocate(OrderLine("order1", "BLACK-LAMP", 10), dry_run=True) == "batch1"
+        assert product.allocate(OrderLine("order2", "BLACK-LAMP", 11), dry_run=True) is None
+
+        assert batch.available_quantity == 10
+        assert product.version_number == 3
+        assert list(product.events) == []
+
+
+    def test_plan_reserves_stock_for_later_lines_of_the_cart(self):
+        """
+        Тест для проверки плана корзины: каждая позиция уменьшает остаток партии для следующих
+        """
+        in_stock = Batch("in-stock", "BLACK-LAMP", 10, eta=None)
+        shipment = Batch("shipment", "BLACK-LAMP", 5, eta=tomorrow)
+        product = Product(sku="BLACK-LAMP", batches=[in_stock, shipment])
+        lines = [OrderLine(f"order{i}", "BLACK-LAMP", qty) for i, qty in enumerate((6, 5, 4, 1))]
+
+        assert product.plan(lines) == ["in-stock", "shipment", "in-stock", None]
+        assert in_stock.available_quantity == 10
+        assert product.allocate(OrderLine("order9", "BLACK-LAMP", 6)) == "in-stock"
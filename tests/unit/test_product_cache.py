@@ -0,0 +1,41 @@
+from src.allocation.domain.models import Product
+from src.allocation.adapters.product_cache import ProductCache
+
+
+class TestProductCache:
+
+    def test_checked_out_product_is_not_given_to_another_unit_of_work(self):
+        cache = ProductCache()
+        product = Product('LAMP', batches=[], version_number=1)
+        cache.checkin(product)
+
+        assert cache.checkout('LAMP') is product
+        assert cache.checkout('LAMP') is None
+
+    def test_older_version_does_not_replace_newer(self):
+        cache = ProductCache()
+        newer = Product('LAMP', batches=[], version_number=5)
+        cache.checkin(newer)
+        cache.checkin(Product('LAMP', batches=[], version_number=4))
+
+        assert cache.checkout('LAMP') is newer
+
+    def test_least_recently_returned_product_is_evicted(self):
+        cache = ProductCache(max_size=2)
+        for sku in ('LAMP', 'TABLE', 'CHAIR'):
+            cache.checkin(Product(sku, batches=[], version_number=1))
+
+        assert cache.checkout('LAMP') is None
+        assert cache.checkout('CHAIR') is not None
+        assert cache.stats.as_dict()['evictions'] == 1
+
+    def test_saved_time_is_estimated_from_average_load(self):
+        cache = ProductCache()
+        cache.stats.increment('misses', 2)
+        cache.stats.increment('load_seconds', 0.02)
+        cache.stats.increment('hits', 8)
+        cache.stats.increment('hit_seconds', 0.008)
+
+        stats = cache.stats.as_dict()
+        assert stats['hit_ratio'] == 0.8
+        assert round(stats['saved_seconds'], 6) == 0.072
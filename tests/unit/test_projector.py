@@ -0,0 +1,107 @@
+import asyncio
+from src.allocation.adapters.view_cache import LruTtlCache, ViewCache
+from src.allocation.domain import events
+from src.allocation.service_layer.projector import (
+    DELETE_ALLOCATIONS, UPSERT_ALLOCATIONS, ReadModelProjector, net_changes
+)
+from tests.fake_uow import FakeUnitOfWork, FakeAsyncUnitOfWork
+
+
+class FailingUnitOfWork(FakeUnitOfWork):
+
+    def _commit(self) -> None:
+        raise RuntimeError('БД недоступна')
+
+
+class TestNetChanges:
+
+    def test_last_event_per_line_wins(self):
+        upserts, deletes = net_changes([
+            events.Allocated('o1', 'LAMP', 1, 'b1'),
+            events.Allocated('o2', 'LAMP', 1, 'b1'),
+            events.Deallocated('o1', 'LAMP', 1),
+            events.Deallocated('o3', 'LAMP', 1),
+            events.Allocated('o3', 'LAMP', 1, 'b2'),
+            events.Allocated('o2', 'LAMP', 1, 'b2'),
+        ])
+
+        assert upserts == [
+            {'orderid': 'o2', 'sku': 'LAMP', 'qty': 1, 'batchref': 'b2'},
+            {'orderid': 'o3', 'sku': 'LAMP', 'qty': 1, 'batchref': 'b2'},
+        ]
+        assert deletes == [{'orderid': 'o1', 'sku': 'LAMP', 'qty': 1}]
+
+    def test_lines_of_same_order_and_sku_are_kept_apart(self):
+        upserts, deletes = net_changes([
+            events.Allocated('o1', 'LAMP', 5, 'b1'),
+            events.Allocated('o1', 'LAMP', 3, 'b2'),
+            events.Deallocated('o1', 'LAMP', 5),
+        ])
+
+        assert upserts == [{'orderid': 'o1', 'sku': 'LAMP', 'qty': 3, 'batchref': 'b2'}]
+        assert deletes == [{'orderid': 'o1', 'sku': 'LAMP', 'qty': 5}]
+
+
+class TestReadModelProjector:
+
+    def test_events_of_scope_are_applied_in_one_transaction(self):
+        uow = FakeUnitOfWork()
+        projector = ReadModelProjector(lambda: uow)
+
+        with projector.message_scope():
+            for i in range(100):
+                projector(events.Allocated(f'o{i}', 'LAMP', 1, 'b1'))
+            projector(events.Deallocated('o0', 'LAMP', 1))
+            assert uow.commits == 0
+
+        assert uow.commits == 1
+        [(delete, deleted), (upsert, upserted)] = uow.session.executed
+        assert (delete, upsert) == (DELETE_ALLOCATIONS, UPSERT_ALLOCATIONS)
+        assert deleted == [{'orderid': 'o0', 'sku': 'LAMP', 'qty': 1}]
+        assert len(upserted) == 99
+
+    def test_event_outside_scope_is_applied_immediately(self):
+        uow = FakeUnitOfWork()
+        projector = ReadModelProjector(lambda: uow)
+
+        projector(events.Allocated('o1', 'LAMP', 1, 'b1'))
+
+        assert uow.commits == 1
+
+    def test_orders_are_invalidated_in_cache_after_commit(self):
+        cache = ViewCache(LruTtlCache())
+        cache.set('o1', [])
+        cache.set('o2', [])
+        projector = ReadModelProjector(FakeUnitOfWork, cache=cache)
+
+        with projector.message_scope():
+            projector(events.Allocated('o1', 'LAMP', 1, 'b1'))
+
+        assert cache.local.get('o1') is None
+        assert cache.local.get('o2') == []
+
+    def test_failed_flush_does_not_fail_the_call(self):
+        projector = ReadModelProjector(FailingUnitOfWork, retry_attempts=2)
+
+        with projector.message_scope():
+            projector(events.Allocated('o1', 'LAMP', 1, 'b1'))
+
+    def test_async_scope(self):
+        created = []
+
+        def async_uow_factory():
+            created.append(FakeAsyncUnitOfWork(set()))
+            return created[-1]
+
+        projector = ReadModelProjector(FakeUnitOfWork, async_uow_factory)
+
+        async def scenario():
+            async with projector.async_message_scope():
+                await projector.project_async(events.Allocated('o1', 'LAMP', 1, 'b1'))
+                await projector.project_async(events.Allocated('o2', 'LAMP', 1, 'b1'))
+
+        asyncio.run(scenario())
+        [uow] = created
+        assert uow.commited
+        [(statement, rows)] = uow.session.executed
+        assert statement is UPSERT_ALLOCATIONS and len(rows) == 2
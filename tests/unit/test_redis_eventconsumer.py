@@ -0,0 +1,223 @@
+import json
+from datetime import date
+from src.allocation import bootstrap
+from src.allocation.domain import commands
+from src.allocation.entrypoints.redis_eventconsumer import StreamConsumer, coalesce
+from tests.fake_redis import FakeRedis
+from tests.fake_uow import FakeUnitOfWork
+
+
+class RecordingBus:
+    """
+    Фейковая шина: запоминает команды, падает на артикулах из failing_skus и заказах из failing_orders
+    """
+
+    def __init__(self, failing_skus=(), failing_orders=()) -> None:
+        self.handled = []
+        self.failing_skus = set(failing_skus)
+        self.failing_orders = set(failing_orders)
+
+    def handle(self, command):
+        lines = command.lines if isinstance(command, commands.AllocateMany) else [command]
+        for line in lines:
+            if getattr(line, 'sku', None) in self.failing_skus or getattr(line, 'orderid', None) in self.failing_orders:
+                raise RuntimeError(f'Ошибка обработки {command}')
+        self.handled.append(command)
+
+    @property
+    def allocated_orders(self):
+        return [
+            line.orderid for command in self.handled
+            for line in (command.lines if isinstance(command, commands.AllocateMany) else [command])
+        ]
+
+
+def make_consumer(fake_redis, bus, name, **options):
+    consumer = StreamConsumer(fake_redis, bus, group='allocation', consumer=name, **options)
+    consumer.ensure_groups()
+    return consumer
+
+
+def add_allocations(fake_redis, n, sku='STREAM-LAMP', first=0):
+    for i in range(first, first + n):
+        fake_redis.xadd('allocate', {'data': json.dumps({'orderid': f'o{i}', 'sku': sku, 'qty': 1})})
+
+
+def add_quantity_change(fake_redis, batchref, qty):
+    fake_redis.xadd('change_batch_quantity', {'data': json.dumps({'batchref': batchref, 'qty': qty})})
+
+
+class TestStreamConsumer:
+
+    def test_consumers_in_group_share_entries(self):
+        """
+        Тест для проверки группы потребителей: каждая запись достается ровно одному потребителю
+        """
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        first = make_consumer(fake_redis, bus, 'first', batch_size=3)
+        second = make_consumer(fake_redis, bus, 'second', batch_size=3)
+        add_allocations(fake_redis, 5)
+
+        assert first.read_batch() == 3
+        assert second.read_batch() == 2
+        assert first.read_batch() == 0
+
+        assert sorted(bus.allocated_orders) == [f'o{i}' for i in range(5)]
+        assert first.lag() == {'change_batch_quantity': {'pending': 0, 'lag': 0}, 'allocate': {'pending': 0, 'lag': 0}}
+
+    def test_batch_is_acknowledged_in_one_call(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first', batch_size=100)
+        add_allocations(fake_redis, 50)
+        round_trips = fake_redis.round_trips
+
+        assert consumer.read_batch() == 50
+        # XREADGROUP на каждый поток, пустое ожидание в окне пачки и XACK
+        assert fake_redis.round_trips == round_trips + len(consumer.handlers) + 2
+
+    def test_entries_of_stalled_consumer_are_claimed(self):
+        fake_redis = FakeRedis()
+        stalled = make_consumer(fake_redis, RecordingBus(failing_skus=['STREAM-LAMP']), 'stalled', claim_idle_ms=1000)
+        healthy_bus = RecordingBus()
+        healthy = make_consumer(fake_redis, healthy_bus, 'healthy', claim_idle_ms=1000)
+        add_allocations(fake_redis, 2)
+
+        assert stalled.read_batch() == 0
+        assert healthy.claim_stale() == 0      # записи еще не простаивали claim_idle_ms
+        fake_redis.advance(2)
+
+        assert healthy.claim_stale() == 2
+        assert healthy_bus.allocated_orders == ['o0', 'o1']
+        assert healthy.stats.as_dict()['claimed'] == 2
+        assert healthy.lag()['allocate']['pending'] == 0
+
+    def test_poison_entry_goes_to_dead_letter_stream(self):
+        fake_redis = FakeRedis()
+        consumer = make_consumer(
+            fake_redis, RecordingBus(failing_skus=['POISON']), 'first', claim_idle_ms=1000, max_deliveries=2
+        )
+        add_allocations(fake_redis, 1, sku='POISON')
+
+        consumer.read_batch()
+        for _ in range(2):
+            fake_redis.advance(2)
+            consumer.claim_stale()
+
+        [(_, fields)] = fake_redis.streams['allocate.dead']
+        assert json.loads(fields[b'data'])['sku'] == 'POISON'
+        assert consumer.stats.as_dict()['dead_lettered'] == 1
+        assert consumer.stats.as_dict()['failed'] == 2
+        assert consumer.lag()['allocate']['pending'] == 0
+
+    def test_change_batch_quantity_stream(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first')
+        fake_redis.xadd('change_batch_quantity', {'data': json.dumps({'batchref': 'b1', 'qty': 5})})
+
+        consumer.read_batch()
+        assert bus.handled == [commands.ChangeBatchQuantity('b1', 5)]
+
+
+class TestCoalescing:
+
+    def test_allocations_are_grouped_per_sku(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first')
+        add_allocations(fake_redis, 3, sku='LAMP')
+        add_allocations(fake_redis, 2, sku='TABLE', first=3)
+        add_allocations(fake_redis, 1, sku='CHAIR', first=5)
+
+        assert consumer.read_batch() == 6
+
+        assert bus.handled == [
+            commands.AllocateMany([commands.Allocate(f'o{i}', 'LAMP', 1) for i in range(3)]),
+            commands.AllocateMany([commands.Allocate(f'o{i}', 'TABLE', 1) for i in (3, 4)]),
+            commands.Allocate('o5', 'CHAIR', 1),
+        ]
+        assert consumer.stats.as_dict()['commands'] == 3
+        assert consumer.lag()['allocate']['pending'] == 0
+
+    def test_superseded_quantity_changes_collapse_to_last_value(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first')
+        for qty in (10, 5, 7):
+            add_quantity_change(fake_redis, 'b1', qty)
+        add_quantity_change(fake_redis, 'b2', 3)
+
+        assert consumer.read_batch() == 4
+
+        assert bus.handled == [commands.ChangeBatchQuantity('b1', 7), commands.ChangeBatchQuantity('b2', 3)]
+        assert consumer.lag()['change_batch_quantity']['pending'] == 0
+
+    def test_batch_is_bounded_by_size(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first', batch_size=4)
+        add_allocations(fake_redis, 10)
+
+        assert consumer.read_batch() == 4
+        assert bus.handled == [commands.AllocateMany([commands.Allocate(f'o{i}', 'STREAM-LAMP', 1) for i in range(4)])]
+
+    def test_batch_size_is_shared_by_streams(self):
+        """
+        Тест для проверки размера пачки: count в XREADGROUP действует на каждый поток,
+        пачка нескольких потоков все равно не больше batch_size
+        """
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first', batch_size=3)
+        add_allocations(fake_redis, 3)
+        for i in range(3):
+            add_quantity_change(fake_redis, f'b{i}', 10)
+
+        assert consumer.read_batch() == 3
+        assert consumer.read_batch() == 3
+        assert consumer.read_batch() == 0
+        assert consumer.lag() == {'change_batch_quantity': {'pending': 0, 'lag': 0}, 'allocate': {'pending': 0, 'lag': 0}}
+
+    def test_batch_is_bounded_by_window(self):
+        fake_redis, bus = FakeRedis(), RecordingBus()
+        consumer = make_consumer(fake_redis, bus, 'first', batch_window_ms=0)
+        add_allocations(fake_redis, 2)
+        round_trips = fake_redis.round_trips
+
+        assert consumer.read_batch() == 2
+        # окно истекло сразу: XREADGROUP на каждый поток и XACK, без ожидания
+        assert fake_redis.round_trips == round_trips + len(consumer.handlers) + 1
+
+    def test_failed_group_is_retried_line_by_line(self):
+        """
+        Тест для проверки изоляции ошибки: упавшая запись остается в ожидающих, остальные записи артикула подтверждены
+        """
+        fake_redis, bus = FakeRedis(), RecordingBus(failing_orders=['o1'])
+        consumer = make_consumer(fake_redis, bus, 'first')
+        add_allocations(fake_redis, 3)
+
+        assert consumer.read_batch() == 2
+
+        assert bus.allocated_orders == ['o0', 'o2']
+        assert consumer.stats.as_dict()['failed'] == 1
+        assert consumer.lag()['allocate']['pending'] == 1
+
+    def test_coalesce_keeps_first_appearance_order(self):
+        entries = [
+            (b'1-0', commands.ChangeBatchQuantity('b1', 10)),
+            (b'1-1', commands.ChangeBatchQuantity('b2', 5)),
+            (b'1-2', commands.ChangeBatchQuantity('b1', 1)),
+        ]
+        assert coalesce(entries) == [
+            ([b'1-0', b'1-2'], commands.ChangeBatchQuantity('b1', 1)),
+            ([b'1-1'], commands.ChangeBatchQuantity('b2', 5)),
+        ]
+
+    def test_batch_allocates_through_bus_in_one_commit_per_sku(self):
+        uow = FakeUnitOfWork()
+        bus = bootstrap.bootstrap(start_orm=False, uow=uow, notifications=lambda *args: None)
+        bus.handle(commands.CreateBatch('b1', 'STREAM-LAMP', 100, date(2024, 1, 1)))
+        fake_redis = FakeRedis()
+        consumer = make_consumer(fake_redis, bus, 'first')
+        add_allocations(fake_redis, 20)
+
+        assert consumer.read_batch() == 20
+
+        [batch] = uow.products.get('STREAM-LAMP').batches
+        assert batch.available_quantity == 80
+        assert consumer.stats.as_dict()['commands'] == 1
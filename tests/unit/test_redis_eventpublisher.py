@@ -0,0 +1,54 @@
+import json
+from dataclasses import asdict
+from src.allocation import bootstrap
+from src.allocation.adapters import redis_eventpublisher
+from src.allocation.adapters.redis_eventpublisher import RedisEventPublisher
+from src.allocation.domain import commands, events
+from tests.fake_redis import FakeRedis
+from tests.fake_uow import FakeUnitOfWork, FakeAsyncUnitOfWork
+
+
+def bootstrap_publishing_app(fake_redis):
+    uow = FakeUnitOfWork()
+    return bootstrap.bootstrap(
+        start_orm=False,
+        uow=uow,
+        notifications=lambda *args: None,
+        publish=RedisEventPublisher(fake_redis),
+        async_uow_factory=lambda: FakeAsyncUnitOfWork(uow.products._products)
+    )
+
+
+class TestRedisEventPublisher:
+
+    def test_publishes_each_event_to_its_channel(self):
+        fake_redis = FakeRedis()
+        publish = RedisEventPublisher(fake_redis)
+
+        publish(events.Allocated('o1', 'LAMP', 10, 'b1'))
+        publish(events.Deallocated('o2', 'LAMP', 10))
+
+        assert [channel for channel, _ in fake_redis.published] == ['line_allocated']
+        assert json.loads(fake_redis.published[0][1]) == {'orderid': 'o1', 'sku': 'LAMP', 'qty': 10, 'batchref': 'b1'}
+
+    def test_publishes_allocations_of_handle_call(self):
+        fake_redis = FakeRedis()
+        bus = bootstrap_publishing_app(fake_redis)
+        bus.handle(commands.CreateBatch('batch1', 'INDIFFERENT-TABLE', 50, None))
+
+        bus.handle(commands.AllocateMany([commands.Allocate(f'order{i}', 'INDIFFERENT-TABLE', 10) for i in range(3)]))
+
+        assert [json.loads(message)['orderid'] for _, message in fake_redis.published] == ['order0', 'order1', 'order2']
+
+    def test_redis_failure_does_not_fail_committed_command(self):
+        fake_redis = FakeRedis()
+        fake_redis.down = True
+        bus = bootstrap_publishing_app(fake_redis)
+        bus.handle(commands.CreateBatch('batch1', 'DOWN-TABLE', 50, None))
+
+        assert bus.handle(commands.Allocate('order1', 'DOWN-TABLE', 10)) == ['batch1']
+        assert bus.uow.commited
+
+    def test_serialize_matches_asdict(self):
+        event = events.Allocated('o1', 'LAMP', 10, 'b1')
+        assert json.loads(redis_eventpublisher.serialize(event)) == asdict(event)
@@ -0,0 +1,161 @@
+from src.allocation import views
+from src.allocation.adapters.view_cache import LruTtlCache, RedisCache, ViewCache
+from tests.fake_redis import FakeRedis
+
+
+class FakeClock:
+
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+ALLOCATIONS = [{'sku': 'LAMP', 'batchref': 'b1'}]
+
+
+class TestLruTtlCache:
+
+    def test_least_recently_read_entry_is_evicted(self):
+        cache = LruTtlCache(max_size=2, ttl=60)
+        cache.set('o1', ALLOCATIONS)
+        cache.set('o2', ALLOCATIONS)
+        cache.get('o1')
+        cache.set('o3', ALLOCATIONS)
+
+        assert cache.get('o1') == ALLOCATIONS
+        assert cache.get('o2') is None
+        assert cache.stats.as_dict()['evictions'] == 1
+
+    def test_entry_expires_after_ttl(self):
+        clock = FakeClock()
+        cache = LruTtlCache(ttl=5, clock=clock)
+        cache.set('o1', ALLOCATIONS)
+
+        clock.now = 4.9
+        assert cache.get('o1') == ALLOCATIONS
+        clock.now = 5.0
+        assert cache.get('o1') is None
+        assert cache.stats.as_dict()['expirations'] == 1
+        assert len(cache) == 0
+
+
+class TestViewCache:
+
+    def test_counts_hits_and_misses(self):
+        cache = ViewCache(LruTtlCache())
+
+        assert cache.get('o1') is None
+        cache.set('o1', [])
+        assert cache.get('o1') == []    # пустой ответ тоже кешируется: заказ без размещений
+        cache.invalidate('o1')
+        assert cache.get('o1') is None
+
+        stats = cache.stats.as_dict()
+        assert (stats['hits'], stats['misses'], stats['invalidations']) == (1, 2, 1)
+        assert stats['hit_ratio'] == 1 / 3
+
+    def test_redis_tier_is_shared_between_processes(self):
+        """
+        Тест для проверки второго уровня: кеш другого процесса берет значение из Redis и инвалидация видна всем
+        """
+        fake_redis = FakeRedis()
+        first = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+        second = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+
+        first.set('o1', ALLOCATIONS)
+        assert second.get('o1') == ALLOCATIONS
+        assert second.stats.as_dict()['remote_hits'] == 1
+        assert second.get('o1') == ALLOCATIONS
+        assert second.stats.as_dict()['local_hits'] == 1
+
+        first.invalidate('o1')
+        second.local.clear()
+        assert second.get('o1') is None
+
+    def test_redis_entry_expires(self):
+        fake_redis = FakeRedis()
+        cache = ViewCache(LruTtlCache(), RedisCache(fake_redis, ttl=10))
+        cache.set('o1', ALLOCATIONS)
+        cache.local.clear()
+
+        fake_redis.advance(11)
+        assert cache.get('o1') is None
+
+    def test_unavailable_redis_is_a_miss(self):
+        fake_redis = FakeRedis()
+        cache = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+        fake_redis.down = True
+
+        cache.set('o1', ALLOCATIONS)
+        cache.local.clear()
+        assert cache.get('o1') is None
+        cache.invalidate('o1')
+
+    def test_fill_after_invalidation_during_read_is_skipped(self):
+        """
+        Тест для проверки гонки: читатель промахнулся и пошел в БД, обработчик проекции зафиксировал
+        изменение заказа и инвалидировал его, затем читатель пишет в кеш устаревшие строки - запись отбрасывается
+        """
+        cache = ViewCache(LruTtlCache())
+
+        cached, token = cache.lookup('o1')
+        assert cached is None
+        cache.invalidate('o1')
+        cache.set('o1', [], token)
+
+        assert cache.get('o1') is None
+        assert cache.stats.as_dict()['stale_fills'] == 1
+        cache.set('o1', ALLOCATIONS, cache.lookup('o1')[1])
+        assert cache.get('o1') == ALLOCATIONS
+
+    def test_invalidation_of_other_order_does_not_skip_fill(self):
+        cache = ViewCache(LruTtlCache())
+
+        _, token = cache.lookup('o1')
+        cache.invalidate('o2')
+        cache.set('o1', ALLOCATIONS, token)
+
+        assert cache.get('o1') == ALLOCATIONS
+
+    def test_fill_after_invalidation_in_other_process_is_skipped(self):
+        """
+        Тест для проверки гонки через Redis: инвалидацию выполнил другой процесс (потребитель потоков),
+        значение с устаревшим поколением ключа не выдается ни одному процессу
+        """
+        fake_redis = FakeRedis()
+        reader = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+        projector = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+        other = ViewCache(LruTtlCache(), RedisCache(fake_redis))
+
+        _, token = reader.lookup('o1')
+        projector.invalidate('o1')
+        reader.set('o1', [], token)
+
+        assert other.get('o1') is None
+        other.set('o1', ALLOCATIONS, other.lookup('o1')[1])
+        reader.local.clear()
+        assert reader.get('o1') == ALLOCATIONS
+
+    def test_fill_older_than_fill_window_is_skipped(self):
+        cache = ViewCache(LruTtlCache(), fill_window=0.0)
+
+        _, token = cache.lookup('o1')
+        cache.set('o1', ALLOCATIONS, token)
+
+        assert cache.get('o1') is None
+
+    def test_view_does_not_cache_rows_read_before_invalidation(self):
+        """
+        Тест для проверки views.allocations: проекция заказа фиксируется, пока идет запрос к модели чтения
+        """
+        cache = ViewCache(LruTtlCache())
+
+        class CommittingDuringRead:
+            def fetch_all(self, statement, **params):
+                cache.invalidate(params['orderid'])     # обработчик проекции зафиксировал размещение
+                return []                               # а читатель получил строки до фиксации
+
+        assert views.allocations('o1', CommittingDuringRead(), cache) == []
+        assert cache.get('o1') is None